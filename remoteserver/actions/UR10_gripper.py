@@ -1,23 +1,23 @@
-from tools.read_json import read_robot_json
+from tools.robot_profile import get_robot_profile
 
 
 def open_gripper():
-    robot_info = read_robot_json("UR10")
+    robot_profile = get_robot_profile("UR10")
     action_dict = [
         {
-            "pos_end_effector": robot_info["init_pose"]["pos_end_effector"],
-            "gripper": robot_info["gripper"]["open"],
+            "pos_end_effector": list(robot_profile.init_pose),
+            "gripper": robot_profile.gripper_open,
         }
     ]
     return action_dict
 
 
 def close_gripper():
-    robot_info = read_robot_json("UR10")
+    robot_profile = get_robot_profile("UR10")
     action_dict = [
         {
-            "pos_end_effector": robot_info["init_pose"]["pos_end_effector"],
-            "gripper": robot_info["gripper"]["close"],
+            "pos_end_effector": list(robot_profile.init_pose),
+            "gripper": robot_profile.gripper_close,
         }
     ]
     return action_dict
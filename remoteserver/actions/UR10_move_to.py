@@ -1,9 +1,9 @@
-from tools.read_json import read_robot_json
+from tools.robot_profile import get_robot_profile
 
 
 def move_to(pos: list):
-    robot_info = read_robot_json("UR10")
-    robot_init_pose = robot_info["init_pose"]["pos_end_effector"]
+    robot_profile = get_robot_profile("UR10")
+    robot_init_pose = robot_profile.init_pose
     quaternion = robot_init_pose[3:]
 
     move_pos = pos[:]
@@ -12,7 +12,7 @@ def move_to(pos: list):
     action_dict = [
         {
             "pos_end_effector": [*move_pos, *quaternion],
-            "gripper": robot_info["gripper"]["close"],
+            "gripper": robot_profile.gripper_close,
         }
     ]
 
@@ -1,11 +1,11 @@
-from tools.read_json import read_robot_json
+from tools.robot_profile import get_robot_profile
 
 
 def pick_and_place(pick_pos: list, place_pos: list):
-    robot_info = read_robot_json("UR10")
-    init_pose = robot_info["init_pose"]["pos_end_effector"]
-    gripper_open = robot_info["gripper"]["open"]
-    gripper_close = robot_info["gripper"]["close"]
+    robot_profile = get_robot_profile("UR10")
+    init_pose = robot_profile.init_pose
+    gripper_open = robot_profile.gripper_open
+    gripper_close = robot_profile.gripper_close
     quaternion = init_pose[3:]
     z_max = init_pose[2]
     z_min = -0.2673
@@ -0,0 +1,160 @@
+"""Dispatch table of the robot actions, built once from the robot profile.
+
+Every action of `actions/<robot>_action.json` is resolved at startup to the
+function of its `program` module, and its `parameters` field is compiled to a
+schema. A robot profile with a missing module or function, or a function that
+can't take the parameters of its action, fails at startup instead of on the
+first command using it.
+
+A plan is validated against the schemas before any robot motion is generated:
+an unknown action or parameters that don't match raise PlanValidationError.
+The parameters of an action are the robot poses of its objects (position, then
+orientation), one per object, e.g. pick_and_place ("array of two strings") takes two.
+"""
+
+import importlib
+import inspect
+import math
+import re
+import threading
+
+from tools.robot_profile import get_robot_profile
+
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+
+
+class PlanValidationError(ValueError):
+    """An action of a plan doesn't match the actions of the robot."""
+
+
+def parameter_count(parameter: dict) -> int:
+    """Number of objects of a parameter: "array of two strings" is two, anything else one."""
+    match = re.search(r"array of (\w+)", parameter.get("type", ""))
+    if not match:
+        return 1
+    word = match.group(1)
+    return int(word) if word.isdigit() else NUMBER_WORDS.get(word, 1)
+
+
+def action_arity(action: dict) -> int:
+    """Number of objects of an action, one or more per parameter."""
+    return sum(parameter_count(parameter) for parameter in action.get("parameters", []))
+
+
+class ActionSpec:
+    def __init__(self, action: dict, function):
+        self.name = action["name"]
+        self.program = action["program"]
+        self.function = function
+        parameters = action.get("parameters", [])
+        self.arity = action_arity(action)
+        # Optional parameters can be left out, from the end
+        self.min_arity = sum(
+            parameter_count(parameter)
+            for parameter in parameters
+            if parameter.get("required", True)
+        )
+
+    def validate(self, params) -> tuple:
+        """Positional arguments of the function, or PlanValidationError."""
+        if params == "None" or params is None:
+            params = ()
+        if not isinstance(params, (list, tuple)):
+            raise PlanValidationError(
+                f"{self.name}: parameters must be a list, got {params!r}"
+            )
+        if not self.min_arity <= len(params) <= self.arity:
+            expected = (
+                f"{self.arity}"
+                if self.min_arity == self.arity
+                else f"{self.min_arity} to {self.arity}"
+            )
+            raise PlanValidationError(
+                f"{self.name} expects {expected} objects, got {len(params)}"
+            )
+        for position in params:
+            if (
+                not isinstance(position, (list, tuple))
+                or len(position) < 2
+                or not all(
+                    isinstance(value, (int, float)) and math.isfinite(value)
+                    for value in position
+                )
+            ):
+                raise PlanValidationError(
+                    f"{self.name}: {position!r} is not a robot position"
+                )
+        return tuple(list(position) for position in params)
+
+    def __call__(self, params) -> list:
+        return self.function(*self.validate(params))
+
+
+class ActionRegistry:
+    def __init__(self, robot_profile):
+        self.robot_profile = robot_profile
+        self.specs = {}
+        errors = []
+        for action in robot_profile.to_dict()["actions"]:
+            try:
+                self.specs[action["name"]] = self.compile(action)
+            except (ImportError, AttributeError, TypeError, KeyError) as e:
+                errors.append(f"{action.get('name')}: {e}")
+        if errors:
+            raise ValueError(
+                f"Invalid actions in the profile of {robot_profile.robot_name}:\n"
+                + "\n".join(errors)
+            )
+
+    @staticmethod
+    def compile(action: dict) -> ActionSpec:
+        module = importlib.import_module(f"actions.{action['program']}")
+        function = getattr(module, action["name"])
+        if not callable(function):
+            raise TypeError(
+                f"actions.{action['program']}.{action['name']} is not callable"
+            )
+        # The function must take one argument per object
+        try:
+            inspect.signature(function).bind(*[None] * action_arity(action))
+        except TypeError as e:
+            raise TypeError(
+                f"{function.__name__} can't take {action_arity(action)} objects: {e}"
+            ) from None
+        return ActionSpec(action, function)
+
+    def spec(self, action_name: str) -> ActionSpec:
+        spec = self.specs.get(action_name)
+        if spec is None:
+            raise PlanValidationError(
+                f"{self.robot_profile.robot_name} has no action {action_name}"
+            )
+        return spec
+
+    def validate(self, action_name: str, params) -> tuple:
+        return self.spec(action_name).validate(params)
+
+    def validate_plan(self, executable_actions: list):
+        """Check every action of a plan, before any of them is expanded."""
+        for executable_action in executable_actions:
+            self.validate(executable_action["action"], executable_action["param"])
+
+    def call(self, action_name: str, params) -> list:
+        """Robot commands (action dicts) of an action."""
+        return self.spec(action_name)(params)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_action_registry(robot_name: str) -> ActionRegistry:
+    """Registry of the robot, rebuilt only when its profile file changes."""
+    robot_profile = get_robot_profile(robot_name)
+    with _registries_lock:
+        registry = _registries.get(robot_name)
+        if registry is None or registry.robot_profile is not robot_profile:
+            registry = ActionRegistry(robot_profile)
+            _registries[robot_name] = registry
+        return registry
@@ -0,0 +1,145 @@
+"""Offline batch mode: every command of a file on every frame of a folder.
+
+The frames are split between worker processes, each one with its own ControlLoop
+(and models). All the commands of a frame run in the same worker, one after the
+other, so the perception (VLM + segmentation) runs once per frame and the next
+commands reuse it from the perception cache.
+
+The debug images of the perception go to <output>_images/<frame name>/, one
+folder per frame, so the workers never write the same files.
+
+One JSON line is written per (frame, command), in the order of the frames and
+commands, with the generated actions and the stage timings:
+    {"image": ..., "command": ..., "actions": [...], "objects_detected": ...,
+     "generated_action": ..., "perception_cached": ..., "total_time": ...,
+     "stages": {stage: seconds}, "critical_path": [...], "spans": {span: seconds},
+     "error": null}
+
+Usage: python main.py --batch_images pictures --batch_commands commands.txt --batch_output results.jsonl
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import cv2
+
+from control_loop import ControlLoop
+from src.perception import OUTPUT_PICTURES
+from src.tracing import get_tracer
+
+
+# Pipeline of the worker process
+_controller = None
+_images_folder = None  # Debug images of the perception, one subfolder per frame
+
+
+def read_commands(path: str) -> list:
+    """One command per line, empty lines and lines starting with # are skipped."""
+    with open(path, "r") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def list_frames(folder: str) -> list:
+    image_extensions = (".png", ".jpg", ".jpeg", ".bmp")
+    return sorted(
+        os.path.join(folder, name)
+        for name in os.listdir(folder)
+        if name.lower().endswith(image_extensions)
+        # Skip the images written by the perception when the folder is pictures/
+        and not any(fnmatch.fnmatch(name, pattern) for pattern in OUTPUT_PICTURES)
+    )
+
+
+def images_folder(batch_output: str) -> str:
+    return f"{os.path.splitext(batch_output)[0]}_images"
+
+
+def init_worker(args):
+    global _controller, _images_folder
+    _controller = ControlLoop(args)
+    _images_folder = images_folder(args.batch_output)
+
+
+def run_command(image, image_name: str, command: str) -> dict:
+    tracer = get_tracer()
+    # Spans of this command only (the process doesn't serve anything else)
+    tracer.reset()
+    record = {"image": image_name, "command": command, "error": None}
+    start = time.time()
+    try:
+        actions = _controller.run(image, command)
+        pipeline_run = _controller.last_pipeline_run
+        record.update(
+            actions=actions,
+            objects_detected=_controller.prompt_generator.environment_description_list,
+            generated_action=getattr(_controller, "last_action_type", "unknown"),
+            perception_cached=bool(pipeline_run.results.get("cache_lookup")),
+            stages={
+                name: pipeline_run.duration(name) for name in sorted(pipeline_run.end)
+            },
+            critical_path=pipeline_run.critical_path,
+        )
+    except Exception as e:
+        # One failing scene doesn't stop the batch
+        traceback.print_exc()
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["total_time"] = time.time() - start
+    record["spans"] = {
+        name: histogram.sum for name, histogram in sorted(tracer.histograms.items())
+    }
+    return record
+
+
+def run_frame(image_path: str, commands: list) -> list:
+    """Records of all the commands of a frame."""
+    image_name = os.path.basename(image_path)
+    _controller.prompt_generator.perception.set_output_folder(
+        os.path.join(_images_folder, image_name)
+    )
+    image = cv2.imread(image_path)
+    if image is None:
+        error = f"Could not read {image_path}"
+        return [
+            {"image": image_name, "command": command, "error": error}
+            for command in commands
+        ]
+    return [run_command(image, image_name, command) for command in commands]
+
+
+def run_batch(args):
+    frames = list_frames(args.batch_images)
+    commands = read_commands(args.batch_commands)
+    print(
+        f"Batch: {len(frames)} frames x {len(commands)} commands, "
+        f"{args.batch_workers} worker processes"
+    )
+    start = time.time()
+    completed = failed = 0
+    # spawn: CUDA can't be used in forked processes
+    with ProcessPoolExecutor(
+        max_workers=args.batch_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args,),
+    ) as executor, open(args.batch_output, "w") as output:
+        # Results come back in the order of the frames, as soon as they are ready
+        for records in executor.map(
+            run_frame, frames, [commands] * len(frames), chunksize=1
+        ):
+            for record in records:
+                output.write(json.dumps(record) + "\n")
+                completed += 1
+                failed += record["error"] is not None
+            output.flush()
+            print(f"Batch: {completed}/{len(frames) * len(commands)} commands done")
+    print(
+        f"Batch done in {time.time() - start:.1f}s: {completed} commands, "
+        f"{failed} failed, results in {args.batch_output}, "
+        f"images in {images_folder(args.batch_output)}"
+    )
@@ -0,0 +1,97 @@
+"""Loopback benchmark of the framed message protocol.
+
+Pushes thousands of messages of varying size (from a single action to plans
+of several hundred KB) through a TCP connection on localhost, reads them back
+with small and irregular recv sizes, checks that every message arrives intact
+and in order, and reports the throughput.
+
+Usage: python benchmarks/bench_framing.py [--messages 5000] [--encoding json]
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.framing import FrameDecoder, encode_message
+
+
+def make_message(index: int, rng: random.Random) -> list:
+    # Most plans are a few actions, some are very large
+    steps = rng.choice([1, 2, 6, 12, 50]) if rng.random() < 0.95 else 2000
+    return [
+        {
+            "pos_end_effector": [rng.uniform(-2, 5) for _ in range(6)],
+            "gripper": rng.choice([30, 220]),
+            "action_id": f"{index:08d}",
+            "step": step + 1,
+            "objects_detected": ["can", "glove", "screw"][: rng.randint(0, 3)],
+            "user_command": "pick the can and place it next to the glove",
+        }
+        for step in range(steps)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument(
+        "--encoding", type=str, default="json", choices=["json", "msgpack"]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    messages = [make_message(i, rng) for i in range(args.messages)]
+    frames = [encode_message(m, args.encoding) for m in messages]
+    total_bytes = sum(len(f) for f in frames)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def send_all():
+        conn, _ = server.accept()
+        for frame in frames:
+            conn.sendall(frame)
+        conn.close()
+
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    client = socket.create_connection(server.getsockname())
+
+    decoder = FrameDecoder()
+    received = []
+    read_sizes = [1, 7, 512, 4096, 65536]
+    start = time.perf_counter()
+    while True:
+        data = client.recv(rng.choice(read_sizes))
+        if not data:
+            break
+        received += decoder.feed(data)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    client.close()
+    server.close()
+
+    assert decoder.pending == 0, f"{decoder.pending} bytes of an incomplete frame left"
+    assert len(received) == len(messages), f"{len(received)}/{len(messages)} received"
+    for sent, got in zip(messages, received):
+        assert sent == got, f"message {sent[0]['action_id']} corrupted"
+
+    sizes = sorted(len(f) for f in frames)
+    print(f"{len(messages)} messages intact and in order ({args.encoding})")
+    print(
+        f"Frame size: min {sizes[0]} B, median {sizes[len(sizes) // 2]} B, max {sizes[-1]} B"
+    )
+    print(
+        f"Throughput: {len(messages) / elapsed:.0f} messages/s, {total_bytes / elapsed / 1e6:.1f} MB/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
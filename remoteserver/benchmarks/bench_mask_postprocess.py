@@ -0,0 +1,109 @@
+"""Microbenchmark of the segmentation maps post-processing.
+
+Compares `Perception.centroid_segmentation` (one call per object) with
+`batch_centroid_segmentation` (one call per scene) on the maps in `pictures/`:
+the CLIPSeg predictions (prediction_*.jpg) and every other picture converted to
+a grayscale 352x352 map. Checks that both give the same centroids and boxes.
+
+Usage: python benchmarks/bench_mask_postprocess.py [--objects 10] [--repeat 5]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+import skimage.transform as sit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.perception import Perception
+from src.mask_postprocess import batch_centroid_segmentation, resize_maps
+
+
+PICTURES_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pictures"
+)
+MAP_SIZE = (352, 352)  # CLIPSeg output size
+
+
+def load_maps():
+    maps = []
+    for path in sorted(glob.glob(os.path.join(PICTURES_FOLDER, "*"))):
+        image = cv.imread(path, cv.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        if image.shape != MAP_SIZE:
+            image = cv.resize(image, MAP_SIZE[::-1], interpolation=cv.INTER_AREA)
+        maps.append(image)
+    return maps
+
+
+def check_identical(perception, maps):
+    batched = batch_centroid_segmentation(maps)
+    for i, current_map in enumerate(maps):
+        centroid, bbox = perception.centroid_segmentation(current_map)
+        batch_centroid, batch_bbox = batched[i]
+        if centroid is None:
+            assert batch_centroid is None, f"map {i}: region found only by the batch"
+            continue
+        assert batch_centroid is not None, f"map {i}: region not found by the batch"
+        np.testing.assert_allclose(batch_centroid, centroid, rtol=0, atol=1e-9)
+        np.testing.assert_array_equal(batch_bbox, bbox)
+    print(f"Identical results on {len(maps)} maps")
+
+
+def bench(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--objects", type=int, default=10, help="Objects per scene")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Repetitions, best is kept"
+    )
+    args = parser.parse_args()
+
+    perception = Perception()
+    maps = load_maps()
+    check_identical(perception, maps)
+
+    scenes = [
+        maps[start : start + args.objects]
+        for start in range(0, len(maps) - args.objects + 1, args.objects)
+    ]
+    loop_time = bench(
+        lambda: [[perception.centroid_segmentation(m) for m in s] for s in scenes],
+        args.repeat,
+    )
+    batch_time = bench(
+        lambda: [batch_centroid_segmentation(s) for s in scenes], args.repeat
+    )
+    skimage_resize_time = bench(
+        lambda: [[sit.resize(m, (256, 256)) for m in s] for s in scenes], args.repeat
+    )
+    batch_resize_time = bench(
+        lambda: [resize_maps(np.asarray(s), (256, 256)) for s in scenes], args.repeat
+    )
+    print(f"{len(scenes)} scenes of {args.objects} objects")
+    print(f"centroid_segmentation loop: {1000 * loop_time / len(scenes):.2f} ms/scene")
+    print(
+        f"batch_centroid_segmentation: {1000 * batch_time / len(scenes):.2f} ms/scene"
+    )
+    print(
+        f"of which resize: {1000 * skimage_resize_time / len(scenes):.2f} ms/scene "
+        f"(skimage) -> {1000 * batch_resize_time / len(scenes):.2f} ms/scene (resize_maps)"
+    )
+    print(f"Speedup: {loop_time / batch_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Benchmark of the pipeline overhead, with the models replaced by the fakes.
+
+Runs `ControlLoop.run` on the pictures of `pictures/` with the deterministic
+stand-ins of `benchmarks/fakes.py`, so only the code around the models is timed:
+frame hashing, VLM preprocessing, mask post-processing, prompt building, action
+resolution, scheduling... Every command is cold (perception cache cleared).
+
+The time of each span (summed over a command, median over the commands) is
+compared to the stored baseline: the benchmark fails if a stage is slower than
+`baseline * (1 + tolerance) + slack`. The baseline depends on the machine, write
+it on the reference machine with --update_baseline.
+
+Usage: python benchmarks/bench_pipeline.py [--repeat 3] [--update_baseline]
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+
+import cv2 as cv
+import matplotlib
+
+# The perception plots are saved, not shown
+matplotlib.use("Agg")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import install_fakes
+from control_loop import ControlLoop
+from src.model_registry import ModelRegistry
+from src.perception import OUTPUT_PICTURES
+from src.perception_cache import PerceptionCache
+from src.tracing import get_tracer
+
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PICTURES_FOLDER = os.path.join(os.path.dirname(BENCHMARKS_FOLDER), "pictures")
+BASELINE_PATH = os.path.join(BENCHMARKS_FOLDER, "baseline_pipeline.json")
+
+# Spans timing the fakes themselves, not the pipeline
+MODEL_SPANS = {
+    "model.load",
+    "vlm.generate",
+    "segmentation.encode_image",
+    "segmentation.encode_texts",
+    "segmentation.decode",
+    "llm.generate",
+    "similarity.encode",
+}
+
+USER_COMMANDS = (
+    "Put the first object on the second one",
+    "Show me the objects one by one",
+    "Clean the table",
+)
+
+
+def load_frames(limit: int = 0):
+    outputs = set()
+    for pattern in OUTPUT_PICTURES:
+        outputs.update(glob.glob(os.path.join(PICTURES_FOLDER, pattern)))
+    frames = []
+    for path in sorted(glob.glob(os.path.join(PICTURES_FOLDER, "*"))):
+        if path in outputs:
+            continue
+        image = cv.imread(path)
+        if image is not None:
+            frames.append((os.path.basename(path), image))
+    return frames[:limit] if limit else frames
+
+
+def pipeline_args(pipeline_workers: int) -> argparse.Namespace:
+    # Defaults of main.py
+    return argparse.Namespace(
+        robot_name="UR10",
+        llm_name="microsoft/Phi-3-mini-4k-instruct",
+        llm_provider="HuggingFace",
+        llm_temperature=0.1,
+        llm_is_chat=False,
+        model_memory_budget=0.0,
+        pipeline_workers=pipeline_workers,
+        refine_segmentation=False,
+    )
+
+
+def build_controller(args, output_folder: str) -> ControlLoop:
+    model_registry = install_fakes(ModelRegistry(args.model_memory_budget), args)
+    controller = ControlLoop(
+        args, model_registry=model_registry, perception_cache=PerceptionCache()
+    )
+    # Keep the images saved by the perception out of pictures/
+    controller.prompt_generator.perception.set_output_folder(output_folder)
+    return controller
+
+
+def run_benchmark(controller, frames, repeat: int) -> dict:
+    """Return {span name: [time of the span in each command]}."""
+    tracer = get_tracer()
+    times = {}
+    for i in range(repeat):
+        for j, (name, frame) in enumerate(frames):
+            controller.perception_cache.clear()
+            tracer.reset()
+            controller.run(frame, USER_COMMANDS[(i + j) % len(USER_COMMANDS)])
+            for span, histogram in tracer.histograms.items():
+                if span not in MODEL_SPANS:
+                    times.setdefault(span, []).append(histogram.sum)
+    return times
+
+
+def compare(stages: dict, baseline: dict, tolerance: float, slack: float) -> list:
+    """Print the stage times against the baseline, return the regressed stages."""
+    regressions = []
+    print(f"{'stage':<32} {'median':>10} {'baseline':>10}")
+    for name, median in sorted(stages.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name:<32} {1000 * median:>8.2f}ms {'new':>10}")
+            continue
+        regressed = median > reference * (1 + tolerance) + slack
+        marker = "  REGRESSION" if regressed else ""
+        print(f"{name:<32} {1000 * median:>8.2f}ms {1000 * reference:>8.2f}ms{marker}")
+        if regressed:
+            regressions.append(name)
+    for name in sorted(set(baseline) - set(stages)):
+        print(f"{name:<32} {'missing':>10} {1000 * baseline[name]:>8.2f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Commands per picture, median is kept"
+    )
+    parser.add_argument(
+        "--images", type=int, default=0, help="Number of pictures, 0 for all"
+    )
+    parser.add_argument(
+        "--pipeline_workers", type=int, default=4, help="Stages run at the same time"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="Allowed slowdown of a stage, relative to the baseline",
+    )
+    parser.add_argument(
+        "--slack",
+        type=float,
+        default=0.002,
+        help="Allowed slowdown of a stage in seconds, on top of the tolerance",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the output of the pipeline"
+    )
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH)
+    parser.add_argument(
+        "--update_baseline",
+        action="store_true",
+        help="Store the measured times as the new baseline",
+    )
+    args = parser.parse_args()
+
+    frames = load_frames(args.images)
+    # The pipeline prints every step of every command
+    output = (
+        contextlib.nullcontext(sys.stdout) if args.verbose else open(os.devnull, "w")
+    )
+    with tempfile.TemporaryDirectory() as output_folder, output as stdout, contextlib.redirect_stdout(
+        stdout
+    ):
+        controller = build_controller(
+            pipeline_args(args.pipeline_workers), output_folder
+        )
+        # First command outside of the measure: fakes loaded, imports done
+        controller.run(frames[0][1], USER_COMMANDS[0])
+        times = run_benchmark(controller, frames, args.repeat)
+        # Wait for the images saved in the background before removing the folder
+        controller.scheduler.executor.shutdown()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+    stages = {name: statistics.median(values) for name, values in times.items()}
+    print(f"{len(frames)} pictures, {args.repeat} commands per picture")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(stages, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        compare(stages, {}, args.tolerance, args.slack)
+        print(f"No baseline at {args.baseline}, write one with --update_baseline")
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(stages, baseline, args.tolerance, args.slack)
+    if regressions:
+        print(f"Regressed stages: {', '.join(regressions)}")
+        return 1
+    print("No regression")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
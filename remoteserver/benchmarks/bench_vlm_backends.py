@@ -0,0 +1,69 @@
+"""Latency and memory footprint of the VLM on each inference backend.
+
+Loads the VLM once per backend and describes the 1280x720 frames of `pictures/`,
+to pick the mode of a machine, e.g. on a CPU-only box:
+    python benchmarks/bench_vlm_backends.py --backends cpu-bf16 cpu-int8 --cpu_threads 8
+
+Needs the VLM checkpoint (downloaded from the HuggingFace hub on first use).
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.bench_vlm_preprocess import load_frames
+from src.inference_backend import BACKENDS, InferenceBackend
+from src.model_registry import GB, estimate_model_bytes
+from src.perception import VLM_NAME
+from src.vlm import VLM
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=["cpu-bf16", "cpu-int8"],
+        choices=BACKENDS,
+    )
+    parser.add_argument("--cpu_threads", type=int, default=0)
+    parser.add_argument("--images", type=int, default=3, help="Number of frames")
+    parser.add_argument("--vlm_name", type=str, default=VLM_NAME)
+    args = parser.parse_args()
+
+    frames = load_frames()[: args.images]
+    results = []
+    for name in args.backends:
+        backend = InferenceBackend(name, args.cpu_threads)
+        start = time.time()
+        vlm = VLM(args.vlm_name, backend=backend)
+        load_time = time.time() - start
+        latencies = []
+        for frame in frames:
+            start = time.time()
+            vlm.run(frame)
+            latencies.append(time.time() - start)
+        results.append(
+            (
+                backend.name,
+                estimate_model_bytes(vlm.model) / GB,
+                load_time,
+                statistics.median(latencies),
+            )
+        )
+        del vlm
+        gc.collect()
+
+    print(f"{len(frames)} frames, VLM {args.vlm_name}")
+    print(f"{'backend':<12} {'memory':>8} {'load':>8} {'latency':>9}")
+    for name, memory, load_time, latency in results:
+        print(f"{name:<12} {memory:>6.2f}GB {load_time:>7.1f}s {latency:>8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
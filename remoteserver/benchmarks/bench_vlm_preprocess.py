@@ -0,0 +1,134 @@
+"""Microbenchmark of the VLM input preprocessing.
+
+Compares `VLM.load_image` (PIL resize, one crop and one ToTensor + Normalize per
+tile) with `VLMPreprocessor` (one tensor resize, tiles as views, one fused
+normalization) on the 1280x720 frames of `pictures/`, and checks that both give
+the same pixel values (within two levels out of 255, on less than 1% of the values).
+
+Usage: python benchmarks/bench_vlm_preprocess.py [--repeat 5] [--device cuda]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2 as cv
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.vlm import VLM
+from src.vlm_preprocess import VLMPreprocessor
+
+
+PICTURES_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pictures"
+)
+FRAME_SIZE = (720, 1280)  # camera frames (height, width)
+
+
+def load_frames():
+    frames = []
+    for path in sorted(glob.glob(os.path.join(PICTURES_FOLDER, "*"))):
+        image = cv.imread(path)
+        if image is None or image.shape[:2] != FRAME_SIZE:
+            continue
+        frames.append(Image.fromarray(cv.cvtColor(image, cv.COLOR_BGR2RGB)))
+    return frames
+
+
+def reference_vlm(max_num):
+    # Only the preprocessing of the VLM is used, the model is not loaded
+    vlm = VLM.__new__(VLM)
+    vlm.IMAGENET_MEAN = (0.485, 0.456, 0.406)
+    vlm.IMAGENET_STD = (0.229, 0.224, 0.225)
+    vlm.image = None
+    vlm.image_size = 448
+    vlm.max_num = max_num
+    return vlm
+
+
+def check_close(vlm, preprocessor, frames, device):
+    max_levels = 0.0
+    different = 0
+    total = 0
+    std = torch.tensor(vlm.IMAGENET_STD).view(1, 3, 1, 1)
+    for frame in frames:
+        reference = vlm.load_image(frame, max_num=vlm.max_num)
+        pixel_values = preprocessor(frame, device=device).cpu()
+        assert pixel_values.shape == reference.shape, (
+            pixel_values.shape,
+            reference.shape,
+        )
+        # Difference in uint8 levels (normalized values * std * 255)
+        levels = (pixel_values - reference).abs() * std * 255
+        max_levels = max(max_levels, levels.max().item())
+        different += (levels > 0.5).sum().item()
+        total += levels.numel()
+    assert max_levels <= 2.01, f"difference of {max_levels:.2f} levels"
+    assert (
+        different < 0.01 * total
+    ), f"{100 * different / total:.2f}% of different values"
+    print(
+        f"Same pixel values on {len(frames)} frames, {tuple(reference.shape)} per frame "
+        f"({100 * different / total:.3f}% differ, by {max_levels:.0f} level at most)"
+    )
+
+
+def bench(function, repeat, device):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Repetitions, best is kept"
+    )
+    parser.add_argument("--max_num", type=int, default=6, help="Max number of tiles")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device of the fast preprocessing (the reference runs on the CPU)",
+    )
+    args = parser.parse_args()
+
+    frames = load_frames()
+    vlm = reference_vlm(args.max_num)
+    preprocessor = VLMPreprocessor(max_num=args.max_num)
+    check_close(vlm, preprocessor, frames, args.device)
+
+    # The VLM gets float16 pixel values on the GPU
+    dtype = torch.float16 if args.device == "cuda" else torch.float32
+    reference_time = bench(
+        lambda: [
+            vlm.load_image(frame, max_num=args.max_num).to(args.device, dtype)
+            for frame in frames
+        ],
+        args.repeat,
+        args.device,
+    )
+    fast_time = bench(
+        lambda: [preprocessor(frame, args.device, dtype) for frame in frames],
+        args.repeat,
+        args.device,
+    )
+    print(f"{len(frames)} frames of {FRAME_SIZE[1]}x{FRAME_SIZE[0]}")
+    print(f"VLM.load_image: {1000 * reference_time / len(frames):.2f} ms/frame")
+    print(
+        f"VLMPreprocessor ({args.device}): {1000 * fast_time / len(frames):.2f} ms/frame"
+    )
+    print(f"Speedup: {reference_time / fast_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
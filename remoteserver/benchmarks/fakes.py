@@ -0,0 +1,179 @@
+"""Deterministic CPU stand-ins for the models of the pipeline.
+
+Same interfaces as `VLM`, `SegmentationEngine`, `LLM` and `SentenceTransformer`,
+without any checkpoint, so the rest of the pipeline (preprocessing, mask
+post-processing, prompt building, action resolution, scheduling) can be run and
+timed anywhere:
+- FakeVLM: real `VLMPreprocessor`, then a canned object list picked from the frame,
+- FakeSegmentationEngine: one Gaussian blob per object, placed from its name,
+- FakeLLM: scripted actions on the objects of the prompt,
+- FakeSentenceTransformer: normalized hashed character trigrams.
+
+The same input always gives the same output. `install_fakes` registers them in a
+model registry under the names of the real models, before the pipeline is built.
+"""
+
+import os
+import re
+import sys
+import zlib
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from control_loop import llm_registry_key
+from src.action import SIMILARITY_MODEL_PATH
+from src.perception import SEG_MODEL_NAME, VLM_NAME
+from src.tracing import trace
+from src.vlm_preprocess import VLMPreprocessor
+from tools.read_json import read_llm_prompt_json
+
+
+# Scenes returned by the fake VLM, one per frame (no "-", removed by parse_vlm_output)
+OBJECT_LISTS = (
+    ["red block", "blue block", "green block", "table"],
+    ["soda can", "glove", "trash bin"],
+    ["screwdriver", "metal part", "wrench", "tray", "table"],
+    ["cup", "bowl", "spoon", "fork"],
+    ["figurine", "cube", "box", "yellow block", "pen", "table"],
+)
+MAP_SIZE = 352  # CLIPSeg output size
+
+
+def stable_hash(data) -> int:
+    """Same value in every process, unlike hash()."""
+    if isinstance(data, str):
+        data = data.encode()
+    return zlib.crc32(data)
+
+
+class FakeVLM:
+    def __init__(self, vlm_name: str = VLM_NAME):
+        self.preprocessor = VLMPreprocessor()
+        self.prompt = "List the objects, with only one object per line"
+
+    def preprocess(self, image):
+        with trace("vlm.preprocess"):
+            return self.preprocessor(image)
+
+    def run(self, image=None):
+        # The generation is canned, the preprocessing is the real one
+        self.preprocess(image)
+        with trace("vlm.generate"):
+            objects = OBJECT_LISTS[stable_hash(np.asarray(image)) % len(OBJECT_LISTS)]
+            return "\n".join(f"- {item}" for item in objects)
+
+
+class FakeSegmentationEngine:
+    def __init__(self, map_size: int = MAP_SIZE, blob_sigma: float = 0.06):
+        """blob_sigma: standard deviation of the blobs, as a fraction of the map size."""
+        self.map_size = map_size
+        self.blob_sigma = blob_sigma
+        grid = torch.linspace(0, 1, map_size)
+        self.ys, self.xs = torch.meshgrid(grid, grid, indexing="ij")
+
+    def encode_image(self, image) -> list:
+        # One activation per image, like the batched encoder
+        batch_size = len(image) if isinstance(image, list) else 1
+        with trace("segmentation.encode_image"):
+            return [torch.zeros(batch_size, 1, 1)]
+
+    def encode_texts(self, texts: list) -> torch.Tensor:
+        """Blob center of each text, in [0.1, 0.9] x [0.1, 0.9] of the map."""
+        with trace("segmentation.encode_texts", texts=len(texts)):
+            centers = [
+                (0.1 + 0.8 * (h % 1000) / 999, 0.1 + 0.8 * (h // 1000 % 1000) / 999)
+                for h in map(stable_hash, texts)
+            ]
+            return torch.tensor(centers, dtype=torch.float32)
+
+    def decode(self, activations: list, text_embeddings: torch.Tensor) -> torch.Tensor:
+        with trace("segmentation.decode", texts=len(text_embeddings)):
+            x = text_embeddings[:, 0].view(-1, 1, 1)
+            y = text_embeddings[:, 1].view(-1, 1, 1)
+            distance = (self.xs - x) ** 2 + (self.ys - y) ** 2
+            return 8 * torch.exp(-distance / (2 * self.blob_sigma**2)) - 4
+
+    def run(self, image, texts: list, activations=None) -> torch.Tensor:
+        if not texts:
+            return torch.empty(0)
+        if activations is None:
+            activations = self.encode_image(image)
+        return self.decode(activations, self.encode_texts(texts))
+
+    def run_crops(self, crops: list, texts: list) -> torch.Tensor:
+        if not crops:
+            return torch.empty(0)
+        return self.decode(self.encode_image(list(crops)), self.encode_texts(texts))
+
+
+class FakeLLM:
+    # Plans, filled with the objects of the scene
+    SCRIPTS = (
+        ["pick_and_place: [{0}, {1}]"],
+        ["move_to: [{0}]", "open_gripper", "move_to: [{1}]", "close_gripper"],
+        ["pick_and_place: [{0}, {2}]", "pick_and_place: [{1}, {2}]"],
+        ["move_to: [{1}]"],
+    )
+
+    def __init__(self, model_name: str = "default", chunk_size: int = 4):
+        """chunk_size: characters per streamed chunk, like tokens."""
+        self.model_name = model_name
+        self.prompt_system = read_llm_prompt_json(model_name)
+        self.chunk_size = chunk_size
+
+    def set_static_prefix(self, content_prefix: str):
+        pass
+
+    def response(self, prompt: str) -> str:
+        match = re.search(r"Environment Description:\n(.*)", prompt)
+        objects = [item.strip() for item in match.group(1).split(",")] if match else []
+        objects = [item for item in objects if item] or ["table"]
+        script = self.SCRIPTS[stable_hash(prompt) % len(self.SCRIPTS)]
+        # Scripts use up to 3 objects, repeat the last ones of small scenes
+        objects += [objects[-1]] * 3
+        return "\n".join(script).format(*objects) + "\n"
+
+    def run(self, prompt: str, grammar=None):
+        # The scripted plans only use the names of the scene, like a constrained generation
+        with trace("llm.generate", model=self.model_name):
+            return self.response(prompt)
+
+    def stream(self, prompt: str, grammar=None):
+        response = self.response(prompt)
+        with trace("llm.generate", nest=False, model=self.model_name, stream=True):
+            for i in range(0, len(response), self.chunk_size):
+                yield response[i : i + self.chunk_size]
+
+
+class FakeSentenceTransformer:
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def encode(self, texts, convert_to_tensor: bool = False):
+        """Bag of hashed character trigrams: similar names get similar embeddings."""
+        single = isinstance(texts, str)
+        texts = [texts] if single else texts
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            text = f"  {text.lower()} "
+            for j in range(len(text) - 2):
+                embeddings[i, stable_hash(text[j : j + 3]) % self.dimension] += 1.0
+        embeddings /= np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        embeddings = embeddings[0] if single else embeddings
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+
+def install_fakes(model_registry, args):
+    """
+    Register the fakes under the names of the real models. Must be called before the
+    ControlLoop is built, its registrations are then no-ops.
+    """
+    model_registry.register(VLM_NAME, FakeVLM)
+    model_registry.register(SEG_MODEL_NAME, FakeSegmentationEngine)
+    model_registry.register(llm_registry_key(args), lambda: FakeLLM(args.llm_name))
+    model_registry.register(SIMILARITY_MODEL_PATH, FakeSentenceTransformer)
+    return model_registry
@@ -1,15 +1,29 @@
 from src.llm import LLM
 from src.prompt_generator import PromptGenerator
 from src.action import ActionManager
+from src.model_registry import get_model_registry
+from src.perception_cache import get_perception_cache
+from src.pipeline_scheduler import PipelineScheduler, Stage
+from src.plan_grammar import PlanGrammar
+from src.motion_compiler import MotionCompiler
+from src.tracing import get_tracer, trace
 from tools.read_json import read_robot_json
 
 import argparse
 import time
-import torch
+
+
+def llm_registry_key(args: argparse.Namespace) -> str:
+    """Name of the LLM in the model registry, one entry per LLM configuration."""
+    return (
+        f"{args.llm_provider}:{args.llm_name}:{args.llm_temperature}:{args.llm_is_chat}"
+    )
 
 
 class ControlLoop:
-    def __init__(self, args: argparse.Namespace):
+    def __init__(
+        self, args: argparse.Namespace, model_registry=None, perception_cache=None
+    ):
 
         # Initialize the robot information
         self.robot_name = args.robot_name
@@ -20,42 +34,179 @@ class ControlLoop:
         self.llm_name = args.llm_name
         self.llm_provider = args.llm_provider
         self.llm_is_chat = args.llm_is_chat
+        # Restrict the LLM output to the actions of the robot and the objects of the scene
+        self.llm_constrained = getattr(args, "llm_constrained", False)
+        self.streaming_error = streaming_error(args)
         self.llm = None
 
+        # Models are shared between every control loop of the process
+        self.model_registry = (
+            model_registry
+            if model_registry is not None
+            else get_model_registry(getattr(args, "model_memory_budget", None))
+        )
+        self.llm_key = llm_registry_key(args)
+        self.model_registry.register(
+            self.llm_key,
+            lambda: LLM(
+                model_name=self.llm_name,
+                temperature=self.llm_temperature,
+                provider=self.llm_provider,
+                is_chat=self.llm_is_chat,
+            ),
+            size_hint=2.5 if self.llm_provider == "HuggingFace" else 0.0,
+        )
+
+        # Perception results are shared too, keyed by frame
+        self.perception_cache = (
+            perception_cache
+            if perception_cache is not None
+            else get_perception_cache(
+                getattr(args, "perception_cache_size", None),
+                getattr(args, "perception_cache_dir", None),
+            )
+        )
+
         # Initialize the prompt generator
-        self.prompt_generator = PromptGenerator(robot_info=self.robot_info)
+        self.prompt_generator = PromptGenerator(
+            robot_info=self.robot_info,
+            model_registry=self.model_registry,
+            perception_cache=self.perception_cache,
+        )
+        # Only the HuggingFace LLM caches the start of the prompt (see src/llm_prefix_cache.py),
+        # the other providers keep the order of their prompt templates
+        self.prompt_generator.robot_prompt_first = self.llm_provider == "HuggingFace"
+        self.prompt_generator.perception.refine_segmentation = getattr(
+            args, "refine_segmentation", False
+        )
+        # Read when the models are loaded, on their first use
+        self.prompt_generator.perception.vlm_backend = getattr(
+            args, "vlm_backend", "auto"
+        )
+        self.prompt_generator.perception.seg_backend = getattr(
+            args, "seg_backend", "cpu-fp32"
+        )
+        self.prompt_generator.perception.cpu_threads = getattr(args, "cpu_threads", 0)
+        self.prompt_generator.perception.incremental = getattr(
+            args, "incremental_perception", False
+        )
 
         # Initialize action
-        self.action = ActionManager(robot_info=self.robot_info)
+        self.action = ActionManager(
+            robot_info=self.robot_info, model_registry=self.model_registry
+        )
+
+        # Blended paths and no redundant waypoints (see src/motion_compiler.py),
+        # None to send the waypoints as the actions expand them
+        self.motion_compiler = (
+            MotionCompiler(blend_radius=getattr(args, "blend_radius", 0.05))
+            if getattr(args, "compile_motion", False)
+            else None
+        )
+        self.last_motion_report = None
+
+        # Runs the independent stages of a command at the same time
+        self.scheduler = PipelineScheduler(getattr(args, "pipeline_workers", 4))
+        self.last_pipeline_run = None
+
+        # Spans of every stage, aggregated into latency histograms
+        self.tracer = get_tracer(getattr(args, "trace_file", None))
+        self.metrics_file = getattr(args, "metrics_file", None)
         print("Control loop initialized")
 
     def run(self, image, user_input):
+        with trace("command"):
+            return self._run(image, user_input)
+
+    def _run(self, image, user_input):
         start = time.time()
         print("Generating actions...")
-        prompt = self.prompt_generator.run(user_input, image)
-
+        perception = self.prompt_generator.perception
+        seg_model_name = perception.seg_model_name
         # Store the original user command
         self.last_user_command = user_input
+        self.prompt_generator.set_user_command(user_input)
 
-        print("Starting LLM")
-        self.llm = LLM(
-            model_name=self.llm_name,
-            temperature=self.llm_temperature,
-            provider=self.llm_provider,
-            is_chat=self.llm_is_chat,
-        )
-        print(f"Generated Prompt:\n{self.llm.prompt_system.format(content=prompt)}")
-        action_text = self.llm.run(prompt)
+        def cache_lookup():
+            perception.set_image(image)
+            return perception.load_cached() or perception.track()
 
-        self.llm = None
-        torch.cuda.empty_cache()
-        print(f"LLM Response:\n{action_text}")
+        def vlm(cache_lookup):
+            if not cache_lookup:
+                perception.describe()
 
-        action_dict_list = self.action.run(
-            action_text,
-            self.prompt_generator.environment_description_list,
-            self.prompt_generator.perception.environment_pos,
-        )
+        def encode_image(cache_lookup, **_):
+            # The vision encoder of the segmentation doesn't need the VLM output
+            if not cache_lookup:
+                return perception.encode_image()
+
+        def segmentation(cache_lookup, vlm, encode_image):
+            if not cache_lookup:
+                perception.locate(encode_image)
+
+        def llm(prompt, **_):
+            print("Starting LLM")
+            with self.model_registry.use(self.llm_key) as llm:
+                llm.set_static_prefix(self.prompt_generator.static_prompt)
+                print(f"Generated Prompt:\n{llm.prompt_system.format(content=prompt)}")
+                return llm.run(prompt, grammar=self.plan_grammar())
+
+        def embed_environment(prompt):
+            # Object names are embedded while the LLM generates
+            return self.action.embed_environment(
+                self.prompt_generator.environment_description_list
+            )
+
+        def actions(llm, **_):
+            print(f"LLM Response:\n{llm}")
+            action_dict_list = self.action.run(
+                llm,
+                self.prompt_generator.environment_description_list,
+                perception.environment_pos,
+            )
+            return self.compile_motion(action_dict_list)[0]
+
+        def load_llm():
+            # The static part of the prompt is prefilled while the perception runs
+            llm = self.model_registry.get(self.llm_key)
+            llm.set_static_prefix(self.prompt_generator.static_prompt)
+            return llm
+
+        # Load the models while the VLM runs, when they all fit in memory
+        prefetch = not self.model_registry.memory_budget
+        load_deps = lambda name: [name] if prefetch else []
+        stages = [
+            Stage("cache_lookup", cache_lookup),
+            Stage("vlm", vlm, deps=["cache_lookup"]),
+            Stage(
+                "encode_image",
+                encode_image,
+                deps=["cache_lookup", *load_deps("load_segmentation")],
+            ),
+            Stage(
+                "segmentation", segmentation, ["cache_lookup", "vlm", "encode_image"]
+            ),
+            Stage(
+                "prompt",
+                lambda **_: self.prompt_generator.build_prompt(),
+                ["segmentation"],
+            ),
+            Stage("llm", llm, deps=["prompt", *load_deps("load_llm")]),
+            Stage("embed_environment", embed_environment, deps=["prompt"]),
+            Stage("actions", actions, deps=["llm", "embed_environment"]),
+        ]
+        if prefetch:
+            stages += [
+                Stage(
+                    "load_segmentation", lambda: self.model_registry.get(seg_model_name)
+                ),
+                Stage("load_llm", load_llm),
+            ]
+
+        pipeline_run = self.scheduler.run(stages)
+        self.last_pipeline_run = pipeline_run
+        action_text = pipeline_run.results["llm"]
+        action_dict_list = pipeline_run.results["actions"]
 
         # Try extracting action type (like "pick_and_place")
         if isinstance(action_dict_list, list) and len(action_dict_list) > 0:
@@ -66,5 +217,124 @@ class ControlLoop:
         print(f"Generated actions:\n{action_dict_list}")
         end = time.time()
         print(f"Control Loop - Time taken: {end - start}")
+        print(pipeline_run.report())
+        print(self.tracer.report())
+        print(self.model_registry.report())
         return action_dict_list
 
+    def run_stream(self, image, user_input):
+        """
+        Streaming version of run: yields the robot commands of each action as soon as the
+        LLM has generated its line, while the next actions are still being generated.
+        """
+        with trace("command", nest=False, stream=True):
+            yield from self._run_stream(image, user_input)
+
+    def _run_stream(self, image, user_input):
+        if self.streaming_error:
+            raise ValueError(self.streaming_error)
+        start = time.time()
+        print("Generating actions (streaming)...")
+        prompt = self.prompt_generator.run(user_input, image)
+
+        # Store the original user command
+        self.last_user_command = user_input
+        self.last_action_type = "unknown"
+        action_text = ""
+
+        def llm_stream(llm):
+            nonlocal action_text
+            for chunk in llm.stream(prompt, grammar=self.plan_grammar()):
+                action_text += chunk
+                yield chunk
+
+        print("Starting LLM")
+        # The robot state at the end of an action is the start of the next one
+        motion_state = None
+        with self.model_registry.use(self.llm_key) as llm:
+            self.llm = llm
+            llm.set_static_prefix(self.prompt_generator.static_prompt)
+            print(f"Generated Prompt:\n{self.llm.prompt_system.format(content=prompt)}")
+            for action_dict_list in self.action.run_stream(
+                llm_stream(llm),
+                self.prompt_generator.environment_description_list,
+                self.prompt_generator.perception.environment_pos,
+            ):
+                action_dict_list, motion_state = self.compile_motion(
+                    action_dict_list, motion_state
+                )
+                if not action_dict_list:
+                    continue
+                self.last_action_type = self.action.extract_last_action_type(
+                    action_text
+                )
+                print(
+                    f"Generated actions after {time.time() - start:.2f}s:\n{action_dict_list}"
+                )
+                yield action_dict_list
+
+        self.llm = None
+        print(f"LLM Response:\n{action_text}")
+        end = time.time()
+        print(f"Control Loop - Time taken: {end - start}")
+        print(self.tracer.report())
+        print(self.model_registry.report())
+
+    def compile_motion(self, action_dict_list, start=None):
+        """
+        Compiled robot commands and robot state at their end, or the commands unchanged
+        when the motion isn't compiled. start: robot state before them, unknown when None.
+        """
+        if self.motion_compiler is None or not isinstance(action_dict_list, list):
+            return action_dict_list, start
+        with trace("motion.compile", waypoints=len(action_dict_list)):
+            compiled, report, end = self.motion_compiler.compile(
+                action_dict_list, start
+            )
+        print(report)
+        self.last_motion_report = report
+        return compiled, end
+
+    def plan_grammar(self):
+        """Valid plans of the current scene, None when the generation isn't constrained."""
+        if not self.llm_constrained:
+            return None
+        return PlanGrammar(
+            self.robot_info["actions"],
+            list(self.prompt_generator.environment_description_list),
+        )
+
+    def export_metrics(self):
+        """Write the latency histograms in the Prometheus text format, if a file is set."""
+        if self.metrics_file:
+            try:
+                self.tracer.write_prometheus(self.metrics_file)
+            except OSError as e:
+                print(f"Could not write the metrics to {self.metrics_file}: {e}")
+
+
+def streaming_error(args):
+    """
+    Why the actions of a plan can't be streamed with these arguments, None when they can.
+    Streamed actions are sent before the rest of the plan is generated, so only the
+    constrained decoding, which can't write an invalid action, makes this safe.
+    """
+    if (
+        not getattr(args, "llm_constrained", False)
+        or args.llm_provider != "HuggingFace"
+    ):
+        return "streaming the actions requires --llm_constrained (HuggingFace provider)"
+    return None
+
+
+def annotate_actions(action_dict_list, controller, user_input, action_id, first_step=1):
+    """Attach the metadata sent to the client to each action of a command."""
+    for step, action in enumerate(action_dict_list, start=first_step):
+        action["action_id"] = action_id
+        action["step"] = step
+        action["objects_detected"] = (
+            controller.prompt_generator.environment_description_list
+        )
+        action["user_command"] = user_input.strip()
+        action["generated_action"] = getattr(controller, "last_action_type", "unknown")
+    return action_dict_list
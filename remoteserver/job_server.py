@@ -0,0 +1,371 @@
+"""Asyncio request server: robot commands are submitted as jobs over the socket.
+
+Any number of operator stations can connect. Each command is a job with an ID,
+put in a bounded queue and run by a fixed number of workers. The workers own the
+pipeline instances (ControlLoop), which share the resident models, so models are
+never duplicated per connection and nothing blocks on a terminal. Results are
+sent back to the submitting connection, tagged with the job ID.
+
+The main PC client (urscripts/remote_send_sim.py) registers as a robot: the
+actions of every job are forwarded to the robot connections as plain lists of
+action dicts, like the simulation server sends them (each chunk of a streaming
+job as soon as it is generated, the whole list otherwise).
+
+Messages are framed with tools.framing. Requests:
+    {"type": "command", "command": "pick the can", "job_id": optional, "image": optional, "stream": optional}
+    {"type": "status"}
+    {"type": "metrics"}
+    {"type": "register_robot"}  (no response, the connection then receives the actions)
+Responses:
+    {"type": "accepted", "job_id": ..., "queue_position": ...}
+    {"type": "rejected", "job_id": ..., "reason": ...}  (queue full, or streaming without --llm_constrained)
+    {"type": "actions", "job_id": ..., "actions": [...]}  (streaming jobs, one per action)
+    {"type": "result", "job_id": ..., "actions": [...], "queue_time": ..., "run_time": ...}
+    {"type": "error", "job_id": ..., "error": ...}
+    {"type": "status", "queued": ..., "running": ..., "workers": ..., "completed": ..., "failed": ..., "robots": ...}
+    {"type": "metrics", "stages": {stage: {"count", "p50", "p95", "p99", ...}}, "prometheus": "..."}
+
+Operator station: python job_server.py --host <server ip> --port 8000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from uuid import uuid4
+
+import cv2
+
+from control_loop import ControlLoop, annotate_actions, streaming_error
+from src.tracing import get_tracer, trace
+from tools.framing import FrameDecoder, ProtocolError, encode_message, send_message
+
+
+class Job:
+    def __init__(
+        self, job_id: str, command: str, image_file: str, stream: bool, writer
+    ):
+        self.job_id = job_id
+        self.command = command
+        self.image_file = image_file
+        self.stream = stream
+        self.writer = writer
+        self.submitted = time.time()
+
+
+class JobServer:
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        workers: int = 1,
+        queue_size: int = 16,
+        allowed_clients=None,
+        model_registry=None,
+    ):
+        """
+        workers: number of jobs run at the same time, each worker has its own ControlLoop.
+        queue_size: maximum number of waiting jobs, new jobs are rejected when it is full.
+        allowed_clients: list of allowed client IPs, None to allow every client.
+        """
+        self.args = args
+        self.num_workers = workers
+        self.queue_size = queue_size
+        self.allowed_clients = allowed_clients
+        self.model_registry = model_registry
+        self.pictures_folder_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "pictures"
+        )
+        self.images = {}  # {file name: image}, loaded once
+        self.robots = set()  # Writers of the robot connections
+        self.queue = None
+        self.loop = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 8000):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+
+        # The pipelines are created once, in the worker threads' executor
+        controllers = [
+            await self.loop.run_in_executor(
+                None, lambda: ControlLoop(self.args, model_registry=self.model_registry)
+            )
+            for _ in range(self.num_workers)
+        ]
+        workers = [
+            asyncio.create_task(self.worker(controller)) for controller in controllers
+        ]
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(
+            f"Job server listening on {host}:{port} "
+            f"({self.num_workers} workers, queue of {self.queue_size} jobs)"
+        )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if self.allowed_clients is not None and addr[0] not in self.allowed_clients:
+            print(f"Rejected connection from {addr[0]}.")
+            writer.close()
+            return
+        print(f"Accepted connection from {addr}")
+
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                messages = decoder.feed(data)
+                for error in decoder.errors:
+                    print(f"Invalid message from {addr}: {error}")
+                for message in messages:
+                    self.handle_message(message, writer)
+                if decoder.error is not None:
+                    # Out of sync with the client, nothing more can be decoded
+                    print(f"Closing the connection with {addr}")
+                    break
+        except ConnectionError as e:
+            print(f"Connection error with {addr}: {e}")
+        finally:
+            self.robots.discard(writer)
+            writer.close()
+            print(f"Connection with {addr} closed.")
+
+    def handle_message(self, message, writer):
+        if not isinstance(message, dict):
+            self.write(writer, {"type": "error", "error": "Invalid request"})
+            return
+        if message.get("type") == "register_robot":
+            self.robots.add(writer)
+            print(f"Robot registered, {len(self.robots)} connected")
+            return
+        if message.get("type") == "status":
+            self.write(writer, self.status())
+            return
+        if message.get("type") == "metrics":
+            tracer = get_tracer()
+            self.write(
+                writer,
+                {
+                    "type": "metrics",
+                    "stages": tracer.summary(),
+                    "prometheus": tracer.prometheus(),
+                },
+            )
+            return
+        if message.get("type") != "command" or not message.get("command"):
+            self.write(writer, {"type": "error", "error": "Invalid request"})
+            return
+
+        job = Job(
+            job_id=str(message.get("job_id") or str(uuid4())[:8]),
+            command=str(message["command"]),
+            image_file=message.get("image") or self.args.simulation_image_file,
+            stream=bool(message.get("stream", False)),
+            writer=writer,
+        )
+        if job.stream and streaming_error(self.args):
+            self.write(
+                writer,
+                {
+                    "type": "rejected",
+                    "job_id": job.job_id,
+                    "reason": streaming_error(self.args),
+                },
+            )
+            return
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.write(
+                writer,
+                {"type": "rejected", "job_id": job.job_id, "reason": "queue full"},
+            )
+            return
+        self.write(
+            writer,
+            {
+                "type": "accepted",
+                "job_id": job.job_id,
+                "queue_position": self.queue.qsize(),
+            },
+        )
+
+    async def worker(self, controller: ControlLoop):
+        while True:
+            job = await self.queue.get()
+            self.running += 1
+            try:
+                await self.loop.run_in_executor(None, self.run_job, controller, job)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Job {job.job_id} failed: {e}")
+                self.write(
+                    job.writer, {"type": "error", "job_id": job.job_id, "error": str(e)}
+                )
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+
+    def run_job(self, controller: ControlLoop, job: Job):
+        """Runs in an executor thread."""
+        start = time.time()
+        image = self.load_image(job.image_file)
+        print(f"Running job {job.job_id}: {job.command}")
+
+        action_dict_list = []
+        if job.stream:
+            for action_dict in controller.run_stream(image, job.command):
+                annotate_actions(
+                    action_dict,
+                    controller,
+                    job.command,
+                    job.job_id,
+                    first_step=len(action_dict_list) + 1,
+                )
+                action_dict_list += action_dict
+                self.write_threadsafe(
+                    job.writer,
+                    {"type": "actions", "job_id": job.job_id, "actions": action_dict},
+                )
+                self.loop.call_soon_threadsafe(self.send_to_robots, action_dict)
+        else:
+            action_dict_list = controller.run(image, job.command) or []
+            annotate_actions(action_dict_list, controller, job.command, job.job_id)
+            if action_dict_list:
+                self.loop.call_soon_threadsafe(self.send_to_robots, action_dict_list)
+
+        self.write_threadsafe(
+            job.writer,
+            {
+                "type": "result",
+                "job_id": job.job_id,
+                "actions": action_dict_list,
+                "queue_time": start - job.submitted,
+                "run_time": time.time() - start,
+            },
+        )
+        controller.export_metrics()
+
+    def load_image(self, image_file: str):
+        if image_file not in self.images:
+            image_path = os.path.join(
+                self.pictures_folder_path, os.path.basename(image_file)
+            )
+            image = cv2.imread(image_path)
+            if image is None:
+                raise FileNotFoundError(f"Image {image_file} not found")
+            self.images[image_file] = image
+        return self.images[image_file]
+
+    def status(self) -> dict:
+        return {
+            "type": "status",
+            "queued": self.queue.qsize(),
+            "running": self.running,
+            "workers": self.num_workers,
+            "completed": self.completed,
+            "failed": self.failed,
+            "robots": len(self.robots),
+        }
+
+    def write(self, writer, message: dict):
+        if writer.is_closing():
+            return
+        with trace("socket.send", message=message.get("type")):
+            writer.write(encode_message(message, self.args.message_encoding))
+
+    def send_to_robots(self, action_dict_list: list):
+        """Actions of a job, to every registered robot."""
+        if not self.robots:
+            return
+        frame = encode_message(action_dict_list, self.args.message_encoding)
+        with trace("socket.send", message="robot", actions=len(action_dict_list)):
+            for writer in list(self.robots):
+                if not writer.is_closing():
+                    writer.write(frame)
+
+    def write_threadsafe(self, writer, message: dict):
+        self.loop.call_soon_threadsafe(self.write, writer, message)
+
+
+def start_job_server(args, model_registry=None, allowed_clients=None):
+    job_server = JobServer(
+        args,
+        workers=args.job_workers,
+        queue_size=args.job_queue_size,
+        allowed_clients=allowed_clients,
+        model_registry=model_registry,
+    )
+    try:
+        asyncio.run(job_server.serve(port=args.job_port))
+    except KeyboardInterrupt:
+        print("\nJob server is shutting down...")
+
+
+def operator_client(host: str, port: int, image: str = None, stream: bool = False):
+    """Terminal of an operator station: sends each command as a job and prints the results."""
+    import socket
+    import threading
+    from tools.framing import recv_messages
+
+    conn = socket.create_connection((host, port))
+    print(f"Connected to job server at {host}:{port}")
+
+    def print_responses():
+        try:
+            for message in recv_messages(conn):
+                print(f"\n{message}")
+        except ProtocolError as e:
+            print(f"\nConnection to the job server closed: {e}")
+
+    threading.Thread(target=print_responses, daemon=True).start()
+    try:
+        while True:
+            command = input(
+                "User input ('stop' to quit, 'status', 'metrics'): "
+            ).strip()
+            if command.lower() == "stop":
+                break
+            if command.lower() in ("status", "metrics"):
+                send_message(conn, {"type": command.lower()})
+            elif command:
+                send_message(
+                    conn,
+                    {
+                        "type": "command",
+                        "command": command,
+                        "image": image,
+                        "stream": stream,
+                    },
+                )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Operator station of the job server")
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="Job server address"
+    )
+    parser.add_argument("--port", type=int, default=8000, help="Job server port")
+    parser.add_argument(
+        "--image", type=str, default=None, help="Image file of the pictures folder"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Receive the actions as they are generated",
+    )
+    args = parser.parse_args()
+    operator_client(args.host, args.port, args.image, args.stream)
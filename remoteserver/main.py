@@ -8,11 +8,19 @@ import socket
 import cv2
 import time
 import os
-from control_loop import ControlLoop
+from control_loop import ControlLoop, annotate_actions, streaming_error
+from src.model_registry import get_model_registry
 from tools.read_json import read_robot_json
+from tools.read_camera import open_camera_capture
+from actions.action_registry import PlanValidationError
+from tools.framing import send_message
+from src.tracing import trace
+from src.inference_backend import BACKENDS
+from job_server import start_job_server
+from batch_runner import run_batch
 from uuid import uuid4
 
-def simulation_controller(args, conn=None):
+def simulation_controller(args, conn=None, model_registry=None):
     if conn is None:
         print("No connection provided. Waiting for a client to connect...")
         host = "0.0.0.0"
@@ -32,8 +40,11 @@ def simulation_controller(args, conn=None):
         args.simulation_image_file,
     )
     image = cv2.imread(simulation_image_path)
+    # Live camera: kept open by a capture thread, a new frame for each command
+    capture = open_camera_capture(args) if args.live_camera else None
     
-    controller = ControlLoop(args)
+    controller = ControlLoop(args, model_registry=model_registry)
+    frame = None # Camera frame of the last command, pinned in the capture buffer
     
     while True:
         if args.show_image:
@@ -44,8 +55,29 @@ def simulation_controller(args, conn=None):
         user_input = input("User input: ")
         if user_input.lower() == "stop":
             break
+        if capture is not None:
+            if frame is not None:
+                frame.release()
+                frame = None
+            try:
+                # No copy: the capture thread doesn't overwrite the frame until it is released
+                frame = capture.latest(newer_than=time.time())
+            except TimeoutError as e:
+                print(f"Camera stalled, command skipped: {e}")
+                continue
+            image = frame.image
+
+        if args.stream_actions:
+            if not stream_actions(args, conn, controller, image, user_input):
+                break
+            continue
                 
-        result = controller.run(image, user_input)
+        try:
+            result = controller.run(image, user_input)
+        except PlanValidationError as e:
+            # Nothing was sent to the robot, the next command can be typed
+            print(f"Plan rejected: {e}")
+            continue
         if result is None:
             print("No action generated")
             break
@@ -57,52 +89,86 @@ def simulation_controller(args, conn=None):
         else:
             action_dict = result.get("actions", [])
             centroids = result.get("centroids", controller.prompt_generator.perception.environment_pos)
-        action_id = str(uuid4())[:8]
-        for idx, action in enumerate(action_dict):
-            action["action_id"] = action_id
-            action["step"] = idx + 1
-
-        # Extract info
-        object_list = controller.prompt_generator.environment_description_list
-        user_cmd = controller.prompt_generator.user_command.replace("User Command:\n", "").strip()
-        parsed_action = controller.last_action_type if hasattr(controller, "last_action_type") else "unknown"
 
         # Attach metadata to each action
-# Attach metadata to each action
-        for action in action_dict:
-            action["objects_detected"] = controller.prompt_generator.environment_description_list
-            action["user_command"] = user_input.strip()
-            action["generated_action"] = getattr(controller, "last_action_type", "unknown")
-            #action["centroids"] = centroids  # Attach centroids to each action
-
+        annotate_actions(action_dict, controller, user_input, str(uuid4())[:8])
 
         print(f"Action with objects and command: {action_dict}")
 
 
         
         try:
-            json_data = json.dumps(action_dict)
-            conn.sendall(json_data.encode("utf-8"))
+            # Length-prefixed frame, the client can't mix up or truncate messages
+            with trace("socket.send", actions=len(action_dict)):
+                send_message(conn, action_dict, encoding=args.message_encoding)
             print("Sent action to client.")
         except Exception as e:
             print("Error sending action data:", e)
             break
+        controller.export_metrics()
 
+    if frame is not None:
+        frame.release()
     if conn is not None:
         conn.close()
         print("Connection closed.")
 
+def stream_actions(args, conn, controller, image, user_input):
+    """
+    Sends the robot commands of each action as soon as it is generated, so the robot
+    can start moving while the LLM generates the next actions. Returns False on send error.
+    """
+    action_id = str(uuid4())[:8]
+    step = 0
+    try:
+        for action_dict in controller.run_stream(image, user_input):
+            annotate_actions(action_dict, controller, user_input, action_id, first_step=step + 1)
+            step += len(action_dict)
+
+            print(f"Action with objects and command: {action_dict}")
+            try:
+                with trace("socket.send", actions=len(action_dict)):
+                    send_message(conn, action_dict, encoding=args.message_encoding)
+                print("Sent action to client.")
+            except Exception as e:
+                print("Error sending action data:", e)
+                return False
+    except PlanValidationError as e:
+        # Each action is checked before its commands are generated, the previous ones were sent
+        print(f"Plan rejected after {step} commands: {e}")
+
+    controller.export_metrics()
+
+    if step == 0:
+        print("No action generated")
+    return True
+
+ALLOWED_CLIENT_IP = "192.168.168.76" #Change this IP for your computer IP
+
 # Checks if the computer IP is allowed
-def handle_client(conn, addr, args):
-    allowed_client_ip = "192.168.168.76" #Change this IP for your computer IP
+def handle_client(conn, addr, args, model_registry=None):
+    allowed_client_ip = ALLOWED_CLIENT_IP
     if addr[0] != allowed_client_ip:
         print(f"Rejected connection from {addr[0]}. Only accepting connections from {allowed_client_ip}.")
         conn.close()
         return
     print(f"Accepted connection from {addr}")
-    simulation_controller(args, conn)
+    simulation_controller(args, conn, model_registry)
 
 def start_server(args):
+    # Models are loaded once and shared by every client thread
+    model_registry = get_model_registry(args.model_memory_budget)
+    if args.preload_models:
+        print("Preloading models...")
+        ControlLoop(args, model_registry=model_registry)
+        model_registry.preload()
+        print(model_registry.report())
+
+    if args.job_server:
+        allowed_clients = None if args.allow_any_client else [ALLOWED_CLIENT_IP]
+        start_job_server(args, model_registry, allowed_clients)
+        return
+
     host = "0.0.0.0"  # Listen on all interfaces
     port = 8000       # Server port for simulation data
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -114,7 +180,7 @@ def start_server(args):
     try:
         while True:
             conn, addr = server.accept()
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr, args))
+            client_thread = threading.Thread(target=handle_client, args=(conn, addr, args, model_registry))
             client_thread.daemon = True  # Ensure thread does not block process termination
             client_thread.start()
     except KeyboardInterrupt:
@@ -137,21 +203,59 @@ def main():
     parser.add_argument("--port", type=int, default=65500, help="Robot server port")
     parser.add_argument("--buffer", type=int, default=1024, help="Server buffer size")
     
+    parser.add_argument("--stream_actions", action="store_true", help="Send each action to the client as soon as the LLM has generated it. Requires --llm_constrained (HuggingFace provider) so that every generated action is valid. The robot positions of an action are only checked when it is expanded, and a plan cut by the token limit of the LLM still sends its complete actions")
+    parser.add_argument("--job_server", action="store_true", help="Asyncio server: commands are received from the clients as jobs instead of typed in the terminal")
+    parser.add_argument("--job_port", type=int, default=8000, help="Job server port")
+    parser.add_argument("--job_workers", type=int, default=1, help="Number of jobs run at the same time")
+    parser.add_argument("--job_queue_size", type=int, default=16, help="Maximum number of waiting jobs")
+    parser.add_argument("--allow_any_client", action="store_true", help="Accept job server connections from any IP")
+    parser.add_argument("--message_encoding", type=str, default="json", choices=["json", "msgpack"], help="Encoding of the messages sent to the main PC")
+
     # Camera
     parser.add_argument("--camera_topic", type=str, default="", help="Camera ros topic")
     parser.add_argument("--camera_device", type=str, default="/dev/video2", help="Camera device")
     parser.add_argument("--camera_width", type=int, default=640, help="Camera width")
     parser.add_argument("--camera_height", type=int, default=480, help="Camera height")
+    parser.add_argument("--camera_file", type=str, default="", help="Video file or folder of images replayed as the camera, for tests without hardware")
+    parser.add_argument("--camera_fps", type=float, default=30.0, help="Frame rate of the --camera_file replay")
+    parser.add_argument("--live_camera", action="store_true", help="Simulation: take a new camera frame for each command instead of --simulation_image_file")
     
     # LLM
     parser.add_argument("--llm_name", type=str, default="microsoft/Phi-3-mini-4k-instruct", help="LLM name")
     parser.add_argument("--llm_provider", type=str, default="HuggingFace", help="LLM provider: HuggingFace or OpenAI")
     parser.add_argument("--llm_temperature", type=float, default=0.1, help="LLM temperature: float between 0.1 and 1.0")
     parser.add_argument("--llm_is_chat", action="store_true", help="The LLM is a Chat model")
+    parser.add_argument("--llm_constrained", action="store_true", help="Constrained decoding: the LLM can only write plans with the actions of the robot and the detected objects (HuggingFace provider)")
+
+    # Motion
+    parser.add_argument("--compile_motion", action="store_true", help="Blend the waypoints where the gripper doesn't act and drop the redundant ones before sending them, prints the estimated cycle time before and after")
+    parser.add_argument("--blend_radius", type=float, default=0.05, help="Maximal blend radius of the compiled paths, in meters")
+
+    # Models
+    parser.add_argument("--model_memory_budget", type=float, default=0.0, help="Memory budget in GB for the resident models, 0 for unlimited")
+    parser.add_argument("--pipeline_workers", type=int, default=4, help="Number of pipeline stages run at the same time (model loading, VLM, segmentation encoder...), 1 to run them one by one")
+    parser.add_argument("--trace_file", type=str, default=None, help="JSON lines file where the span of every pipeline stage is appended")
+    parser.add_argument("--metrics_file", type=str, default=None, help="File rewritten after each command with the stage latency histograms, in the Prometheus text format")
+    parser.add_argument("--preload_models", action="store_true", help="Load every model at startup instead of on the first command")
+    parser.add_argument("--vlm_backend", type=str, default="auto", choices=BACKENDS, help="Device and precision of the VLM: auto (cuda-fp16 on a GPU, cpu-bf16 otherwise), cuda-fp16, cpu-fp32, cpu-bf16 or cpu-int8 (linear layers quantized)")
+    parser.add_argument("--seg_backend", type=str, default="cpu-fp32", choices=BACKENDS, help="Device and precision of the segmentation model, same choices as --vlm_backend")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="Number of CPU threads of the models on a cpu backend, 0 for the torch default")
+
+    # Perception
+    parser.add_argument("--refine_segmentation", action="store_true", help="Segment small objects again in a crop around them for a more precise centroid")
+    parser.add_argument("--perception_cache_size", type=int, default=64, help="Number of scenes whose perception results are kept in memory")
+    parser.add_argument("--incremental_perception", action="store_true", help="Live camera: track the objects of the last perception in the new frame, the VLM and the segmentation only run again when the scene changed")
+    parser.add_argument("--perception_cache_dir", type=str, default=None, help="Folder to also store the perception results on disk, to survive restarts")
     
     # Simulation
     parser.add_argument("--simulation", action="store_true", help="Run in simulation mode")
     parser.add_argument("--simulation_image_file", type=str, default="test.png", help="Simulation image file")
+
+    # Offline batch mode
+    parser.add_argument("--batch_images", type=str, default=None, help="Folder of frames: run every command of --batch_commands on each frame, without robot or client")
+    parser.add_argument("--batch_commands", type=str, default=None, help="File of user commands, one per line")
+    parser.add_argument("--batch_output", type=str, default="batch_results.jsonl", help="JSON lines file of the actions and stage timings of each (frame, command)")
+    parser.add_argument("--batch_workers", type=int, default=1, help="Number of worker processes, each one loads its own models")
     
     # Image
     parser.add_argument("--show_image", action="store_true", help="Show the captured image")
@@ -159,8 +263,14 @@ def main():
     
     args = parser.parse_args()
     
+    if args.batch_images:
+        if not args.batch_commands:
+            parser.error("--batch_images requires --batch_commands")
+    if args.stream_actions and streaming_error(args):
+        parser.error(streaming_error(args))
+        run_batch(args)
     # If simulation mode is active, start the server to send JSON data.
-    if args.simulation:
+    elif args.simulation:
         start_server(args)
     else:
         real_controller(args)
@@ -1,74 +1,271 @@
-from tools.robot_tool import pixel_to_robot
-from actions.call_actions import call_robot_function
+from tools.robot_tool import pixels_to_robot
+from actions.action_registry import get_action_registry
+from src.model_registry import get_model_registry
+from src.tracing import trace
 
 from sentence_transformers import SentenceTransformer, util
+from collections import OrderedDict
 import re
 import os
+import threading
 
+import torch
+
+
+SIMILARITY_MODEL_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    "similarity_model",
+    "all-MiniLM-L6-v2",
+)
+
+# Regex pattern to match the action_name and optional parameters
+ACTION_PATTERN = re.compile(
+    r"^(?P<action_name>[^\:]+)(?:\:\s*\[(?P<parameters>[^\]]*)\])?$"
+)
+
+
+def parse_action_line(line: str):
+    """
+    Return the action dict of a line of the format: {'action': 'action_name', param: ['param1', 'param2'...]}
+    or None if the line is not an action.
+    """
+    match = ACTION_PATTERN.match(line)
+    if not match:
+        return None
+
+    # Extract action_name and parameters from match groups
+    action_name = match.group("action_name")
+    parameters_str = match.group("parameters")
+
+    if parameters_str:
+        # Split parameters by comma and strip whitespace
+        parameters = [
+            param.strip() for param in parameters_str.split(",") if param.strip()
+        ]
+    else:
+        parameters = "None"
+    return {"action": action_name, "param": parameters}
 
-def parse_action_text(action_text: str):
-    action_text_lines = action_text.split("\n")
-    first_action_found = False
-    # Define a list of action dicts of the format: {'action': 'action_name', param: ['param1', 'param2'...]}
-    action_list = []
-    # Define a regex pattern to match the action_name and optional parameters
-    pattern = r"^(?P<action_name>[^\:]+)(?:\:\s*\[(?P<parameters>[^\]]*)\])?$"
-
-    # Search in action_text all the actions and the parameters
-    for lines in action_text_lines:
-        # Use re.match to find the pattern in the action_text
-        match = re.match(pattern, lines)
-        if match:
-            if not first_action_found:
-                first_action_found = True
-
-            # Extract action_name and parameters from match groups
-            action_name = match.group("action_name")
-            parameters_str = match.group("parameters")
-
-            if parameters_str:
-                # Split parameters by comma and strip whitespace
-                parameters = [
-                    param.strip()
-                    for param in parameters_str.split(",")
-                    if param.strip()
-                ]
-            else:
-                parameters = "None"
-            action_list.append({"action": action_name, "param": parameters})
 
+class ActionStreamParser:
+    """
+    Incremental version of parse_action_text, for a LLM response received token by token.
+    An action is returned as soon as its line is complete.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.first_action_found = False
         # After have found one action, if no more action is found stop
-        if not match and first_action_found:
-            break
+        self.done = False
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        return self._parse_lines(lines)
+
+    def close(self) -> list:
+        """Parse the last line, which doesn't end with a new line."""
+        lines, self.buffer = [self.buffer], ""
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines: list) -> list:
+        action_list = []
+        for line in lines:
+            if self.done:
+                break
+            action = parse_action_line(line)
+            if action is not None:
+                self.first_action_found = True
+                action_list.append(action)
+            elif self.first_action_found:
+                self.done = True
+        return action_list
 
-    return action_list
+
+def parse_action_text(action_text: str):
+    # Define a list of action dicts of the format: {'action': 'action_name', param: ['param1', 'param2'...]}
+    parser = ActionStreamParser()
+    return parser.feed(action_text) + parser.close()
 
 
 class ActionManager:
-    def __init__(self, robot_info: dict):
+    def __init__(
+        self, robot_info: dict, model_registry=None, embedding_cache_size: int = 1024
+    ):
+        """
+        embedding_cache_size: number of text embeddings kept (LRU), the object names
+        and the LLM action names come back from one command to the next.
+        """
         self.robot_info = robot_info
         self.robot_actions = self.robot_info["actions"]
         self.robot_actions_name = [action["name"] for action in self.robot_actions]
-        # Initialize the similarity model
-        model_path = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)),
-            "similarity_model",
-            "all-MiniLM-L6-v2",
+        # Every action resolved to its function once, invalid profiles fail here
+        get_action_registry(self.robot_info["robot_name"])
+        # Initialize the similarity model, shared through the registry
+        self.similarity_model_path = SIMILARITY_MODEL_PATH
+        self.model_registry = (
+            model_registry if model_registry is not None else get_model_registry()
+        )
+        self.model_registry.register(
+            self.similarity_model_path,
+            lambda: SentenceTransformer(self.similarity_model_path),
+            size_hint=0.1,
         )
-        self.similarity_model = SentenceTransformer(model_path)
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache = (
+            OrderedDict()
+        )  # {text: embedding}, least recently used first
+        self.embedding_lock = threading.Lock()
+        self.encoder_calls = 0
+        # Embedding of the environment list of the current scene
+        self.environment_key = None
+        self.environment_embedding = None
         # Embed the robot actions
-        self.robot_actions_embedding = self.similarity_model.encode(
-            self.robot_actions_name, convert_to_tensor=True
-        ).cpu()
+        self.robot_actions_embedding = self.embed(self.robot_actions_name)
+
+    @property
+    def similarity_model(self):
+        return self.model_registry.get(self.similarity_model_path)
+
+    def embed(self, texts: list) -> torch.Tensor:
+        """
+        Return the (N, D) embeddings of the texts. Only the texts missing from the cache
+        are encoded, all in one batched call.
+        """
+        with self.embedding_lock:
+            embeddings = {
+                text: self.embedding_cache[text]
+                for text in texts
+                if text in self.embedding_cache
+            }
+            for text in embeddings:
+                self.embedding_cache.move_to_end(text)
+        missing = list(dict.fromkeys(text for text in texts if text not in embeddings))
+
+        if missing:
+            with trace(
+                "similarity.encode", texts=len(missing)
+            ), self.model_registry.use(self.similarity_model_path) as similarity_model:
+                encoded = similarity_model.encode(missing, convert_to_tensor=True).cpu()
+            with self.embedding_lock:
+                self.encoder_calls += 1
+                for text, embedding in zip(missing, encoded):
+                    embeddings[text] = embedding
+                    self.embedding_cache[text] = embedding
+                    self.embedding_cache.move_to_end(text)
+                while len(self.embedding_cache) > self.embedding_cache_size:
+                    self.embedding_cache.popitem(last=False)
+
+        return torch.stack([embeddings[text] for text in texts])
+
+    def embed_environment(self, environment_description_list: list) -> torch.Tensor:
+        """Embeddings of the objects of the scene, computed once per scene."""
+        environment_key = tuple(environment_description_list)
+        if environment_key != self.environment_key:
+            self.environment_embedding = self.embed(list(environment_key))
+            self.environment_key = environment_key
+        return self.environment_embedding
+
+    def prepare_embeddings(
+        self, llm_action_list: list, environment_description_list: list
+    ):
+        """
+        Embed the action names and parameters of the plan and the objects of the scene
+        in one encoder call, so resolve_action only reads the cache. Names that exactly
+        match an action or an object (e.g. constrained decoding) need no embedding.
+        """
+        texts = []
+        for llm_action in llm_action_list:
+            if llm_action["action"] not in self.robot_actions_name:
+                texts.append(llm_action["action"])
+            if llm_action["param"] != "None":
+                texts += [
+                    param
+                    for param in llm_action["param"]
+                    if param not in environment_description_list
+                ]
+        if texts:
+            texts = list(environment_description_list) + texts
+            self.embed(list(dict.fromkeys(texts)))
 
     def extract_last_action_type(self, raw_response):
         """
         Try to extract the action name from the raw LLM response like: 'pick_and_place: [can, glove]'
         """
         import re
+
         match = re.search(r"(\w+)\s*:", raw_response)
         return match.group(1) if match else "unknown"
 
+    def resolve_action(
+        self,
+        llm_action: dict,
+        environment_description_list: list,
+        environment_pos: dict,
+    ) -> dict:
+        """
+        Use sentence similarity to ensure that LLM output matches actions defined in robot_action.json and parameters defined by the VLM (environment_description_list)
+        """
+        with trace("action.resolve", action=llm_action["action"]):
+            return self._resolve_action(
+                llm_action, environment_description_list, environment_pos
+            )
+
+    def _resolve_action(
+        self,
+        llm_action: dict,
+        environment_description_list: list,
+        environment_pos: dict,
+    ) -> dict:
+        parameters = []
+        action_name = llm_action["action"]
+        if action_name not in self.robot_actions_name:
+            action_name = self.most_similar(
+                target=action_name,
+                compare_list=self.robot_actions_name,
+                embedded_compare_list=self.robot_actions_embedding,
+            )
+        if llm_action["param"] != "None":
+            parameter_pixels = []
+            for llm_parameter in llm_action["param"]:
+                # parameter_text = name of an object
+                parameter_text = llm_parameter
+                if parameter_text not in environment_description_list:
+                    parameter_text = self.most_similar(
+                        target=llm_parameter,
+                        compare_list=environment_description_list,
+                        embedded_compare_list=self.embed_environment(
+                            environment_description_list
+                        ),
+                    )
+                # based on the name, find the pixel coordinates
+                parameter_pixels.append(environment_pos[parameter_text][:2])
+            # convert them to robot coordinates, in one batch, for the list of the final parameters
+            parameters = pixels_to_robot(
+                self.robot_info["robot_name"], parameter_pixels
+            )
+        else:
+            parameters = "None"
+        print(f"Formatted Action: {action_name}, Parameters: {parameters}")
+        return {"action": action_name, "param": parameters}
+
+    @property
+    def action_registry(self):
+        return get_action_registry(self.robot_info["robot_name"])
+
+    def validate_actions(self, executable_actions: list):
+        """Reject the plan (PlanValidationError) before any robot command is generated."""
+        with trace("action.validate", actions=len(executable_actions)):
+            self.action_registry.validate_plan(executable_actions)
+
+    def expand_action(self, executable_action: dict) -> list:
+        """Return the robot commands (action dicts) of an executable action."""
+        with trace("action.expand", action=executable_action["action"]):
+            return self.action_registry.call(
+                executable_action["action"], executable_action["param"]
+            )
+
     def run(
         self,
         action_text: str,
@@ -76,47 +273,54 @@ class ActionManager:
         environment_pos: dict,
     ):
         action_dict_list = []
-        action_list = []
         llm_output_action_list = parse_action_text(action_text=action_text)
         print(f"Actions found in the LLM Response:\n{llm_output_action_list}")
+        self.prepare_embeddings(llm_output_action_list, environment_description_list)
 
-        # Use sentence similarity to ensure that LLM output matches actions defined in robot_action.json and parameters defined by the VLM (environment_description_list)
-
-        for llm_action in llm_output_action_list:
-            parameters = []
-            action_name = self.most_similar(
-                target=llm_action["action"],
-                compare_list=self.robot_actions_name,
-                embedded_compare_list=self.robot_actions_embedding,
+        action_list = [
+            self.resolve_action(
+                llm_action, environment_description_list, environment_pos
             )
-            if llm_action["param"] != "None":
-                for llm_parameter in llm_action["param"]:
-                    # parameter_text = name of an object
-                    parameter_text = self.most_similar(
-                        target=llm_parameter, compare_list=environment_description_list
-                    )
-                    # based on the name, find the pixel coordinates
-                    parameter_pixel = environment_pos[parameter_text]
-                    # convert it to robot coordinates and add it to the list of the final parameters
-                    parameters.append(
-                        pixel_to_robot(self.robot_info["robot_name"], parameter_pixel)
-                    )
-            else:
-                parameters = "None"
-            print(f"Formatted Action: {action_name}, Parameters: {parameters}")
-            action_list.append({"action": action_name, "param": parameters})
+            for llm_action in llm_output_action_list
+        ]
+        self.validate_actions(action_list)
 
         for executable_action in action_list:
-            if executable_action["param"] == "None":
-                param = (None,)
-            else:
-                param = executable_action["param"]
-            action_dict_list += call_robot_function(
-                self.robot_info["robot_name"], executable_action["action"], *param
-            )
+            action_dict_list += self.expand_action(executable_action)
 
         return action_dict_list
 
+    def run_stream(
+        self,
+        action_text_stream,
+        environment_description_list: list,
+        environment_pos: dict,
+    ):
+        """
+        Streaming version of run: `action_text_stream` yields the LLM response chunk by chunk,
+        and the robot commands of each action are yielded as soon as its line is complete.
+        """
+        parser = ActionStreamParser()
+        for chunk in action_text_stream:
+            for llm_action in parser.feed(chunk):
+                print(f"Action found in the LLM Response: {llm_action}")
+                self.prepare_embeddings([llm_action], environment_description_list)
+                yield self.expand_action(
+                    self.resolve_action(
+                        llm_action, environment_description_list, environment_pos
+                    )
+                )
+            if parser.done:
+                break
+        for llm_action in parser.close():
+            print(f"Action found in the LLM Response: {llm_action}")
+            self.prepare_embeddings([llm_action], environment_description_list)
+            yield self.expand_action(
+                self.resolve_action(
+                    llm_action, environment_description_list, environment_pos
+                )
+            )
+
     def most_similar(self, target: str, compare_list: list, embedded_compare_list=None):
         # Fix: If input is a dictionary (e.g., environment_pos), use its keys
         if isinstance(compare_list, dict):
@@ -124,17 +328,11 @@ class ActionManager:
         elif isinstance(compare_list, str):
             compare_list = [compare_list]
 
-        embedded_target = self.similarity_model.encode(
-            target, convert_to_tensor=True
-        ).cpu()
-
+        embedded_target = self.embed([target])
         if embedded_compare_list is None:
-            embedded_compare_list = self.similarity_model.encode(
-                compare_list, convert_to_tensor=True
-            ).cpu()
+            embedded_compare_list = self.embed(compare_list)
 
         similarities = util.cos_sim(embedded_target, embedded_compare_list)[0]
         most_similar_index = similarities.argmax().item()
 
         return compare_list[most_similar_index]
-
@@ -0,0 +1,70 @@
+"""Device and precision of the perception models.
+
+A backend is picked by name:
+- "cuda-fp16": GPU, half precision (what the VLM always used),
+- "cpu-fp32": CPU, full precision (what CLIPSeg always used),
+- "cpu-bf16": CPU, bfloat16 weights and activations, half the memory of fp32,
+- "cpu-int8": CPU, fp32 model with the linear layers dynamically quantized to
+  int8 (weights stored in int8, activations quantized on the fly), the fastest
+  CPU mode, at some cost in accuracy,
+- "auto": cuda-fp16 when there is a GPU, cpu-bf16 otherwise.
+`threads` sets the number of CPU threads of torch (0 keeps the torch default).
+"""
+
+import time
+
+import torch
+
+from src.model_registry import GB, estimate_model_bytes
+
+
+BACKENDS = ("auto", "cuda-fp16", "cpu-fp32", "cpu-bf16", "cpu-int8")
+
+
+class InferenceBackend:
+    def __init__(self, name: str = "auto", threads: int = 0):
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown backend {name}, expected one of {BACKENDS}")
+        if name == "auto":
+            name = "cuda-fp16" if torch.cuda.is_available() else "cpu-bf16"
+        if name == "cuda-fp16" and not torch.cuda.is_available():
+            raise ValueError("Backend cuda-fp16 requested but CUDA is not available")
+        self.name = name
+        self.threads = threads
+        self.device = torch.device("cuda" if name == "cuda-fp16" else "cpu")
+        self.quantize = name == "cpu-int8"
+        # Weights and inputs, the int8 mode quantizes an fp32 model
+        self.dtype = {
+            "cuda-fp16": torch.float16,
+            "cpu-bf16": torch.bfloat16,
+        }.get(name, torch.float32)
+
+    def configure_threads(self):
+        if self.threads > 0 and self.device.type == "cpu":
+            torch.set_num_threads(self.threads)
+
+    def prepare(self, model):
+        """Move the loaded model to the device and precision of the backend."""
+        model = model.eval().to(self.device, self.dtype)
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def load(self, loader, label: str):
+        """
+        Load a model with `loader(dtype)` (e.g. a from_pretrained with torch_dtype=dtype)
+        and prepare it. Prints the load time and the memory footprint of the model.
+        """
+        self.configure_threads()
+        start = time.time()
+        model = self.prepare(loader(self.dtype))
+        print(
+            f"{label} runs on {self.name} ({torch.get_num_threads()} CPU threads): "
+            f"{estimate_model_bytes(model) / GB:.2f}GB, loaded in {time.time() - start:.1f}s"
+        )
+        return model
+
+    def __repr__(self):
+        return f"InferenceBackend({self.name}, threads={self.threads})"
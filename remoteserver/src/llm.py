@@ -1,4 +1,7 @@
 from tools.read_json import read_llm_prompt_json
+from src.llm_prefix_cache import PrefixKVCache
+from src.plan_grammar import PlanGrammar, PlanLogitsProcessor, TokenTrie
+from src.tracing import trace
 
 import os
 from dotenv import load_dotenv
@@ -28,6 +31,9 @@ class LLM:
                     "OpenAI API key not found. Please set the OPENAI_API_KEY environment variable in the .env file."
                 )
         self.model = None
+        # Key/value cache of the static start of the prompts (HuggingFace provider)
+        self.prefix_cache = None
+        self.token_trie = None  # Text of the tokens, for the constrained generation
         self.set_model()
         self.parser = StrOutputParser()
 
@@ -98,7 +104,67 @@ class LLM:
             if not "{content}" in self.prompt_system:
                 self.prompt_system += "\n{content}"
             self.prompt_template = PromptTemplate.from_template(self.prompt_system)
+            # Same generation as the pipeline, resumed from the cached prefix
+            self.prefix_cache = PrefixKVCache(
+                model,
+                tokenizer,
+                dict(max_new_tokens=100, do_sample=True, temperature=self.temperature),
+            )
+
+    def set_static_prefix(self, content_prefix: str):
+        """
+        content_prefix: start of the content shared by every prompt (robot description
+        and actions). With the template before it, it is run through the model once and
+        the next prompts resume from its key/value cache.
+        """
+        if self.prefix_cache is None:
+            return
+        marker = "\0content\0"
+        template_prefix = self.prompt_template.format(content=marker).split(marker)[0]
+        self.prefix_cache.set_prefix(template_prefix + content_prefix)
 
-    def run(self, prompt: str):
+    def plan_logits_processor(self, grammar: PlanGrammar):
+        """Logits processor of a constrained generation, None when the provider can't constrain."""
+        if grammar is None or self.prefix_cache is None:
+            return None
+        if self.token_trie is None:
+            self.token_trie = TokenTrie(self.prefix_cache.tokenizer)
+        eos_ids = self.prefix_cache.model.generation_config.eos_token_id
+        eos_ids = eos_ids if isinstance(eos_ids, list) else [eos_ids]
+        eos_ids = set(eos_ids + [self.prefix_cache.tokenizer.eos_token_id])
+        return PlanLogitsProcessor(grammar, self.token_trie, eos_ids - {None})
+
+    def run(self, prompt: str, grammar: PlanGrammar = None):
+        """grammar: restricts the response to the valid plans (HuggingFace provider only)."""
+        if self.prefix_cache is not None:
+            with trace(
+                "llm.generate", model=self.model_name, constrained=grammar is not None
+            ):
+                response = self.prefix_cache.generate(
+                    self.prompt_template.format(content=prompt),
+                    self.plan_logits_processor(grammar),
+                )
+            print(self.prefix_cache.report())
+            return response
+        chain = self.prompt_template | self.model | StrOutputParser()
+        with trace("llm.generate", model=self.model_name):
+            return chain.invoke({"content": prompt})
+
+    def stream(self, prompt: str, grammar: PlanGrammar = None):
+        """Yield the response chunk by chunk, as the tokens are generated."""
+        if self.prefix_cache is not None:
+            with trace(
+                "llm.generate",
+                nest=False,
+                model=self.model_name,
+                stream=True,
+                constrained=grammar is not None,
+            ):
+                yield from self.prefix_cache.stream(
+                    self.prompt_template.format(content=prompt),
+                    self.plan_logits_processor(grammar),
+                )
+            return
         chain = self.prompt_template | self.model | StrOutputParser()
-        return chain.invoke({"content": prompt})
+        with trace("llm.generate", nest=False, model=self.model_name, stream=True):
+            yield from chain.stream({"content": prompt})
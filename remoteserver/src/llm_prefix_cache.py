@@ -0,0 +1,127 @@
+"""Reuse of the key/value cache of the static start of the LLM prompts.
+
+Every prompt starts the same way: the prompt template (instructions and few-shot
+example) and the description of the robot with its list of actions. Only the end
+changes (environment description, user command). The static prefix is run through
+the model once, its past key values are kept, and each request only prefills the
+tokens after the longest common prefix with it.
+
+The prompt is tokenized as a whole and compared token by token with the cached
+prefix, so the model sees exactly the same tokens as without the cache.
+"""
+
+import copy
+import threading
+
+import torch
+from transformers import LogitsProcessorList, TextIteratorStreamer
+
+from src.tracing import trace
+
+
+class PrefixKVCache:
+    def __init__(self, model, tokenizer, generation_config: dict):
+        """generation_config: arguments of model.generate (max_new_tokens, do_sample, temperature...)."""
+        self.model = model
+        self.tokenizer = tokenizer
+        self.generation_config = generation_config
+        self.prefix = None
+        self.prefix_ids = None  # (1, prefix tokens)
+        self.past_key_values = None
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.prefills = 0
+        self.requests = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        return self.tokenizer(text, return_tensors="pt").input_ids.to(self.device)
+
+    def set_prefix(self, prefix: str):
+        """Run the static prefix through the model, unless it is already cached."""
+        with self.lock:
+            if prefix == self.prefix:
+                return
+            prefix_ids = self.tokenize(prefix)
+            with trace("llm.prefill", tokens=prefix_ids.shape[1]), torch.no_grad():
+                outputs = self.model(input_ids=prefix_ids, use_cache=True)
+            self.prefix = prefix
+            self.prefix_ids = prefix_ids
+            self.past_key_values = outputs.past_key_values
+            self.prefills += 1
+
+    def prepare(self, text: str):
+        """Token IDs of the prompt and a copy of the cache of its cached tokens (or None)."""
+        input_ids = self.tokenize(text)
+        with self.lock:
+            prefix_ids, past_key_values = self.prefix_ids, self.past_key_values
+        reused = 0
+        if prefix_ids is not None:
+            length = min(prefix_ids.shape[1], input_ids.shape[1] - 1)
+            same = (input_ids[0, :length] == prefix_ids[0, :length]).int()
+            # Length of the common prefix, at least one token is left to run
+            reused = int(same.cumprod(0).sum())
+        if reused:
+            # generate extends the cache, each request works on its own copy
+            past_key_values = copy.deepcopy(past_key_values)
+            if reused < prefix_ids.shape[1]:
+                # Negative: number of tokens removed, in every transformers version
+                past_key_values.crop(reused - prefix_ids.shape[1])
+        else:
+            past_key_values = None
+        with self.lock:
+            self.requests += 1
+            self.reused_tokens += reused
+            self.prompt_tokens += input_ids.shape[1]
+        return input_ids, past_key_values
+
+    def generate_kwargs(self, text: str, logits_processor=None) -> dict:
+        """logits_processor: restricts the generated tokens (see src/plan_grammar.py)."""
+        input_ids, past_key_values = self.prepare(text)
+        return dict(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            pad_token_id=self.tokenizer.eos_token_id,
+            logits_processor=LogitsProcessorList(
+                [logits_processor] if logits_processor is not None else []
+            ),
+            **self.generation_config,
+        )
+
+    def generate(self, text: str, logits_processor=None) -> str:
+        kwargs = self.generate_kwargs(text, logits_processor)
+        with torch.no_grad():
+            output_ids = self.model.generate(**kwargs)
+        new_ids = output_ids[0, kwargs["input_ids"].shape[1] :]
+        return self.tokenizer.decode(new_ids, skip_special_tokens=True)
+
+    def stream(self, text: str, logits_processor=None):
+        """Yield the response chunk by chunk, generated in a background thread."""
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        kwargs = self.generate_kwargs(text, logits_processor)
+
+        def generate():
+            with torch.no_grad():
+                self.model.generate(**kwargs, streamer=streamer)
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        yield from streamer
+        thread.join()
+
+    def report(self) -> str:
+        with self.lock:
+            ratio = self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0
+            return (
+                f"LLM prefix cache: {self.prefills} prefills, {self.requests} requests, "
+                f"{100 * ratio:.0f}% of the prompt tokens reused"
+            )
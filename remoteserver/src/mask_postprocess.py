@@ -0,0 +1,182 @@
+"""Batched post-processing of the segmentation maps.
+
+Same algorithm as `Perception.centroid_segmentation` (resize, gaussian blur,
+threshold, connected components and selection of the region with the highest
+median value), but done for every object of the scene in one vectorized pass
+instead of one call and one python loop over the regions per object.
+"""
+
+import cv2 as cv
+import numpy as np
+import scipy.ndimage as ndi
+import skimage.transform as sit
+from skimage.util import img_as_float
+
+
+# Labels the connected components of each map separately (8-connectivity in the
+# image plane, no connectivity between two maps of the stack)
+STACK_STRUCTURE = np.zeros((3, 3, 3), dtype=bool)
+STACK_STRUCTURE[1] = True
+
+
+class MaskRegions:
+    """
+    Best region of every map of the stack. Arrays are indexed like the input maps,
+    objects without any region have `found` set to False and NaN values.
+    centroids: (N, 2) as (x, y), bboxes: (N, 4) as (min_x, min_y, max_x, max_y)
+    """
+
+    def __init__(self, centroids, bboxes, areas, scores, found):
+        self.centroids = centroids
+        self.bboxes = bboxes
+        self.areas = areas
+        self.scores = scores
+        self.found = found
+
+    def __len__(self):
+        return len(self.found)
+
+    def __getitem__(self, index):
+        """Same output as `Perception.centroid_segmentation`: (centroid, bbox)."""
+        if not self.found[index]:
+            return None, None
+        return list(self.centroids[index]), list(self.bboxes[index])
+
+
+def gaussian_kernel(sigma: float, truncate: float = 4.0) -> np.ndarray:
+    """1D kernel of scipy.ndimage.gaussian_filter."""
+    if sigma <= 0:
+        return np.ones(1)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    return kernel / kernel.sum()
+
+
+def resize_maps(maps, output_shape) -> np.ndarray:
+    """
+    Same output as `sit.resize(map, output_shape)` for every map of a (N, H, W) stack
+    (float64, up to rounding): anti-aliasing gaussian (mirrored borders), then linear
+    interpolation between the pixel centers. Done with OpenCV, without the generic
+    spline code of scipy.ndimage.zoom.
+    """
+    images = img_as_float(maps).astype(np.float64, copy=False)
+    height, width = images.shape[1:]
+    if output_shape[0] > height or output_shape[1] > width:
+        # Upsampling reads outside the map (mirrored by skimage, clamped by OpenCV)
+        return np.stack([sit.resize(image, output_shape) for image in images])
+    kernel_y = gaussian_kernel(max(0, (height / output_shape[0] - 1) / 2))
+    kernel_x = gaussian_kernel(max(0, (width / output_shape[1] - 1) / 2))
+    resized = np.empty((len(images), *output_shape))
+    for image, output in zip(images, resized):
+        filtered = cv.sepFilter2D(
+            image, -1, kernel_x, kernel_y, borderType=cv.BORDER_REFLECT_101
+        )
+        cv.resize(
+            filtered,
+            output_shape[::-1],
+            dst=output,
+            interpolation=cv.INTER_LINEAR,
+        )
+    # sit.resize clips to the range of its input
+    low = images.min(axis=(1, 2), keepdims=True)
+    high = images.max(axis=(1, 2), keepdims=True)
+    return np.clip(resized, low, high, out=resized)
+
+
+def grouped_median(grouped_values, region_end, region_area) -> np.ndarray:
+    """
+    Median of every region, the values being grouped by region (contiguous groups).
+    A partition of each group is enough, no full sort of the values is needed.
+    """
+    medians = np.empty(len(region_area))
+    for i, (end, area) in enumerate(zip(region_end, region_area)):
+        low, high = (area - 1) // 2, area // 2
+        partitioned = np.partition(grouped_values[end - area : end], (low, high))
+        medians[i] = (partitioned[low] + partitioned[high]) / 2
+    return medians
+
+
+def batch_centroid_segmentation(
+    maps, resize_image_format=(256, 256), threshold_std=0.5
+) -> MaskRegions:
+    """
+    maps: sequence or (N, H, W) array of segmentation maps (uint8 or float) of the same shape.
+    """
+    maps = np.asarray(maps)
+    num_maps = len(maps)
+
+    centroids = np.full((num_maps, 2), np.nan)
+    bboxes = np.full((num_maps, 4), np.nan)
+    areas = np.zeros(num_maps, dtype=int)
+    scores = np.full(num_maps, np.nan)
+    found = np.zeros(num_maps, dtype=bool)
+    if num_maps == 0:
+        return MaskRegions(centroids, bboxes, areas, scores, found)
+
+    scale_y = maps.shape[1] / resize_image_format[0]
+    scale_x = maps.shape[2] / resize_image_format[1]
+
+    im_resized = resize_maps(maps, resize_image_format)
+    blurred = np.empty_like(im_resized)
+    for resized, output in zip(im_resized, blurred):
+        cv.GaussianBlur(resized, ksize=(5, 5), sigmaX=1, dst=output)
+
+    # Per map threshold, then label every map in one call
+    mean = im_resized.mean(axis=(1, 2), keepdims=True)
+    std = im_resized.std(axis=(1, 2), keepdims=True)
+    label_stack, num_labels = ndi.label(
+        blurred > mean + threshold_std * std, structure=STACK_STRUCTURE
+    )
+    if num_labels == 0:
+        return MaskRegions(centroids, bboxes, areas, scores, found)
+
+    # Labeled reductions over all the regions of all the maps. Regions are
+    # numbered from 0 in raster order, map by map, like skimage.measure.label.
+    labels = np.arange(num_labels)
+    foreground = np.flatnonzero(label_stack)
+    region = label_stack.ravel()[foreground] - 1
+    map_index, pixel = np.divmod(foreground, label_stack[0].size)
+    rows, cols = np.divmod(pixel, label_stack.shape[2])
+    region_area = np.bincount(region, minlength=num_labels)
+    region_row = np.bincount(region, weights=rows, minlength=num_labels) / region_area
+    region_col = np.bincount(region, weights=cols, minlength=num_labels) / region_area
+
+    # Group the pixels by region (stable radix sort) for the other reductions
+    grouped = np.argsort(region, kind="stable")
+    region_end = np.cumsum(region_area)
+    region_start = region_end - region_area
+    region_map = map_index[grouped][region_start]
+    region_median = grouped_median(
+        im_resized.ravel()[foreground][grouped], region_end, region_area
+    )
+
+    # Best region of each map: highest median, first region (in raster order) on ties
+    order = np.lexsort((labels, -region_median, region_map))
+    best_map, first = np.unique(region_map[order], return_index=True)
+    best = order[first]
+
+    # Bounding boxes (min_row, min_col, max_row + 1, max_col + 1)
+    grouped_rows, grouped_cols = rows[grouped], cols[grouped]
+    best_bbox = np.stack(
+        [
+            np.minimum.reduceat(grouped_rows, region_start)[best],
+            np.minimum.reduceat(grouped_cols, region_start)[best],
+            np.maximum.reduceat(grouped_rows, region_start)[best] + 1,
+            np.maximum.reduceat(grouped_cols, region_start)[best] + 1,
+        ],
+        axis=1,
+    )
+
+    # Scale back to the map size, and convert from (row, col) to (x, y)
+    centroids[best_map, 0] = region_col[best] * scale_x
+    centroids[best_map, 1] = region_row[best] * scale_y
+    bboxes[best_map, 0] = best_bbox[:, 1] * scale_x
+    bboxes[best_map, 1] = best_bbox[:, 0] * scale_y
+    bboxes[best_map, 2] = best_bbox[:, 3] * scale_x
+    bboxes[best_map, 3] = best_bbox[:, 2] * scale_y
+    areas[best_map] = region_area[best]
+    scores[best_map] = region_median[best]
+    found[best_map] = True
+
+    return MaskRegions(centroids, bboxes, areas, scores, found)
@@ -0,0 +1,292 @@
+"""Long-lived model registry shared by every pipeline instance of the server.
+
+Models are registered with a loader callable and loaded lazily on first use.
+Once loaded they stay resident and are shared by all client threads, so the
+weights are deserialized once instead of once per command. A memory budget can
+be set, in which case the least recently used models that are not currently in
+use are evicted to make room for the next one.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import threading
+import time
+
+from src.tracing import trace
+
+
+GB = 1024**3
+
+
+def estimate_model_bytes(obj, _depth=0) -> int:
+    """
+    Best effort estimation of the memory held by a model (parameters + buffers).
+    Walks through the usual wrappers (tuples, pipelines, objects with a `model` attribute).
+    """
+    if obj is None or _depth > 4:
+        return 0
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_model_bytes(item, _depth + 1) for item in obj)
+    if hasattr(obj, "parameters") and hasattr(obj, "buffers"):
+        try:
+            total = sum(p.numel() * p.element_size() for p in obj.parameters())
+            total += sum(b.numel() * b.element_size() for b in obj.buffers())
+            # Dynamically quantized linear layers keep their weights out of the parameters
+            for module in obj.modules():
+                if hasattr(module, "_packed_params") and callable(
+                    getattr(module, "weight", None)
+                ):
+                    weight, bias = module.weight(), module.bias()
+                    total += weight.numel() * weight.element_size()
+                    if bias is not None:
+                        total += bias.numel() * bias.element_size()
+            return total
+        except Exception:
+            return 0
+    for attribute in ("model", "pipeline"):
+        if hasattr(obj, attribute):
+            return estimate_model_bytes(getattr(obj, attribute), _depth + 1)
+    return 0
+
+
+def release_accelerator_memory():
+    gc.collect()
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class ModelEntry:
+    def __init__(self, name: str, loader, size_hint: float = 0.0):
+        self.name = name
+        self.loader = loader
+        self.size_hint = int(size_hint * GB)  # Expected size in bytes, before loading
+        self.model = None
+        self.size = 0  # Measured size in bytes, after loading
+        self.users = 0  # Number of threads currently running the model
+        self.load_lock = threading.Lock()
+
+        # Metrics
+        self.loads = 0
+        self.load_time = 0.0
+        self.last_load_time = 0.0
+        self.inference_calls = 0
+        self.inference_time = 0.0
+        self.evictions = 0
+
+    @property
+    def resident(self) -> bool:
+        return self.model is not None
+
+    @property
+    def expected_size(self) -> int:
+        return self.size if self.size else self.size_hint
+
+
+class ModelRegistry:
+    def __init__(self, memory_budget_gb: float = 0.0):
+        """
+        memory_budget_gb: maximum memory the resident models can use. 0 means unlimited.
+        """
+        self.memory_budget = int(memory_budget_gb * GB)
+        self.entries = OrderedDict()  # Ordered from least to most recently used
+        self.lock = threading.RLock()
+
+    def register(self, name: str, loader, size_hint: float = 0.0):
+        """
+        Register a model loader under `name`. Registering an existing name is a no-op,
+        so every pipeline instance can register the models it needs.
+        size_hint: expected size of the model in GB, used by the eviction before loading.
+        """
+        with self.lock:
+            if name not in self.entries:
+                self.entries[name] = ModelEntry(name, loader, size_hint)
+            return self.entries[name]
+
+    def is_registered(self, name: str) -> bool:
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name: str):
+        """Return the loaded model, loading it if needed. Inference time is not recorded."""
+        entry = self._entry(name)
+        with self.lock:
+            entry.users += 1
+        try:
+            return self._ensure_loaded(entry)
+        finally:
+            with self.lock:
+                entry.users -= 1
+
+    @contextmanager
+    def use(self, name: str):
+        """
+        Context manager giving access to a loaded model. The model can't be evicted while
+        it is being used and the time spent inside the block is recorded as inference time.
+        """
+        entry = self._entry(name)
+        with self.lock:
+            entry.users += 1
+        try:
+            model = self._ensure_loaded(entry)
+            start = time.time()
+            try:
+                yield model
+            finally:
+                elapsed = time.time() - start
+                with self.lock:
+                    entry.inference_calls += 1
+                    entry.inference_time += elapsed
+        finally:
+            with self.lock:
+                entry.users -= 1
+
+    def preload(self, names=None):
+        for name in names if names is not None else list(self.entries):
+            self.get(name)
+
+    def evict(self, name: str) -> bool:
+        with self.lock:
+            entry = self._entry(name)
+            if not entry.resident or entry.users > 0:
+                return False
+            self._unload(entry)
+        release_accelerator_memory()
+        return True
+
+    def resident_bytes(self) -> int:
+        with self.lock:
+            return sum(entry.size for entry in self.entries.values() if entry.resident)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                name: {
+                    "resident": entry.resident,
+                    "size_gb": round(entry.expected_size / GB, 3),
+                    "loads": entry.loads,
+                    "load_time": entry.load_time,
+                    "last_load_time": entry.last_load_time,
+                    "inference_calls": entry.inference_calls,
+                    "inference_time": entry.inference_time,
+                    "mean_inference_time": (
+                        entry.inference_time / entry.inference_calls
+                        if entry.inference_calls
+                        else 0.0
+                    ),
+                    "evictions": entry.evictions,
+                }
+                for name, entry in self.entries.items()
+            }
+
+    def report(self) -> str:
+        lines = ["Model registry:"]
+        for name, m in self.metrics().items():
+            lines.append(
+                f"- {name}: resident={m['resident']}, size={m['size_gb']}GB, "
+                f"loads={m['loads']} ({m['load_time']:.2f}s), "
+                f"inference={m['inference_calls']} ({m['inference_time']:.2f}s, "
+                f"mean {m['mean_inference_time']:.2f}s), evictions={m['evictions']}"
+            )
+        return "\n".join(lines)
+
+    def _entry(self, name: str) -> ModelEntry:
+        try:
+            return self.entries[name]
+        except KeyError:
+            raise KeyError(f"Model '{name}' is not registered") from None
+
+    def _ensure_loaded(self, entry: ModelEntry):
+        with self.lock:
+            if entry.resident:
+                self.entries.move_to_end(entry.name)
+                return entry.model
+
+        # Only one thread loads a given model, the others wait for it
+        with entry.load_lock:
+            with self.lock:
+                if entry.resident:
+                    self.entries.move_to_end(entry.name)
+                    return entry.model
+                evicted = self._make_room(entry)
+            if evicted:
+                release_accelerator_memory()
+
+            print(f"Loading model {entry.name}")
+            start = time.time()
+            with trace("model.load", model=entry.name):
+                model = entry.loader()
+            elapsed = time.time() - start
+            size = estimate_model_bytes(model)
+
+            with self.lock:
+                entry.model = model
+                entry.size = size if size else entry.size_hint
+                entry.loads += 1
+                entry.load_time += elapsed
+                entry.last_load_time = elapsed
+                self.entries.move_to_end(entry.name)
+                # The measured size can be larger than the hint
+                evicted = self._make_room(entry)
+            if evicted:
+                release_accelerator_memory()
+            print(
+                f"Model {entry.name} loaded in {elapsed:.2f}s ({entry.size / GB:.2f}GB)"
+            )
+            return model
+
+    def _make_room(self, entry: ModelEntry) -> bool:
+        """Evict least recently used idle models until `entry` fits in the budget."""
+        if not self.memory_budget:
+            return False
+
+        def required():
+            extra = 0 if entry.resident else entry.expected_size
+            return self.resident_bytes() + extra
+
+        evicted = False
+        for candidate in list(self.entries.values()):
+            if required() <= self.memory_budget:
+                break
+            if candidate is entry or not candidate.resident or candidate.users > 0:
+                continue
+            print(f"Evicting model {candidate.name} to fit {entry.name} in the budget")
+            self._unload(candidate)
+            evicted = True
+        if required() > self.memory_budget:
+            print(f"Model {entry.name} doesn't fit in the memory budget")
+        return evicted
+
+    def _unload(self, entry: ModelEntry):
+        entry.model = None
+        entry.evictions += 1
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_model_registry(memory_budget_gb: float = None) -> ModelRegistry:
+    """
+    Return the process wide registry, creating it on first call.
+    memory_budget_gb left to None accepts the existing registry, a different budget raises ValueError.
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ModelRegistry(memory_budget_gb or 0.0)
+        elif (
+            memory_budget_gb is not None
+            and int(memory_budget_gb * GB) != _default_registry.memory_budget
+        ):
+            raise ValueError(
+                f"The model registry has a budget of "
+                f"{_default_registry.memory_budget / GB:.2f}GB, "
+                f"{memory_budget_gb:.2f}GB requested"
+            )
+        return _default_registry
@@ -0,0 +1,194 @@
+"""Compilation of the robot commands of a plan before they are sent.
+
+The actions expand to a list of waypoints {"pos_end_effector": pose, "gripper": value}:
+move to the pose, then set the gripper. Sent as they are, every waypoint is a
+stop-and-go move followed by a gripper command. The compiler:
+- drops the waypoints that change nothing (same pose and gripper state as the
+  robot already has), and folds a gripper-only waypoint into the previous one,
+- blends the waypoints where the gripper doesn't change: the robot goes through
+  them without stopping ("move": "movep", "blend_radius" > 0). The radius is at
+  most `blend_radius` and 40% of the shorter adjacent segment, so that two
+  blends never overlap,
+- stops ("move": "movel", "blend_radius": 0) where the gripper acts and at the end.
+
+The waypoints keep their format, the two keys are only added, so a client that
+ignores them still works.
+
+The cycle time is estimated before and after compilation with a trapezoidal
+velocity profile (speed `speed`, acceleration `acceleration`) on the distance
+between the positions, the robot stopping at every stop-and-go waypoint and only
+at the stops of a blended path, plus the gripper commands.
+"""
+
+import math
+
+
+def waypoint_pose(waypoint: dict):
+    """Pose of a waypoint, None for a named command (e.g. "reset_pose")."""
+    pose = waypoint.get("pos_end_effector")
+    return pose if isinstance(pose, (list, tuple)) else None
+
+
+class MotionState:
+    """Pose and gripper state of the robot at the end of a compiled plan."""
+
+    def __init__(self, pose=None, gripper=None):
+        self.pose = pose
+        self.gripper = gripper
+
+
+class MotionReport:
+    def __init__(self, waypoints, compiled, blended, time_before, time_after):
+        self.waypoints = waypoints
+        self.compiled = compiled
+        self.blended = blended
+        self.time_before = time_before  # Estimated cycle time in seconds
+        self.time_after = time_after
+
+    def __str__(self):
+        return (
+            f"Motion compiler: {self.waypoints} waypoints -> {self.compiled} "
+            f"({self.blended} blended), estimated cycle time "
+            f"{self.time_before:.1f}s -> {self.time_after:.1f}s"
+        )
+
+
+class MotionCompiler:
+    def __init__(
+        self,
+        blend_radius: float = 0.05,
+        speed: float = 0.1,
+        acceleration: float = 0.1,
+        gripper_time: float = 1.0,
+        gripper_noop_time: float = 0.1,
+        tolerance: float = 1e-4,
+        blend_move: str = "movep",
+    ):
+        """
+        blend_radius: maximal blend radius in meters, 0 to only remove the redundant waypoints.
+        speed, acceleration: tool speed (m/s) and acceleration (m/s^2) of the moves, as sent by ur_rcv_sim.
+        gripper_time, gripper_noop_time: duration of a gripper command that moves it / that doesn't.
+        tolerance: poses closer than this (on every coordinate) are the same pose.
+        blend_move: URScript move of the blended waypoints, "movep" (constant tool speed) or "movel".
+        """
+        self.blend_radius = blend_radius
+        self.speed = speed
+        self.acceleration = acceleration
+        self.gripper_time = gripper_time
+        self.gripper_noop_time = gripper_noop_time
+        self.tolerance = tolerance
+        self.blend_move = blend_move
+
+    def same_pose(self, pose, other) -> bool:
+        if pose is None or other is None or len(pose) != len(other):
+            return False
+        return all(abs(a - b) <= self.tolerance for a, b in zip(pose, other))
+
+    def move_time(self, distance: float) -> float:
+        """Time of a move from standstill to standstill, trapezoidal velocity profile."""
+        if distance <= 0:
+            return 0.0
+        if distance >= self.speed**2 / self.acceleration:
+            return distance / self.speed + self.speed / self.acceleration
+        return 2 * math.sqrt(distance / self.acceleration)
+
+    @staticmethod
+    def distance(pose, other) -> float:
+        if pose is None or other is None:
+            return 0.0
+        return math.dist(pose[:3], other[:3])
+
+    def estimate_uncompiled(self, waypoints: list, start: MotionState) -> float:
+        """Every waypoint is a stop-and-go move followed by a gripper command."""
+        total = 0.0
+        pose, gripper = start.pose, start.gripper
+        for waypoint in waypoints:
+            total += self.move_time(self.distance(pose, waypoint_pose(waypoint)))
+            moves_gripper = waypoint.get("gripper") != gripper
+            total += self.gripper_time if moves_gripper else self.gripper_noop_time
+            pose, gripper = waypoint_pose(waypoint), waypoint.get("gripper")
+        return total
+
+    def estimate_compiled(
+        self, waypoints: list, start: MotionState, gripper_changes: list
+    ) -> float:
+        """The robot only stops at the stop waypoints, a blended path is one move."""
+        total = 0.0
+        pose = start.pose
+        path_length = 0.0
+        for waypoint, gripper_change in zip(waypoints, gripper_changes):
+            path_length += self.distance(pose, waypoint_pose(waypoint))
+            pose = waypoint_pose(waypoint)
+            if not waypoint.get("blend_radius"):
+                total += self.move_time(path_length)
+                path_length = 0.0
+            if gripper_change:
+                total += self.gripper_time
+        return total + self.move_time(path_length)
+
+    def compile(self, action_dict_list: list, start: MotionState = None):
+        """
+        Compiled waypoints, report, and state of the robot at the end (start of the next plan).
+        start: state of the robot before the plan, unknown when None.
+        """
+        start = start if start is not None else MotionState()
+        compiled = []
+        gripper_changes = []  # The gripper acts at the waypoint
+        pose, gripper = start.pose, start.gripper
+        for action_dict in action_dict_list:
+            pose_end_effector = waypoint_pose(action_dict)
+            waypoint_gripper = action_dict.get("gripper")
+            if pose_end_effector is None:
+                # Named command, sent as it is
+                compiled.append(dict(action_dict))
+                gripper_changes.append(waypoint_gripper != gripper)
+                pose, gripper = None, waypoint_gripper
+                continue
+            gripper_change = waypoint_gripper != gripper
+            if self.same_pose(pose_end_effector, pose):
+                if not gripper_change:
+                    continue  # No-op
+                if compiled and not gripper_changes[-1]:
+                    # Gripper only: done at the end of the previous move
+                    compiled[-1]["gripper"] = waypoint_gripper
+                    gripper_changes[-1] = True
+                    gripper = waypoint_gripper
+                    continue
+            compiled.append(dict(action_dict))
+            gripper_changes.append(gripper_change)
+            pose, gripper = list(pose_end_effector), waypoint_gripper
+
+        self.blend(compiled, gripper_changes, start)
+        end = MotionState(pose, gripper)
+        report = MotionReport(
+            len(action_dict_list),
+            len(compiled),
+            sum(1 for waypoint in compiled if waypoint.get("blend_radius")),
+            self.estimate_uncompiled(action_dict_list, start),
+            self.estimate_compiled(compiled, start, gripper_changes),
+        )
+        return compiled, report, end
+
+    def blend(self, compiled: list, gripper_changes: list, start: MotionState):
+        """Set the move and blend radius of every waypoint."""
+        poses = [waypoint_pose(waypoint) for waypoint in compiled]
+        for i, waypoint in enumerate(compiled):
+            if poses[i] is None:
+                continue
+            radius = 0.0
+            previous = poses[i - 1] if i > 0 else start.pose
+            following = poses[i + 1] if i + 1 < len(compiled) else None
+            # Blended when the robot goes through: no gripper action, moves on both sides
+            if (
+                self.blend_radius > 0
+                and not gripper_changes[i]
+                and previous is not None
+                and following is not None
+            ):
+                shorter = min(
+                    self.distance(previous, poses[i]),
+                    self.distance(poses[i], following),
+                )
+                radius = min(self.blend_radius, 0.4 * shorter)
+            waypoint["move"] = self.blend_move if radius > 0 else "movel"
+            waypoint["blend_radius"] = round(radius, 6)
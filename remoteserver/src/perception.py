@@ -1,7 +1,13 @@
 from src.vlm import VLM
+from src.model_registry import get_model_registry
+from src.segmentation import SegmentationEngine
+from src.inference_backend import InferenceBackend
+from src.mask_postprocess import batch_centroid_segmentation
+from src.perception_cache import get_perception_cache
+from src.scene_tracker import SceneTracker
+from src.tracing import trace
 
 import torch
-from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
 import matplotlib.pyplot as plt
 import numpy as np
 import cv2 as cv
@@ -14,6 +20,12 @@ import threading
 import textwrap
 
 
+VLM_NAME = "OpenGVLab/Mini-InternVL-Chat-2B-V1-5"
+SEG_MODEL_NAME = "CIDAS/clipseg-rd64-refined"
+# Files written in the pictures folder by the perception, not camera frames
+OUTPUT_PICTURES = ("prediction_*", "plot.png", "overlay_output.png", "seg_result.png")
+
+
 def save_image(image_path: str, image_data):
     cv.imwrite(image_path, image_data)
 
@@ -27,23 +39,85 @@ def parse_vlm_output(text):
 
 
 class Perception:
-    def __init__(self):
-        self.vlm_name = "OpenGVLab/Mini-InternVL-Chat-2B-V1-5"
-        self.seg_model_name = "CIDAS/clipseg-rd64-refined"
-        self.pictures_folder_path = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)), "pictures"
+    # Increase when a change of the perception code changes its results, to
+    # invalidate the cached results
+    version = 1
+
+    def __init__(self, model_registry=None, perception_cache=None):
+        self.vlm_name = VLM_NAME
+        self.seg_model_name = SEG_MODEL_NAME
+        self.seg_text_cache_size = 256  # Number of object names kept encoded
+
+        # Device and precision of the models (see src/inference_backend.py)
+        self.vlm_backend = "auto"
+        self.seg_backend = "cpu-fp32"
+        self.cpu_threads = 0  # Torch CPU threads, 0 for the torch default
+
+        # Coarse-to-fine segmentation: small objects found by the full frame pass
+        # are segmented again in a crop around them, at a higher effective resolution
+        self.refine_segmentation = False
+        self.refine_max_area_fraction = (
+            0.05  # Only refine bboxes smaller than this part of the frame
+        )
+        self.refine_window_margin = 1.0  # Margin around the bbox, in bbox sizes
+        self.refine_min_window = 128  # Minimal side of the crop window, in pixels
+        self.refine_score_ratio = (
+            0.8  # Keep the refined centroid if its score >= ratio * coarse score
+        )
+
+        # Incremental perception: between two commands, the objects of the last
+        # perception are tracked in the new frame, the VLM and the segmentation only
+        # run again when the scene changed (see src/scene_tracker.py)
+        self.incremental = False
+        self.scene_tracker = SceneTracker()
+
+        # Models are loaded once and shared through the registry
+        self.model_registry = (
+            model_registry if model_registry is not None else get_model_registry()
+        )
+        self.model_registry.register(
+            self.vlm_name,
+            lambda: VLM(
+                self.vlm_name,
+                backend=InferenceBackend(self.vlm_backend, self.cpu_threads),
+            ),
+            size_hint=4.5,
+        )
+        self.model_registry.register(
+            self.seg_model_name,
+            lambda: SegmentationEngine.from_pretrained(
+                self.seg_model_name,
+                self.seg_text_cache_size,
+                backend=InferenceBackend(self.seg_backend, self.cpu_threads),
+            ),
+            size_hint=0.6,
+        )
+        # Results of the already seen frames
+        self.perception_cache = (
+            perception_cache if perception_cache is not None else get_perception_cache()
+        )
+        # Debug images (predictions, overlay, plot), see set_output_folder
+        self.set_output_folder(
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "pictures")
         )
-        self.seg_result_image_path = os.path.join(
-            self.pictures_folder_path, "seg_result.png"
-        )  # Result of the centroid segmentation
-        self.plot_image_path = os.path.join(self.pictures_folder_path, "plot.png")
 
         self.environment_description_list = []  # ["figurine", "cup", "table"]
         self.centers_location = []  # [(x1,y1,z1), (x2,y2,z2), (x3,y3,z3)]
         self.environment_pos = (
             {}
         )  # {'figurine':[x1,y1,z1], 'cup':[x2,y2,z2], 'table':[x3,y3,z3]}
+        self.bboxes = {}  # {'figurine':[min_x,min_y,max_x,max_y], ...}
         self.image = None
+        self.cache_key = None
+
+    def set_output_folder(self, folder: str):
+        """Folder of the debug images, created if needed. Defaults to pictures/."""
+        os.makedirs(folder, exist_ok=True)
+        self.pictures_folder_path = folder
+        self.seg_result_image_path = os.path.join(
+            folder, "seg_result.png"
+        )  # Result of the centroid segmentation
+        self.plot_image_path = os.path.join(folder, "plot.png")
 
     def centroid_segmentation(self, map):
         """
@@ -53,7 +127,9 @@ class Perception:
         im_resized = sit.resize(map, resize_image_format)
         # Apply gaussian blur, threshold and finally labeling the image
         threshold = np.mean(im_resized) + 0.5 * np.std(im_resized)
-        label_map = sim.label(cv.GaussianBlur(im_resized, ksize=(5, 5), sigmaX=1) > threshold)
+        label_map = sim.label(
+            cv.GaussianBlur(im_resized, ksize=(5, 5), sigmaX=1) > threshold
+        )
 
         # segmentation
         regions = sim.regionprops(label_map)
@@ -88,47 +164,47 @@ class Perception:
         return centroid, bbox
         # return centroid
 
-    def segmentation(self):
-        # Load model
-        print(f"Run Image Segmentation model {self.seg_model_name}")
-        processor = CLIPSegProcessor.from_pretrained(self.seg_model_name)
-        model = CLIPSegForImageSegmentation.from_pretrained(self.seg_model_name)
-
-        # Prepare image & texts for model
-        inputs = processor(
-            text=self.environment_description_list,
-            images=[self.image] * len(self.environment_description_list),
-            padding="max_length",
-            return_tensors="pt",
-        )
+    def encode_image(self):
+        """Vision encoder part of the segmentation, it doesn't need the VLM output."""
+        with self.model_registry.use(self.seg_model_name) as segmentation_engine:
+            return segmentation_engine.encode_image(self.image)
 
-        # Forward pass and visualize the predictions of the model
-        # Predict
-        with torch.no_grad():
-            outputs = model(**inputs)
+    def segmentation(self, activations=None):
+        """activations: output of encode_image, computed here when None."""
+        print(f"Run Image Segmentation model {self.seg_model_name}")
+        with self.model_registry.use(self.seg_model_name) as segmentation_engine:
+            # The image is encoded once and every object is decoded in one batch
+            logits = segmentation_engine.run(
+                self.image, self.environment_description_list, activations
+            )
 
-        preds = outputs.logits.unsqueeze(1)
+        preds = logits.unsqueeze(1)
 
         imgs_seg = []
         centers = []
+        bboxes = []
+        scores = []
         environment_not_found = (
             []
         )  # List of indexes of objects that were not found in the segmentation
 
-        # # Compute center and bounding box + Visualize each object
-        for i in range(len(self.environment_description_list)):
+        # Convert tensors to int8 images
+        maps = (torch.sigmoid(preds[:, 0]).cpu().numpy() * 255).astype(np.uint8)
+
+        # Compute bounding boxes and centroids of every object in one pass
+        with trace("segmentation.centroids", objects=len(maps)):
+            regions = batch_centroid_segmentation(maps)
 
-            # Convert tensor to int8 image
-            img_array = torch.sigmoid(preds[i][0]).cpu().numpy()
-            img_array = (img_array * 255).astype(np.uint8)
+        # # Visualize each object
+        for i in range(len(self.environment_description_list)):
+            img_array = maps[i]
 
             # Save the image in a thread using OpenCV
             img_path = os.path.join(self.pictures_folder_path, f"prediction_{i}.jpg")
             thread = threading.Thread(target=save_image, args=(img_path, img_array))
             thread.start()
 
-            # Compute bounding box and centroids
-            center, bbox = self.centroid_segmentation(img_array)
+            center, bbox = regions[i]
 
             # If no center or bbox is found, remove the object
             if center is None or bbox is None:
@@ -142,6 +218,8 @@ class Perception:
             # For the moment we fix the Z manually (no depth with camera)
             center_z = -3.5
             centers.append([center_x, center_y, center_z])
+            bboxes.append(list(bbox))
+            scores.append(regions.scores[i])
 
             # Set up to visualize bounding box and its center
             cv.rectangle(img_array, (min_x, min_y), (max_x, max_y), (255, 255, 255), 3)
@@ -167,6 +245,14 @@ class Perception:
             x, y, _ = centers[i]
             centers[i][0] = x * image_shape[0] / resized_shape[0]
             centers[i][1] = y * image_shape[1] / resized_shape[1]
+            bboxes[i][0] *= image_shape[0] / resized_shape[0]
+            bboxes[i][2] *= image_shape[0] / resized_shape[0]
+            bboxes[i][1] *= image_shape[1] / resized_shape[1]
+            bboxes[i][3] *= image_shape[1] / resized_shape[1]
+        self.bboxes = dict(zip(self.environment_description_list, bboxes))
+        if self.refine_segmentation:
+            with trace("segmentation.refine"):
+                centers = self.refine_centers(centers, bboxes, scores)
         img_array = np.array(self.image)
         for c in centers:
             cv.circle(
@@ -177,20 +263,84 @@ class Perception:
                 thickness=-1,
             )
             # Save final annotated image
-        final_overlay_path = os.path.join(self.pictures_folder_path, "overlay_output.png")
+        final_overlay_path = os.path.join(
+            self.pictures_folder_path, "overlay_output.png"
+        )
         cv.imwrite(final_overlay_path, img_array)
-        self.annotated_image_path = final_overlay_path  # Store path if needed externally
-
+        self.annotated_image_path = (
+            final_overlay_path  # Store path if needed externally
+        )
 
         # Show plot
         thread_plot = threading.Thread(
-            target=self.generate_plot, args=(imgs_seg, img_array)
+            target=self.generate_plot,
+            # The next command can change the image, the list and the folder while plotting
+            args=(
+                imgs_seg,
+                img_array,
+                self.image,
+                list(self.environment_description_list),
+                self.plot_image_path,
+            ),
         )
         thread_plot.start()
 
         return centers
 
-    def generate_plot(self, imgs_seg, result_img):
+    def refine_window(self, center, bbox):
+        """Square crop window (min_x, min_y, max_x, max_y) around an object, inside the frame."""
+        width, height = self.image.size
+        min_x, min_y, max_x, max_y = bbox
+        side = (1 + 2 * self.refine_window_margin) * max(max_x - min_x, max_y - min_y)
+        side = int(min(max(side, self.refine_min_window), width, height))
+        x0 = int(round(min(max(center[0] - side / 2, 0), width - side)))
+        y0 = int(round(min(max(center[1] - side / 2, 0), height - side)))
+        return x0, y0, x0 + side, y0 + side
+
+    def refine_centers(self, centers, bboxes, scores):
+        """
+        Second pass of the coarse-to-fine segmentation. Each small object is segmented
+        again in a crop around its coarse position, so CLIPSeg sees it at a higher
+        resolution. Only the crops are encoded, in one batch.
+        Centers and bboxes are in frame coordinates, aligned with environment_description_list.
+        """
+        width, height = self.image.size
+        candidates, windows = [], []
+        for i, bbox in enumerate(bboxes):
+            bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+            if bbox_area <= self.refine_max_area_fraction * width * height:
+                candidates.append(i)
+                windows.append(self.refine_window(centers[i], bbox))
+        if not candidates:
+            return centers
+
+        print(f"Refining the segmentation of {len(candidates)} objects")
+        crops = [self.image.crop(window) for window in windows]
+        texts = [self.environment_description_list[i] for i in candidates]
+        with self.model_registry.use(self.seg_model_name) as segmentation_engine:
+            logits = segmentation_engine.run_crops(crops, texts)
+        maps = (torch.sigmoid(logits).cpu().numpy() * 255).astype(np.uint8)
+        regions = batch_centroid_segmentation(maps)
+
+        for k, i in enumerate(candidates):
+            if not regions.found[k]:
+                continue
+            if regions.scores[k] < self.refine_score_ratio * scores[i]:
+                continue
+            x0, y0, x1, y1 = windows[k]
+            refined_x, refined_y = regions.centroids[k]
+            centers[i][0] = float(x0 + refined_x * (x1 - x0) / maps.shape[2])
+            centers[i][1] = float(y0 + refined_y * (y1 - y0) / maps.shape[1])
+        return centers
+
+    def generate_plot(
+        self,
+        imgs_seg,
+        result_img,
+        image,
+        environment_description_list,
+        plot_image_path=None,
+    ):
         num_plots = len(imgs_seg) + 2
 
         # Create a single figure with subplots
@@ -208,7 +358,7 @@ class Perception:
             a.axis("off")
 
         # Display the base image in the first subplot
-        ax[0].imshow(self.image)
+        ax[0].imshow(image)
         ax[0].set_title("Base Image", fontsize=14)
 
         # Display the result image in the last subplot
@@ -222,7 +372,7 @@ class Perception:
             ax[i + 1].axis("off")
 
             # Create a text annotation below the image
-            text = self.environment_description_list[i]
+            text = environment_description_list[i]
             wrapped_text = textwrap.fill(text, width=30)
             ax[i + 1].annotate(
                 wrapped_text,
@@ -236,35 +386,109 @@ class Perception:
             )
 
         # Manually adjust subplot parameters to reduce blank space
-        plt.subplots_adjust(
+        fig.subplots_adjust(
             left=0.05, right=0.95, top=0.85, bottom=0.2
         )  # Adjust margins to minimize blank space
 
         # Save the plot with tight bounding box to avoid excess white space
-        plt.savefig(self.plot_image_path, bbox_inches="tight", pad_inches=0.1)
+        fig.savefig(
+            plot_image_path or self.plot_image_path, bbox_inches="tight", pad_inches=0.1
+        )
         plt.show()
-        plt.close()
+        plt.close(fig)
+
+    def config(self) -> dict:
+        """Everything that changes the results for a given frame, part of the cache key."""
+        return {
+            "version": self.version,
+            "vlm_name": self.vlm_name,
+            "seg_model_name": self.seg_model_name,
+            "vlm_backend": self.vlm_backend,
+            "seg_backend": self.seg_backend,
+            "refine_segmentation": self.refine_segmentation,
+            "refine_max_area_fraction": self.refine_max_area_fraction,
+            "refine_window_margin": self.refine_window_margin,
+            "refine_min_window": self.refine_min_window,
+            "refine_score_ratio": self.refine_score_ratio,
+        }
 
-    def run(self, image):
+    def set_image(self, image):
         self.image = Image.fromarray(cv.cvtColor(image, cv.COLOR_BGR2RGB))
-        
-        # VLM
+        with trace("perception.frame_hash"):
+            self.cache_key = self.perception_cache.key(image, self.config())
+
+    def load_cached(self) -> bool:
+        """Same frame and configuration as a previous command: reuse its results."""
+        with trace("perception.cache_lookup") as span:
+            cached = self.perception_cache.get(self.cache_key)
+            span.set(hit=cached is not None)
+        if cached is None:
+            return False
+        print("Perception cache hit, skipping VLM and segmentation")
+        self.environment_description_list = cached["environment_description_list"]
+        self.environment_pos = cached["environment_pos"]
+        self.centers_location = [
+            self.environment_pos[item] for item in self.environment_description_list
+        ]
+        if self.incremental:
+            # No boxes in the cache, the tracker uses boxes around the centroids
+            self.scene_tracker.reset(self.image, self.environment_pos)
+        return True
+
+    def track(self) -> bool:
+        """Incremental mode: follow the objects of the last perception in the new frame."""
+        if not self.incremental:
+            return False
+        with trace("perception.track") as span:
+            environment_pos = self.scene_tracker.update(self.image)
+            span.set(tracked=environment_pos is not None)
+        if environment_pos is None:
+            print(
+                f"Scene tracking stopped ({self.scene_tracker.reason}), running the full perception"
+            )
+            return False
+        print("Scene tracked, skipping VLM and segmentation")
+        self.environment_pos = environment_pos
+        self.centers_location = [
+            self.environment_pos[item] for item in self.environment_description_list
+        ]
+        return True
+
+    def describe(self):
         print("Starting VLM")
-        vlm = VLM(self.vlm_name, self.image)
-        vlm_output = vlm.run()
-        torch.cuda.empty_cache()
+        with trace("vlm"), self.model_registry.use(self.vlm_name) as vlm:
+            vlm_output = vlm.run(self.image)
         self.environment_description_list = parse_vlm_output(vlm_output)
+        return self.environment_description_list
 
-        # Segmentation
+    def locate(self, activations=None):
         print("Starting Segmentation")
-        self.centers_location = self.segmentation()
+        with trace("segmentation"):
+            self.centers_location = self.segmentation(activations)
         self.environment_pos = {
             item: list(coord)
             for item, coord in zip(
                 self.environment_description_list, self.centers_location
             )
         }
+        self.perception_cache.put(
+            self.cache_key, self.environment_description_list, self.environment_pos
+        )
+        if self.incremental:
+            with trace("perception.track_reset"):
+                self.scene_tracker.reset(self.image, self.environment_pos, self.bboxes)
+        return self.environment_pos
+
+    def run(self, image):
+        self.set_image(image)
+        if self.load_cached() or self.track():
+            return self.environment_pos
+
+        # VLM
+        self.describe()
+
+        # Segmentation
+        self.locate()
 
         # Only return this now
         return self.environment_pos
-
@@ -0,0 +1,159 @@
+"""Content-addressed cache of the perception results.
+
+The key is a hash of the frame pixels and of the perception configuration
+(models and algorithm version), so a command on an unchanged scene skips the
+VLM, the segmentation and the centroid extraction. Results are kept in memory
+(LRU) and optionally in a folder as JSON files, to survive restarts.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+def frame_hash(frame) -> str:
+    """Hash of the pixels of a frame (numpy array or PIL image), shape and dtype included."""
+    frame = np.ascontiguousarray(np.asarray(frame))
+    digest = hashlib.sha256()
+    digest.update(f"{frame.shape}:{frame.dtype}".encode("utf-8"))
+    digest.update(frame.data)
+    return digest.hexdigest()
+
+
+def config_hash(config: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class PerceptionCache:
+    def __init__(self, max_entries: int = 64, cache_dir: str = None):
+        """
+        max_entries: number of scenes kept in memory.
+        cache_dir: folder of the on-disk store, None to only keep the results in memory.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()  # {key: result}, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, frame, config: dict) -> str:
+        return f"{frame_hash(frame)[:32]}-{config_hash(config)[:16]}"
+
+    def get(self, key: str):
+        """
+        Return a copy of the cached result, or None.
+        result: {"environment_description_list": [...], "environment_pos": {...}}
+        """
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+        if result is None:
+            result = self._read(key)
+            if result is not None:
+                self._put_memory(key, result)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self._copy(result)
+
+    def put(self, key: str, environment_description_list: list, environment_pos: dict):
+        result = self._copy(
+            {
+                "environment_description_list": environment_description_list,
+                "environment_pos": environment_pos,
+            }
+        )
+        self._put_memory(key, result)
+        self._write(key, result)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _put_memory(self, key: str, result: dict):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read(self, key: str):
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Perception cache: could not read {self._path(key)}: {e}")
+            return None
+
+    def _write(self, key: str, result: dict):
+        if not self.cache_dir:
+            return
+        # Write then rename, so a reader never sees a partial file
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Perception cache: could not write {self._path(key)}: {e}")
+
+    @staticmethod
+    def _copy(result: dict) -> dict:
+        return {
+            "environment_description_list": list(
+                result["environment_description_list"]
+            ),
+            "environment_pos": {
+                item: [float(c) for c in coord]
+                for item, coord in result["environment_pos"].items()
+            },
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_perception_cache(max_entries: int = None, cache_dir: str = None):
+    """
+    Return the process wide perception cache, creating it on first call.
+    Arguments left to None accept the existing cache, different ones raise ValueError.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PerceptionCache(
+                max_entries if max_entries is not None else 64, cache_dir
+            )
+            return _default_cache
+        if max_entries is not None and max_entries != _default_cache.max_entries:
+            raise ValueError(
+                f"The perception cache keeps {_default_cache.max_entries} scenes, "
+                f"{max_entries} requested"
+            )
+        if cache_dir is not None and (
+            _default_cache.cache_dir is None
+            or os.path.abspath(cache_dir) != os.path.abspath(_default_cache.cache_dir)
+        ):
+            stored = _default_cache.cache_dir or "memory only"
+            raise ValueError(
+                f"The perception cache is stored in {stored}, {cache_dir} requested"
+            )
+        return _default_cache
@@ -0,0 +1,129 @@
+"""Dependency graph of pipeline stages, run with the independent stages overlapped.
+
+A request is a list of stages, each with the names of the stages it depends on.
+The scheduler starts every stage as soon as its dependencies are done, on a thread
+pool, so e.g. model loading or the image encoding of the segmentation run while
+the VLM generates. It records when every stage ran and reports the critical path:
+the chain of dependent stages with the longest total time, which bounds the
+latency of the request.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import contextvars
+import time
+
+from src.tracing import trace
+
+
+class Stage:
+    def __init__(self, name: str, function, deps=()):
+        """
+        function: called with the results of the dependencies as keyword arguments
+        (one per dependency name), returns the result of the stage.
+        """
+        self.name = name
+        self.function = function
+        self.deps = tuple(deps)
+
+
+class PipelineRun:
+    """Results and timings of one run of a stage graph."""
+
+    def __init__(self, stages: dict):
+        self.stages = stages
+        self.results = {}
+        self.start = {}  # {stage name: start time, relative to the run start}
+        self.end = {}
+        self.total_time = 0.0
+
+    def duration(self, name: str) -> float:
+        return self.end[name] - self.start[name]
+
+    @property
+    def critical_path(self) -> list:
+        """
+        Stages bounding the latency: the chain of dependencies with the longest total
+        stage time, ending at the last stage to finish. With enough workers, the
+        latency of the request is the time of this chain.
+        """
+        if not self.end:
+            return []
+        longest = {}  # {stage name: (time of the longest chain ending at it, chain)}
+
+        def chain(name):
+            if name not in longest:
+                deps = [chain(dep) for dep in self.stages[name].deps if dep in self.end]
+                time_before, path = max(deps, default=(0.0, []))
+                longest[name] = (time_before + self.duration(name), path + [name])
+            return longest[name]
+
+        return chain(max(self.end, key=self.end.get))[1]
+
+    def report(self) -> str:
+        critical_path = self.critical_path
+        lines = [f"Pipeline stages (total {self.total_time:.2f}s):"]
+        for name in sorted(self.start, key=self.start.get):
+            marker = "*" if name in critical_path else " "
+            lines.append(
+                f"{marker} {name}: {self.start[name]:.2f}s -> {self.end[name]:.2f}s "
+                f"({self.duration(name):.2f}s)"
+            )
+        critical_time = sum(self.duration(name) for name in critical_path)
+        lines.append(
+            f"Critical path ({critical_time:.2f}s of stage time): "
+            + " -> ".join(critical_path)
+        )
+        return "\n".join(lines)
+
+
+class PipelineScheduler:
+    def __init__(self, max_workers: int = 4):
+        """max_workers: number of stages run at the same time, 1 runs them one by one."""
+        self.max_workers = max(1, max_workers)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="pipeline"
+        )
+
+    def run(self, stages: list) -> PipelineRun:
+        stages = {stage.name: stage for stage in stages}
+        for stage in stages.values():
+            for dep in stage.deps:
+                if dep not in stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown {dep}")
+
+        pipeline_run = PipelineRun(stages)
+        run_start = time.perf_counter()
+
+        def run_stage(stage):
+            pipeline_run.start[stage.name] = time.perf_counter() - run_start
+            try:
+                with trace(f"stage.{stage.name}"):
+                    return stage.function(
+                        **{dep: pipeline_run.results[dep] for dep in stage.deps}
+                    )
+            finally:
+                pipeline_run.end[stage.name] = time.perf_counter() - run_start
+
+        pending = dict(stages)
+        running = {}  # {future: stage name}
+        try:
+            while pending or running:
+                # Start every stage whose dependencies are done, in the given order
+                for name, stage in list(pending.items()):
+                    if all(dep in pipeline_run.results for dep in stage.deps):
+                        # The stage spans are children of the span running the graph
+                        context = contextvars.copy_context()
+                        future = self.executor.submit(context.run, run_stage, stage)
+                        running[future] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"Dependency cycle between {list(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # A failed stage fails the run, its error is raised here
+                    pipeline_run.results[running.pop(future)] = future.result()
+        finally:
+            # Don't leave stages running in the background of a failed run
+            wait(running)
+            pipeline_run.total_time = time.perf_counter() - run_start
+        return pipeline_run
@@ -0,0 +1,134 @@
+"""Constrained decoding of the LLM plans.
+
+The plan grammar is the format parsed by `parse_action_text`, one action per line:
+    action_name\\n                       (actions without parameters)
+    action_name: [object, object]\\n     (one object per parameter)
+with the action names of the robot and the objects of the scene only. Since both
+lists are finite, the grammar is the set of all the valid lines, stored as a
+character trie whose end of line goes back to its root (any number of lines).
+
+At each step, the logits processor only allows the tokens whose text continues a
+valid line (a token can span several lines), and the end of sequence tokens
+after a complete line. The response is always parsable, uses the exact names
+and stops as soon as the model ends the plan.
+"""
+
+import itertools
+
+import torch
+from transformers import LogitsProcessor
+
+from actions.action_registry import action_arity
+
+
+# Characters of the action format, names containing them can't be written in a plan
+FORMAT_CHARACTERS = (":", "[", "]", ",", "\n")
+
+
+class TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []  # Tokens ending here (token trie only)
+
+
+class TokenTrie:
+    """Text of every token of a tokenizer, as a character trie. Built once per LLM."""
+
+    def __init__(self, tokenizer):
+        self.root = TrieNode()
+        self.texts = {}  # {token id: text}
+        # Decode after a reference token, a leading space would be dropped otherwise
+        reference = tokenizer.encode("a", add_special_tokens=False)
+        reference_text = tokenizer.decode(reference)
+        special_ids = set(tokenizer.all_special_ids)
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                continue
+            text = tokenizer.decode(reference + [token_id])[len(reference_text) :]
+            # Empty or partial UTF-8 tokens can't be matched against the names
+            if not text or "�" in text:
+                continue
+            self.texts[token_id] = text
+            node = self.root
+            for character in text:
+                node = node.children.setdefault(character, TrieNode())
+            node.ids.append(token_id)
+
+
+class PlanGrammar:
+    def __init__(self, robot_actions: list, objects: list):
+        """robot_actions: "actions" of the robot json, objects: names of the objects of the scene."""
+        objects = [
+            name
+            for name in dict.fromkeys(objects)
+            if name and not any(c in name for c in FORMAT_CHARACTERS)
+        ]
+        self.lines = []
+        for action in robot_actions:
+            arity = action_arity(action)
+            if arity == 0:
+                self.lines.append(f"{action['name']}\n")
+                continue
+            # Different objects when the scene has enough of them
+            combinations = (
+                itertools.permutations(objects, arity)
+                if len(objects) >= arity
+                else itertools.product(objects, repeat=arity)
+            )
+            for combination in combinations:
+                self.lines.append(f"{action['name']}: [{', '.join(combination)}]\n")
+
+        # End of line goes back to the root: the trie accepts any number of lines
+        self.root = TrieNode()
+        for line in self.lines:
+            node = self.root
+            for character in line[:-1]:
+                node = node.children.setdefault(character, TrieNode())
+            node.children["\n"] = self.root
+
+    def allowed_tokens(self, token_trie: TokenTrie, node) -> list:
+        """Tokens whose text continues the grammar from `node`."""
+        allowed = []
+        stack = [(token_trie.root, node)]
+        while stack:
+            token_node, grammar_node = stack.pop()
+            for character, token_child in token_node.children.items():
+                grammar_child = grammar_node.children.get(character)
+                if grammar_child is not None:
+                    allowed += token_child.ids
+                    stack.append((token_child, grammar_child))
+        return allowed
+
+
+class PlanLogitsProcessor(LogitsProcessor):
+    """Masks the tokens leaving the plan grammar, for a batch of one sequence."""
+
+    def __init__(self, grammar: PlanGrammar, token_trie: TokenTrie, eos_ids):
+        self.grammar = grammar
+        self.token_trie = token_trie
+        self.eos_ids = list(eos_ids)
+        self.prompt_length = None
+        self.node = grammar.root
+        self.lines = 0
+        self.generated = 0  # Generated tokens already followed in the grammar
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        new_ids = input_ids[0, self.prompt_length + self.generated :].tolist()
+        for token_id in new_ids:
+            # Only allowed tokens were generated, the grammar can follow them
+            for character in self.token_trie.texts.get(token_id, ""):
+                self.node = self.node.children[character]
+                self.lines += character == "\n"
+        self.generated += len(new_ids)
+
+        allowed = self.grammar.allowed_tokens(self.token_trie, self.node)
+        # The plan can end after a complete line, or if the grammar is a dead end
+        if (self.node is self.grammar.root and self.lines) or not allowed:
+            allowed += self.eos_ids
+        mask = torch.full_like(scores, float("-inf"))
+        mask[:, allowed] = 0
+        return scores + mask
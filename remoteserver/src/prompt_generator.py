@@ -1,27 +1,52 @@
 from src.perception import Perception
+from src.tracing import trace
 
 
 class PromptGenerator:
-    def __init__(self, robot_info: dict):
+    def __init__(self, robot_info: dict, model_registry=None, perception_cache=None):
         self.robot_info = robot_info
         self.environment_prompt = ""  # Generated by the perception module (VLM)
         self.robot_prompt = f"Description of the robot:\n{self.robot_info['description']}\n\nList of Actions that the robot can do:\n{self.robot_action_to_readable_format()}"
         self.user_command = ""
         self.environment_description_list = None
+        # Robot description before the environment, for the LLMs reusing the key/value
+        # cache of the start of the prompt (see static_prompt)
+        self.robot_prompt_first = False
         # Initialize perception
-        self.perception = Perception()
+        self.perception = Perception(
+            model_registry=model_registry, perception_cache=perception_cache
+        )
 
     def run(self, user_input: str, image):
-        self.user_command = f"User Command:\n{user_input}"
+        self.set_user_command(user_input)
         # Run perception
-        self.environment_description_list = self.perception.run(image)
+        self.perception.run(image)
+        return self.build_prompt()
+
+    def set_user_command(self, user_input: str):
+        self.user_command = f"User Command:\n{user_input}"
+
+    def build_prompt(self):
+        """Prompt of the user command, once the perception has run."""
+        with trace("llm.prompt"):
+            return self._build_prompt()
+
+    def _build_prompt(self):
+        self.environment_description_list = self.perception.environment_pos
         environment_description = ", ".join(self.environment_description_list)
         self.environment_prompt = f"Environment Description:\n{environment_description}"
-        prompt = "\n\n".join(
-            [self.environment_prompt, self.robot_prompt, self.user_command, "Solution:"]
-        )
+        sections = [self.environment_prompt, self.robot_prompt]
+        if self.robot_prompt_first:
+            # Same for every command, so the LLM reuses its key/value cache
+            sections.reverse()
+        prompt = "\n\n".join([*sections, self.user_command, "Solution:"])
         return prompt
 
+    @property
+    def static_prompt(self) -> str:
+        """Start of every prompt of the robot when robot_prompt_first, before the environment and the command."""
+        return f"{self.robot_prompt}\n\n"
+
     def robot_action_to_readable_format(self):
         actions = self.robot_info["actions"]
         result = "\n"
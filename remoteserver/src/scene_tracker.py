@@ -0,0 +1,210 @@
+"""Incremental perception between two commands on a fixed camera.
+
+The frame of the last full perception (VLM + segmentation) is kept as a keyframe,
+with the box and a few feature points of every object. On the next frame:
+- the changed regions are found by differencing the two frames,
+- objects untouched by any change are carried forward as they are,
+- objects touched by a change are followed with sparse optical flow (pyramidal
+  Lucas-Kanade, forward-backward checked), their centroid moves with the median
+  displacement of their points,
+- the change must be explained by the tracked objects (their old and new box).
+
+The full perception has to run again (update returns None) when an object can't
+be tracked with enough confidence, a change appears elsewhere (object added or
+removed, hand in the scene), too much of the frame changed (lighting, camera
+moved), or after `max_tracked_frames` frames to bound the drift.
+Large objects (table, background) are carried forward and never explain a change.
+"""
+
+import cv2 as cv
+import numpy as np
+
+
+class TrackedObject:
+    def __init__(self, position, bbox, points):
+        self.position = position  # [x, y, z] in frame pixels, like environment_pos
+        self.bbox = bbox  # [min_x, min_y, max_x, max_y] in frame pixels
+        self.points = points  # (N, 1, 2) float32 feature points, in tracking pixels
+
+
+class SceneTracker:
+    def __init__(self):
+        self.max_side = 640  # Frames are tracked at this resolution at most
+        self.max_points = 40  # Feature points per object
+        self.min_points = 4  # Fewer tracked points than this: track lost
+        self.min_confidence = 0.5  # Fraction of the points of an object to track
+        self.max_flow_error = 1.0  # Forward-backward error of a point, in pixels
+        self.diff_threshold = 20  # Gray level difference of a changed pixel
+        self.min_change_area = 0.001  # Smaller changes are noise, in frame fraction
+        self.max_change_area = 0.25  # Larger changes: the whole scene changed
+        self.max_object_area = 0.25  # Larger objects are background, in frame fraction
+        self.explained_margin = 0.2  # Margin around the boxes of moved objects
+        self.max_unexplained = 0.2  # Fraction of a change allowed outside them
+        self.max_tracked_frames = 30
+
+        self.keyframe = None
+        self.objects = {}
+        self.tracked_frames = 0
+        self.reason = "no keyframe"  # Why the last update failed
+
+    def prepare(self, image):
+        """Blurred grayscale frame at the tracking resolution, and its scale."""
+        image = np.asarray(image)
+        gray = cv.cvtColor(image, cv.COLOR_RGB2GRAY) if image.ndim == 3 else image
+        scale = min(1.0, self.max_side / max(gray.shape))
+        if scale < 1.0:
+            gray = cv.resize(
+                gray, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA
+            )
+        return cv.GaussianBlur(gray, (5, 5), 0), scale
+
+    def is_background(self, bbox) -> bool:
+        height, width = self.keyframe.shape
+        area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) * self.scale**2
+        return area > self.max_object_area * width * height
+
+    def box(self, bbox, margin: float = 0.0):
+        """Box in tracking pixels, clipped to the frame."""
+        height, width = self.keyframe.shape
+        min_x, min_y, max_x, max_y = (np.asarray(bbox) * self.scale).tolist()
+        dx, dy = margin * (max_x - min_x), margin * (max_y - min_y)
+        return (
+            int(max(min_x - dx, 0)),
+            int(max(min_y - dy, 0)),
+            int(min(np.ceil(max_x + dx), width)),
+            int(min(np.ceil(max_y + dy), height)),
+        )
+
+    def features(self, bbox):
+        min_x, min_y, max_x, max_y = self.box(bbox)
+        mask = np.zeros_like(self.keyframe)
+        mask[min_y:max_y, min_x:max_x] = 255
+        points = cv.goodFeaturesToTrack(
+            self.keyframe, self.max_points, 0.01, 3, mask=mask
+        )
+        if points is None:
+            return np.empty((0, 1, 2), np.float32)
+        return points.astype(np.float32)
+
+    def reset(self, image, environment_pos: dict, bboxes: dict = None):
+        """
+        New keyframe, after a full perception.
+        bboxes: {name: [min_x, min_y, max_x, max_y]}, a box of a tenth of the frame
+        around the centroid for the objects without one.
+        """
+        self.keyframe, self.scale = self.prepare(image)
+        self.tracked_frames = 0
+        self.objects = {}
+        height, width = self.keyframe.shape
+        half_side = 0.05 * min(width, height) / self.scale
+        for name, position in environment_pos.items():
+            bbox = (bboxes or {}).get(name)
+            if bbox is None:
+                x, y = position[0], position[1]
+                bbox = [x - half_side, y - half_side, x + half_side, y + half_side]
+            self.objects[name] = TrackedObject(list(position), list(bbox), None)
+            self.objects[name].points = self.features(bbox)
+
+    def track(self, gray, tracked_object):
+        """Displacement (dx, dy) in frame pixels and tracked points, or None."""
+        points = tracked_object.points
+        if len(points) < self.min_points:
+            return None
+        new_points, status, _ = cv.calcOpticalFlowPyrLK(
+            self.keyframe, gray, points, None, winSize=(21, 21), maxLevel=4
+        )
+        back_points, back_status, _ = cv.calcOpticalFlowPyrLK(
+            gray, self.keyframe, new_points, None, winSize=(21, 21), maxLevel=4
+        )
+        error = np.linalg.norm((back_points - points).reshape(-1, 2), axis=1)
+        good = (
+            (status.ravel() == 1)
+            & (back_status.ravel() == 1)
+            & (error < self.max_flow_error)
+        )
+        if good.sum() < max(self.min_points, self.min_confidence * len(points)):
+            return None
+        displacement = np.median((new_points - points).reshape(-1, 2)[good], axis=0)
+        return displacement / self.scale, new_points[good]
+
+    def update(self, image):
+        """New environment_pos of the objects in `image`, or None if the full perception must run."""
+        if self.keyframe is None:
+            self.reason = "no keyframe"
+            return None
+        if self.tracked_frames >= self.max_tracked_frames:
+            self.reason = (
+                f"{self.tracked_frames} frames tracked since the last perception"
+            )
+            return None
+        gray, scale = self.prepare(image)
+        if gray.shape != self.keyframe.shape:
+            self.reason = "frame size changed"
+            return None
+
+        changed = (cv.absdiff(gray, self.keyframe) > self.diff_threshold).astype(
+            np.uint8
+        )
+        changed = cv.morphologyEx(changed, cv.MORPH_OPEN, np.ones((3, 3), np.uint8))
+        frame_area = changed.size
+        if changed.sum() > self.max_change_area * frame_area:
+            self.reason = f"{100 * changed.mean():.0f}% of the frame changed"
+            return None
+        count, labels, stats, _ = cv.connectedComponentsWithStats(changed)
+        changes = [
+            label
+            for label in range(1, count)
+            if stats[label, cv.CC_STAT_AREA] >= self.min_change_area * frame_area
+        ]
+
+        # Follow the objects touched by a change
+        explained = np.zeros_like(changed)
+        moved = {}
+        for name, tracked_object in self.objects.items():
+            if self.is_background(tracked_object.bbox):
+                continue
+            min_x, min_y, max_x, max_y = self.box(tracked_object.bbox)
+            touched = np.isin(labels[min_y:max_y, min_x:max_x], changes).any()
+            if not touched:
+                continue
+            result = self.track(gray, tracked_object)
+            if result is None:
+                self.reason = f"lost track of {name}"
+                return None
+            (dx, dy), points = result
+            new_bbox = [
+                tracked_object.bbox[0] + dx,
+                tracked_object.bbox[1] + dy,
+                tracked_object.bbox[2] + dx,
+                tracked_object.bbox[3] + dy,
+            ]
+            moved[name] = (dx, dy, new_bbox, points)
+            for bbox in (tracked_object.bbox, new_bbox):
+                min_x, min_y, max_x, max_y = self.box(bbox, self.explained_margin)
+                explained[min_y:max_y, min_x:max_x] = 1
+
+        # Every change must come from a tracked object
+        for label in changes:
+            region = labels == label
+            unexplained = np.count_nonzero(region & (explained == 0))
+            if unexplained > self.max_unexplained * stats[label, cv.CC_STAT_AREA]:
+                x, y = stats[label, cv.CC_STAT_LEFT], stats[label, cv.CC_STAT_TOP]
+                self.reason = f"new change at ({x / scale:.0f}, {y / scale:.0f})"
+                return None
+
+        # The frame becomes the keyframe, the moved objects take their new place
+        self.keyframe = gray
+        self.tracked_frames += 1
+        for name, (dx, dy, new_bbox, points) in moved.items():
+            tracked_object = self.objects[name]
+            tracked_object.position[0] += float(dx)
+            tracked_object.position[1] += float(dy)
+            tracked_object.bbox = new_bbox
+            tracked_object.points = (
+                points if len(points) >= self.min_points else self.features(new_bbox)
+            )
+        self.reason = None
+        return {
+            name: list(tracked_object.position)
+            for name, tracked_object in self.objects.items()
+        }
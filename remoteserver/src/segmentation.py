@@ -0,0 +1,142 @@
+"""CLIPSeg segmentation engine.
+
+The CLIP vision encoder is the expensive part of CLIPSeg, the decoder is light.
+Instead of feeding the same frame once per text prompt, the engine encodes the
+frame once and decodes all the text prompts against it in a single batch. Text
+embeddings are cached by prompt, since the same object names come up often.
+"""
+
+from collections import OrderedDict
+import threading
+
+import torch
+from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
+
+from src.inference_backend import InferenceBackend
+from src.tracing import trace
+
+
+class SegmentationEngine:
+    def __init__(self, processor, model, text_cache_size: int = 256):
+        self.processor = processor
+        self.model = model
+        self.text_cache_size = text_cache_size
+        self.text_cache = OrderedDict()  # {text: embedding}, least recently used first
+        self.text_cache_lock = threading.Lock()
+        self.text_cache_hits = 0
+        self.text_cache_misses = 0
+
+    @classmethod
+    def from_pretrained(
+        cls, seg_model_name: str, text_cache_size: int = 256, backend=None
+    ):
+        """backend: device and precision of the model, cpu-fp32 by default."""
+        backend = backend if backend is not None else InferenceBackend("cpu-fp32")
+        processor = CLIPSegProcessor.from_pretrained(seg_model_name)
+        model = backend.load(
+            lambda dtype: CLIPSegForImageSegmentation.from_pretrained(
+                seg_model_name, torch_dtype=dtype
+            ),
+            f"Segmentation model {seg_model_name}",
+        )
+        return cls(processor, model, text_cache_size)
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    @property
+    def dtype(self):
+        # Floating point parameters: the int8 layers have no parameters, the others stay fp32
+        return next(self.model.parameters()).dtype
+
+    def encode_image(self, image) -> list:
+        """
+        Run the vision encoder once and return the activations used by the decoder.
+        `image` can also be a list of images, encoded in one batch.
+        """
+        with trace("segmentation.preprocess"):
+            pixel_values = self.processor.image_processor(
+                images=image, return_tensors="pt"
+            ).pixel_values.to(self.device, self.dtype)
+        with trace("segmentation.encode_image"), torch.no_grad():
+            vision_outputs = self.model.clip.vision_model(
+                pixel_values=pixel_values, output_hidden_states=True
+            )
+        hidden_states = vision_outputs.hidden_states
+        # +1 because the hidden states also include the initial embeddings
+        return [hidden_states[i + 1] for i in self.model.extract_layers]
+
+    def encode_texts(self, texts: list) -> torch.Tensor:
+        """
+        Return the conditional embeddings of the texts, only encoding the ones not cached.
+        """
+        embeddings = {}
+        with self.text_cache_lock:
+            for text in texts:
+                if text in embeddings:
+                    continue
+                if text in self.text_cache:
+                    self.text_cache.move_to_end(text)
+                    embeddings[text] = self.text_cache[text]
+                    self.text_cache_hits += 1
+                else:
+                    embeddings[text] = None
+                    self.text_cache_misses += 1
+        missing = [text for text, embedding in embeddings.items() if embedding is None]
+
+        if missing:
+            text_inputs = self.processor.tokenizer(
+                missing, padding="max_length", return_tensors="pt"
+            ).to(self.device)
+            with trace(
+                "segmentation.encode_texts", texts=len(missing)
+            ), torch.no_grad():
+                text_outputs = self.model.clip.text_model(
+                    input_ids=text_inputs["input_ids"],
+                    attention_mask=text_inputs["attention_mask"],
+                )
+                text_embeddings = self.model.clip.text_projection(
+                    text_outputs.pooler_output
+                )
+            with self.text_cache_lock:
+                for text, embedding in zip(missing, text_embeddings):
+                    embeddings[text] = embedding
+                    self.text_cache[text] = embedding
+                    self.text_cache.move_to_end(text)
+                while len(self.text_cache) > self.text_cache_size:
+                    self.text_cache.popitem(last=False)
+
+        return torch.stack([embeddings[text] for text in texts])
+
+    def decode(self, activations: list, text_embeddings: torch.Tensor) -> torch.Tensor:
+        """
+        Decode every text embedding against the activations of one image, or each
+        text embedding against the activations of its own image for a batch of images.
+        Returns logits of shape (len(text_embeddings), height, width).
+        """
+        batch_size = text_embeddings.shape[0]
+        if activations[0].shape[0] == 1:
+            # Broadcast the single image activations to the batch without copying them
+            activations = [a.expand(batch_size, -1, -1) for a in activations]
+        with trace("segmentation.decode", texts=batch_size), torch.no_grad():
+            logits = self.model.decoder(activations, text_embeddings).logits
+        # float: the maps are converted to numpy, which has no bfloat16
+        return logits.reshape(batch_size, *logits.shape[-2:]).float()
+
+    def run(self, image, texts: list, activations=None) -> torch.Tensor:
+        """activations: output of encode_image(image) if it was already computed."""
+        if not texts:
+            return torch.empty(0)
+        if activations is None:
+            activations = self.encode_image(image)
+        text_embeddings = self.encode_texts(texts)
+        return self.decode(activations, text_embeddings)
+
+    def run_crops(self, crops: list, texts: list) -> torch.Tensor:
+        """Segment each text in its own crop, all the crops being encoded in one batch."""
+        if not crops:
+            return torch.empty(0)
+        activations = self.encode_image(list(crops))
+        text_embeddings = self.encode_texts(texts)
+        return self.decode(activations, text_embeddings)
@@ -0,0 +1,260 @@
+"""Per-stage latency tracing.
+
+Every stage of a command runs in a span (`with trace("vlm.generate"):`). Spans
+nest: a span started inside another one (in the same thread, or in a pipeline
+stage started by it) is its child and shares its trace ID, so the spans of one
+command can be found together. Finished spans are:
+- aggregated per name into latency histograms (p50/p95/p99 over the recent spans,
+  cumulative buckets for Prometheus),
+- optionally appended to a JSON lines file, one span per line,
+- dumped on demand in the Prometheus text format.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+# Span currently running in this thread / task
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent, attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = 0.0
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+            "thread": threading.current_thread().name,
+        }
+
+
+class LatencyHistogram:
+    def __init__(self, window: int = 1024):
+        """window: number of recent durations kept for the percentiles."""
+        self.recent = deque(maxlen=window)
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.recent.append(duration)
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Tracer:
+    def __init__(self, jsonl_path: str = None, window: int = 1024):
+        """
+        jsonl_path: file where every finished span is appended, None to only keep the histograms.
+        window: number of recent spans per name used for the percentiles.
+        """
+        self.jsonl_path = jsonl_path
+        self.window = window
+        self.histograms = {}  # {span name: LatencyHistogram}
+        self.errors = {}  # {span name: number of failed spans}
+        self.lock = threading.Lock()
+        self.set_jsonl_path(jsonl_path)
+
+    def set_jsonl_path(self, jsonl_path: str):
+        if jsonl_path:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        self.jsonl_path = jsonl_path
+
+    @contextmanager
+    def span(self, name: str, nest: bool = True, **attributes):
+        """
+        nest: the spans started inside are children of this one. Use False for a span
+        around the yields of a generator, the caller's spans would nest in it otherwise.
+        """
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span) if nest else None
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            if token is not None:
+                _current_span.reset(token)
+            self.record(span)
+
+    def record(self, span: Span):
+        with self.lock:
+            if span.name not in self.histograms:
+                self.histograms[span.name] = LatencyHistogram(self.window)
+            self.histograms[span.name].add(span.duration)
+            if span.error is not None:
+                self.errors[span.name] = self.errors.get(span.name, 0) + 1
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a") as f:
+                        f.write(json.dumps(span.to_dict(), default=str) + "\n")
+                except OSError as e:
+                    print(f"Tracing: could not write {self.jsonl_path}: {e}")
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                name: {**histogram.summary(), "errors": self.errors.get(name, 0)}
+                for name, histogram in sorted(self.histograms.items())
+            }
+
+    def report(self) -> str:
+        lines = ["Stage latencies (s):"]
+        for name, s in self.summary().items():
+            lines.append(
+                f"- {name}: n={s['count']} p50={s['p50']:.3f} p95={s['p95']:.3f} "
+                f"p99={s['p99']:.3f} max={s['max']:.3f} errors={s['errors']}"
+            )
+        return "\n".join(lines)
+
+    def prometheus(self, prefix: str = "svlr") -> str:
+        """Histograms and percentiles in the Prometheus text exposition format."""
+        metric = f"{prefix}_stage_duration_seconds"
+        lines = [
+            f"# HELP {metric} Latency of the pipeline stages.",
+            f"# TYPE {metric} histogram",
+        ]
+        quantile_lines = [
+            f"# HELP {metric}_quantile Recent latency percentiles of the pipeline stages.",
+            f"# TYPE {metric}_quantile gauge",
+        ]
+        error_lines = [
+            f"# HELP {prefix}_stage_errors_total Failed pipeline stages.",
+            f"# TYPE {prefix}_stage_errors_total counter",
+        ]
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                label = f'stage="{name}"'
+                for bound, count in zip(
+                    BUCKETS, itertools.accumulate(histogram.bucket_counts)
+                ):
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum{{{label}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+                for q in (50, 95, 99):
+                    quantile_lines.append(
+                        f'{metric}_quantile{{{label},quantile="{q / 100}"}} '
+                        f"{histogram.percentile(q)}"
+                    )
+                error_lines.append(
+                    f"{prefix}_stage_errors_total{{{label}}} {self.errors.get(name, 0)}"
+                )
+        return "\n".join(lines + quantile_lines + error_lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        # Write then rename, so a scraper never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.errors.clear()
+
+
+_default_tracer = None
+_default_tracer_lock = threading.Lock()
+
+
+def get_tracer(jsonl_path: str = None) -> Tracer:
+    """
+    Return the process wide tracer, creating it on first call.
+    jsonl_path, if given, is set on a tracer without one; a different path raises ValueError.
+    """
+    global _default_tracer
+    with _default_tracer_lock:
+        if _default_tracer is None:
+            _default_tracer = Tracer(jsonl_path)
+        elif jsonl_path:
+            if _default_tracer.jsonl_path is None:
+                _default_tracer.set_jsonl_path(jsonl_path)
+            elif os.path.abspath(jsonl_path) != os.path.abspath(
+                _default_tracer.jsonl_path
+            ):
+                raise ValueError(
+                    f"The spans are written to {_default_tracer.jsonl_path}, "
+                    f"{jsonl_path} requested"
+                )
+        return _default_tracer
+
+
+def trace(name: str, nest: bool = True, **attributes):
+    """Span of the process wide tracer: `with trace("vlm.generate"):`."""
+    return get_tracer().span(name, nest, **attributes)
+
+
+def current_span():
+    return _current_span.get()
@@ -4,34 +4,43 @@ import torchvision.transforms as T
 from torchvision.transforms.functional import InterpolationMode
 import time
 
+from src.vlm_preprocess import VLMPreprocessor, target_ratios
+from src.inference_backend import InferenceBackend
+from src.tracing import trace
+
 
 class VLM:
-    def __init__(self, vlm_name: str, image):
+    def __init__(self, vlm_name: str, image=None, backend: InferenceBackend = None):
+        """backend: device and precision of the model, cuda-fp16 on a GPU, cpu-bf16 otherwise by default."""
 
         self.IMAGENET_MEAN = (0.485, 0.456, 0.406)
         self.IMAGENET_STD = (0.229, 0.224, 0.225)
 
-        print(
-            f"VLM {vlm_name} runs on {torch.device('cuda' if torch.cuda.is_available() else 'cpu')}"
-        )
-        self.model = (
-            AutoModel.from_pretrained(
+        self.backend = backend if backend is not None else InferenceBackend()
+        self.model = self.backend.load(
+            lambda dtype: AutoModel.from_pretrained(
                 vlm_name,
-                torch_dtype=torch.float16,
+                torch_dtype=dtype,
                 low_cpu_mem_usage=True,
                 trust_remote_code=True,
-            )
-            .eval()
-            .cuda()
+            ),
+            f"VLM {vlm_name}",
         )
 
         self.tokenizer = AutoTokenizer.from_pretrained(vlm_name, trust_remote_code=True)
 
-        self.image = image
+        self.image = None
         self.image_size = 448  # image will be resized to (image_size x image_size) for fast processing
-
-        # set the max number of tiles in `max_num`
-        self.pixel_values = self.load_image(max_num=6).to(torch.float16).cuda()
+        self.max_num = 6  # max number of tiles
+        self.preprocessor = VLMPreprocessor(
+            image_size=self.image_size,
+            max_num=self.max_num,
+            mean=self.IMAGENET_MEAN,
+            std=self.IMAGENET_STD,
+        )
+        self.pixel_values = None
+        if image is not None:
+            self.set_image(image)
 
         # Test param modifications
         self.generation_config = dict(
@@ -44,14 +53,30 @@ class VLM:
 
         self.prompt = "List the objects, with only one object per line"
 
-    def run(self):
+    def set_image(self, image):
+        self.image = image
+        self.pixel_values = self.preprocess(image)
+
+    def preprocess(self, image):
+        with trace("vlm.preprocess"):
+            return self.preprocessor(
+                image, device=self.backend.device, dtype=self.backend.dtype
+            )
+
+    def run(self, image=None):
+        """
+        The model is loaded once and can be reused for several images, pass the image
+        here rather than to the constructor to share a VLM between requests.
+        """
+        pixel_values = self.pixel_values if image is None else self.preprocess(image)
         # single-round single-image conversation
         start = time.time()
-        response = self.model.chat(
-            self.tokenizer, self.pixel_values, self.prompt, self.generation_config
-        )
+        with trace("vlm.generate", backend=self.backend.name):
+            response = self.model.chat(
+                self.tokenizer, pixel_values, self.prompt, self.generation_config
+            )
         end = time.time()
-        print(f"VLM Inference time = {end - start}s")
+        print(f"VLM Inference time ({self.backend.name}) = {end - start}s")
         print(f"VLM Prompt = {self.prompt}")
         print(f"VLM Response = {response}")
         return response
@@ -86,23 +111,14 @@ class VLM:
                     best_ratio = ratio
         return best_ratio
 
-    def dynamic_preprocess(self, min_num=1, max_num=6, use_thumbnail=False):
-        orig_width, orig_height = self.image.size
+    def dynamic_preprocess(self, image=None, min_num=1, max_num=6, use_thumbnail=False):
+        image = self.image if image is None else image
+        orig_width, orig_height = image.size
         aspect_ratio = orig_width / orig_height
 
-        # calculate the existing image aspect ratio
-        target_ratios = set(
-            (i, j)
-            for n in range(min_num, max_num + 1)
-            for i in range(1, n + 1)
-            for j in range(1, n + 1)
-            if i * j <= max_num and i * j >= min_num
-        )
-        target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-        # find the closest aspect ratio to the target
+        # find the closest aspect ratio to the target (ratio table computed once)
         target_aspect_ratio = self.find_closest_aspect_ratio(
-            aspect_ratio, target_ratios, orig_width, orig_height
+            aspect_ratio, target_ratios(min_num, max_num), orig_width, orig_height
         )
 
         # calculate the target width and height
@@ -111,7 +127,7 @@ class VLM:
         blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
 
         # resize the image
-        resized_img = self.image.resize((target_width, target_height))
+        resized_img = image.resize((target_width, target_height))
         processed_images = []
         for i in range(blocks):
             box = (
@@ -125,13 +141,14 @@ class VLM:
             processed_images.append(split_img)
         assert len(processed_images) == blocks
         if use_thumbnail and len(processed_images) != 1:
-            thumbnail_img = self.image.resize((self.image_size, self.image_size))
+            thumbnail_img = image.resize((self.image_size, self.image_size))
             processed_images.append(thumbnail_img)
         return processed_images
 
-    def load_image(self, max_num=6):
+    def load_image(self, image=None, max_num=6):
+        """PIL reference implementation of the preprocessing, see VLMPreprocessor for the fast one."""
         transform = self.build_transform()
-        images = self.dynamic_preprocess(use_thumbnail=True, max_num=max_num)
+        images = self.dynamic_preprocess(image, use_thumbnail=True, max_num=max_num)
         pixel_values = [transform(image) for image in images]
         pixel_values = torch.stack(pixel_values)
         return pixel_values
@@ -0,0 +1,179 @@
+"""Buffered, rotating JSON lines log, written by a background thread.
+
+`write` only puts the record in a queue, so the caller (the receive loop of the
+main PC client) never waits for the disk. The thread writes the records in
+batches and rotates the file when it gets larger than `max_bytes`:
+log.jsonl -> log.jsonl.1 -> ... -> log.jsonl.<backups>, the oldest is removed.
+
+fsync policy, what survives a power loss:
+- "none": the OS writes the file when it wants (fastest),
+- "batch": every batch is synced to the disk,
+- "interval": synced at most every `fsync_interval` seconds.
+
+Only uses the standard library, so the main PC can import it as well.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+
+FSYNC_POLICIES = ("none", "batch", "interval")
+
+
+class ActionLogWriter:
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+        fsync: str = "interval",
+        fsync_interval: float = 1.0,
+        batch_size: int = 256,
+        flush_interval: float = 0.2,
+        max_queue: int = 10000,
+    ):
+        """
+        max_bytes: size of a file before rotation, 0 to never rotate.
+        batch_size, flush_interval: records are written when a batch is full or after this time.
+        max_queue: records waiting to be written, the next ones are dropped (and counted).
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(
+                f"Unknown fsync policy {fsync}, expected one of {FSYNC_POLICIES}"
+            )
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.file = None
+        self.last_fsync = time.monotonic()
+
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self.run, name="action_log_writer", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, record: dict):
+        """Queue a record, never blocks."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "ab")
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self.open()
+
+    def write_batch(self, records: list):
+        data = b"".join(
+            (json.dumps(record) + "\n").encode("utf-8") for record in records
+        )
+        size = self.file.tell()
+        if self.max_bytes and size and size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        now = time.monotonic()
+        if self.fsync == "batch" or (
+            self.fsync == "interval" and now - self.last_fsync >= self.fsync_interval
+        ):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+        self.written += len(records)
+        self.batches += 1
+
+    def run(self):
+        self.open()
+        stop = False
+        while not stop:
+            records = []
+            deadline = time.monotonic() + self.flush_interval
+            # Wait for a first record, then gather a batch until it is full or too old
+            while len(records) < self.batch_size:
+                timeout = deadline - time.monotonic() if records else None
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                records.append(record)
+            if records:
+                try:
+                    self.write_batch(records)
+                except OSError as e:
+                    print(f"Could not write the action log {self.path}: {e}")
+        if self.fsync != "none":
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def close(self):
+        """Write the queued records and stop the thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def report(self) -> str:
+        return (
+            f"Action log {self.path}: {self.written} records in {self.batches} batches, "
+            f"{self.rotations} rotations, {self.dropped} dropped"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_action_log(path: str, rotated: bool = True):
+    """Records of a log, oldest first, with its rotated files when `rotated`."""
+    paths = []
+    if rotated:
+        index = 1
+        while os.path.exists(f"{path}.{index}"):
+            paths.append(f"{path}.{index}")
+            index += 1
+        paths.reverse()
+    paths.append(path)
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
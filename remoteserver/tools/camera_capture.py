@@ -0,0 +1,354 @@
+"""Persistent camera capture.
+
+The device is opened once and read continuously by a background thread, so the
+exposure has settled and a fresh frame is ready when a command comes in. Frames
+are written into a ring of preallocated buffers; `latest()` hands out the most
+recent one as a read-only view, without copying. A frame is pinned while it is
+held (`with capture.latest() as frame:`), the thread never overwrites it and
+writes into the next free buffer instead.
+
+Sources:
+- VideoDeviceSource: V4L / USB camera through cv2.VideoCapture,
+- FileSource: video file, image or folder of images, replayed at a given frame
+  rate (tests and replays without hardware),
+- RosSource: sensor_msgs/Image topic.
+"""
+
+import glob
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class VideoDeviceSource:
+    def __init__(self, device="/dev/video2", width: int = 1920, height: int = 1080):
+        self.device = device
+        self.capture = cv2.VideoCapture(device)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open video device {device}")
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        # Only keep the newest frame in the driver, the thread reads them all anyway
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def read(self, out=None):
+        """Read the next frame into `out` (allocated when None), return it or None."""
+        ok, frame = self.capture.read(out)
+        if not ok:
+            return None
+        if out is not None and frame is not out:
+            if frame.shape != out.shape:
+                return None
+            np.copyto(out, frame)
+            return out
+        return frame
+
+    def release(self):
+        self.capture.release()
+
+
+class FileSource:
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+    def __init__(self, path: str, fps: float = 30.0, loop: bool = True):
+        """
+        path: video file, image, or folder of images (resized to the size of the first one).
+        fps: replay rate like a camera, 0 to read as fast as possible.
+        """
+        self.path = path
+        self.period = 1.0 / fps if fps > 0 else 0.0
+        self.loop = loop
+        self.next_time = 0.0
+        self.images = None
+        self.video = None
+        if os.path.isdir(path):
+            paths = sorted(
+                p
+                for p in glob.glob(os.path.join(path, "*"))
+                if p.lower().endswith(self.IMAGE_EXTENSIONS)
+            )
+            self.images = [
+                image for image in map(cv2.imread, paths) if image is not None
+            ]
+        elif path.lower().endswith(self.IMAGE_EXTENSIONS):
+            self.images = [cv2.imread(path)] if cv2.imread(path) is not None else []
+        else:
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise RuntimeError(f"Could not open video file {path}")
+        if self.images is not None and not self.images:
+            raise RuntimeError(f"No image found in {path}")
+        self.position = 0
+
+    def wait(self):
+        # Pace the frames like a camera
+        if self.period:
+            now = time.perf_counter()
+            if self.next_time > now:
+                time.sleep(self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.period
+
+    def read(self, out=None):
+        self.wait()
+        if self.images is not None:
+            if self.position >= len(self.images):
+                if not self.loop:
+                    return None
+                self.position = 0
+            image = self.images[self.position]
+            self.position += 1
+            if out is None:
+                return image.copy()
+            if image.shape != out.shape:
+                return cv2.resize(image, out.shape[1::-1], dst=out)
+            np.copyto(out, image)
+            return out
+
+        ok, frame = self.video.read(out)
+        if not ok and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.video.read(out)
+        if not ok:
+            return None
+        if out is not None and frame is not out:
+            np.copyto(out, frame)
+            return out
+        return frame
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+
+class RosSource:
+    def __init__(self, topic: str = "/camera/image_raw"):
+        import rospy
+        from sensor_msgs.msg import Image
+        from cv_bridge import CvBridge
+
+        init_ros_node()
+        self.bridge = CvBridge()
+        self.message = None
+        self.condition = threading.Condition()
+        self.subscriber = rospy.Subscriber(topic, Image, self.on_image, queue_size=1)
+
+    def on_image(self, message):
+        with self.condition:
+            self.message = message
+            self.condition.notify_all()
+
+    def read(self, out=None, timeout: float = 5.0):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.message is not None, timeout):
+                return None
+            message, self.message = self.message, None
+        frame = self.bridge.imgmsg_to_cv2(message, "bgr8")
+        if out is None:
+            return frame
+        if frame.shape != out.shape:
+            return None
+        np.copyto(out, frame)
+        return out
+
+    def release(self):
+        self.subscriber.unregister()
+
+
+_ros_node_lock = threading.Lock()
+_ros_node_initialized = False
+
+
+def init_ros_node():
+    """rospy.init_node can only be called once per process."""
+    global _ros_node_initialized
+    import rospy
+
+    with _ros_node_lock:
+        if not _ros_node_initialized:
+            rospy.init_node(
+                "svlr_image_subsriber_node", anonymous=True, disable_signals=True
+            )
+            _ros_node_initialized = True
+
+
+class Frame:
+    """Latest frame of a capture: `image` is a read-only view of its ring buffer slot."""
+
+    def __init__(self, capture, slot: int, index: int, timestamp: float):
+        self.capture = capture
+        self.slot = slot
+        self.index = index  # Number of the frame since the capture started
+        self.timestamp = timestamp  # time.time() when the frame was read
+        self.image = capture.frames[slot].view()
+        self.image.flags.writeable = False
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.capture.unpin(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class CameraCapture:
+    def __init__(self, source, buffer_size: int = 4, warmup_frames: int = 0):
+        """
+        buffer_size: number of preallocated frames, at least 2 (one being written, the latest).
+        warmup_frames: frames read and dropped at start, while the exposure settles.
+        """
+        self.source = source
+        self.buffer_size = max(2, buffer_size)
+        self.warmup_frames = warmup_frames
+        self.frames = (
+            None  # (buffer_size, height, width, 3), allocated on the first frame
+        )
+        self.pins = [0] * self.buffer_size  # Number of readers holding each slot
+        self.timestamps = [0.0] * self.buffer_size
+        self.indexes = [0] * self.buffer_size
+        self.latest_slot = None
+        self.writing_slot = None
+        self.index = 0
+        self.dropped = 0  # Frames dropped because every slot was held
+        self.errors = 0
+        self.start_time = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        first = self.source.read()
+        if first is None:
+            raise RuntimeError("Could not read the first frame of the camera")
+        for _ in range(self.warmup_frames):
+            first = self.source.read(first)
+        self.frames = np.empty((self.buffer_size,) + first.shape, dtype=first.dtype)
+        self.scratch = np.empty_like(first)  # Written when every slot is held
+        self.start_time = time.time()
+        self.publish(0, first)
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name="camera_capture", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def publish(self, slot: int, image=None):
+        with self.condition:
+            if image is not None:
+                np.copyto(self.frames[slot], image)
+            self.index += 1
+            self.indexes[slot] = self.index
+            self.timestamps[slot] = time.time()
+            self.latest_slot = slot
+            self.writing_slot = None
+            self.condition.notify_all()
+
+    def next_slot(self):
+        """Free slot to write the next frame in: not the latest one, not held by a reader."""
+        with self.condition:
+            for offset in range(1, self.buffer_size):
+                slot = (self.latest_slot + offset) % self.buffer_size
+                if self.pins[slot] == 0:
+                    self.writing_slot = slot
+                    return slot
+            return None
+
+    def run(self):
+        while self.running:
+            slot = self.next_slot()
+            # The driver is read even if every slot is held, to never get old frames
+            out = self.frames[slot] if slot is not None else self.scratch
+            try:
+                frame = self.source.read(out)
+            except Exception as e:
+                print(f"Camera capture error: {e}")
+                frame = None
+            if frame is None:
+                with self.condition:
+                    self.writing_slot = None
+                    self.errors += 1
+                time.sleep(0.01)
+                continue
+            if slot is None:
+                with self.condition:
+                    self.dropped += 1
+                continue
+            self.publish(slot)
+
+    def latest(self, newer_than: float = None, timeout: float = 2.0) -> Frame:
+        """
+        Pin and return the latest frame, without copy. Release it (or use `with`) when done.
+        newer_than: wait for a frame read after this time.time(), e.g. the time of the command.
+        """
+        with self.condition:
+            if newer_than is not None:
+                ready = self.condition.wait_for(
+                    lambda: self.timestamps[self.latest_slot] > newer_than, timeout
+                )
+                if not ready:
+                    raise TimeoutError(f"No camera frame in the last {timeout}s")
+            slot = self.latest_slot
+            self.pins[slot] += 1
+            return Frame(self, slot, self.indexes[slot], self.timestamps[slot])
+
+    def unpin(self, slot: int):
+        with self.condition:
+            self.pins[slot] -= 1
+
+    def read(self, newer_than: float = None) -> np.ndarray:
+        """Copy of the latest frame, for callers that keep it."""
+        with self.latest(newer_than) as frame:
+            return frame.image.copy()
+
+    def fps(self) -> float:
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        return self.index / elapsed if elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return (
+            f"Camera capture: {self.index} frames ({self.fps():.1f} fps), "
+            f"{self.dropped} dropped, {self.errors} read errors"
+        )
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.source.release()
+
+
+_captures = {}
+_captures_lock = threading.Lock()
+
+
+def get_camera_capture(key, source_factory, buffer_size: int = 4) -> CameraCapture:
+    """
+    Return the running capture of `key` (device, topic or file), starting it on first call.
+    A different buffer_size than the running capture's raises ValueError.
+    """
+    with _captures_lock:
+        capture = _captures.get(key)
+        if capture is None:
+            capture = CameraCapture(source_factory(), buffer_size).start()
+            _captures[key] = capture
+        elif max(2, buffer_size) != capture.buffer_size:
+            raise ValueError(
+                f"The capture of {key} has {capture.buffer_size} buffers, "
+                f"{buffer_size} requested"
+            )
+        return capture
+
+
+def stop_camera_captures():
+    with _captures_lock:
+        for capture in _captures.values():
+            capture.stop()
+        _captures.clear()
@@ -0,0 +1,115 @@
+"""Batched pixel to robot base transform, shared by the remote server and the main PC.
+
+A pixel (u, v) is undistorted, converted to normalized camera coordinates with the
+camera intrinsics, scaled by the depth, then moved to the robot base frame with a
+rotation and a translation:
+
+    robot = R @ (depth * [(u - cx) / fx, (v - cy) / fy, 1]) + T
+
+Every step is done for all the points at once. When the camera has distortion,
+the undistorted normalized coordinates of every pixel of the image can be
+precomputed, the undistortion of a point is then a bilinear lookup in that grid.
+
+Only depends on numpy (and OpenCV for the distortion), so the main PC can import it as well.
+"""
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class PixelToRobotTransform:
+    def __init__(
+        self,
+        camera_matrix,
+        rotation,
+        translation,
+        depth: float = 1.0,
+        dist_coeffs=None,
+        image_size=None,
+    ):
+        """
+        camera_matrix: (3, 3) intrinsics (no skew).
+        rotation, translation: camera to robot base transform, (3, 3) and (3,).
+        depth: depth of the points whose depth is not given.
+        dist_coeffs: OpenCV distortion coefficients (k1, k2, p1, p2, k3), None for no distortion.
+        image_size: (width, height), needed by precompute_undistortion.
+        """
+        self.camera_matrix = np.asarray(camera_matrix, dtype=float).reshape(3, 3)
+        self.rotation = np.asarray(rotation, dtype=float).reshape(3, 3)
+        self.translation = np.asarray(translation, dtype=float).reshape(3)
+        self.depth = depth
+        self.dist_coeffs = (
+            np.zeros(5)
+            if dist_coeffs is None
+            else np.asarray(dist_coeffs, dtype=float).ravel()
+        )
+        self.has_distortion = bool(np.any(self.dist_coeffs))
+        self.image_size = image_size
+        self.fx, self.fy = self.camera_matrix[0, 0], self.camera_matrix[1, 1]
+        self.cx, self.cy = self.camera_matrix[0, 2], self.camera_matrix[1, 2]
+        self.undistortion_grid = None  # (H, W, 2) normalized coordinates of each pixel
+
+    def precompute_undistortion(self):
+        """Undistort every pixel of the image once, points are then undistorted by a lookup."""
+        if not self.has_distortion:
+            return self
+        if self.image_size is None:
+            raise ValueError("image_size is needed to precompute the undistortion")
+        width, height = self.image_size
+        u, v = np.meshgrid(np.arange(width), np.arange(height))
+        pixels = np.stack([u, v], axis=-1).reshape(-1, 1, 2).astype(np.float64)
+        normalized = cv2.undistortPoints(pixels, self.camera_matrix, self.dist_coeffs)
+        self.undistortion_grid = normalized.reshape(height, width, 2)
+        return self
+
+    def normalize(self, pixels: np.ndarray) -> np.ndarray:
+        """(N, 2) pixels to (N, 2) undistorted normalized camera coordinates."""
+        if not self.has_distortion:
+            return (pixels - (self.cx, self.cy)) / (self.fx, self.fy)
+        if self.undistortion_grid is None:
+            return cv2.undistortPoints(
+                pixels.reshape(-1, 1, 2), self.camera_matrix, self.dist_coeffs
+            ).reshape(-1, 2)
+        return self.lookup(pixels)
+
+    def lookup(self, pixels: np.ndarray) -> np.ndarray:
+        """Bilinear interpolation of the undistortion grid, points outside are clamped to the border."""
+        height, width = self.undistortion_grid.shape[:2]
+        u = np.clip(pixels[:, 0], 0, width - 1)
+        v = np.clip(pixels[:, 1], 0, height - 1)
+        u0 = np.minimum(np.floor(u).astype(int), width - 2)
+        v0 = np.minimum(np.floor(v).astype(int), height - 2)
+        du = (u - u0)[:, None]
+        dv = (v - v0)[:, None]
+        grid = self.undistortion_grid
+        top = grid[v0, u0] * (1 - du) + grid[v0, u0 + 1] * du
+        bottom = grid[v0 + 1, u0] * (1 - du) + grid[v0 + 1, u0 + 1] * du
+        return top * (1 - dv) + bottom * dv
+
+    def pixels_to_camera(self, pixels) -> np.ndarray:
+        """
+        pixels: (N, 2) array of (u, v), or (N, 3) array of (u, v, depth).
+        Return the (N, 3) positions in the camera frame.
+        """
+        pixels = np.asarray(pixels, dtype=float).reshape(-1, np.shape(pixels)[-1])
+        if pixels.shape[1] == 3:
+            depth = pixels[:, 2:3]
+        else:
+            depth = self.depth
+        camera = np.empty((len(pixels), 3))
+        camera[:, :2] = self.normalize(pixels[:, :2])
+        camera[:, 2] = 1.0
+        return camera * depth
+
+    def camera_to_robot(self, camera_positions: np.ndarray) -> np.ndarray:
+        return camera_positions @ self.rotation.T + self.translation
+
+    def __call__(self, pixels) -> np.ndarray:
+        """(N, 2) or (N, 3) pixels to (N, 3) positions in the robot base frame."""
+        if len(pixels) == 0:
+            return np.empty((0, 3))
+        return self.camera_to_robot(self.pixels_to_camera(pixels))
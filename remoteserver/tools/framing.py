@@ -0,0 +1,161 @@
+"""Framed message protocol between the remote server and the main PC.
+
+Every message is sent as one frame:
+
+    | magic "SV" (2 bytes) | version (1 byte) | encoding (1 byte) | length (4 bytes) | payload |
+
+The length is the payload size in bytes, big endian. The payload is JSON, or
+msgpack (more compact, optional dependency) when both sides have it installed.
+FrameDecoder accepts the bytes in any chunking (partial frames, several frames
+in one recv) and returns complete messages only. After an invalid header the
+stream is out of sync, the connection has to be closed.
+
+Only depends on the standard library, so the main PC can import it as well.
+"""
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MAGIC = b"SV"
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+HEADER = struct.Struct("!2sBBI")
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+ENCODINGS = {"json": ENCODING_JSON, "msgpack": ENCODING_MSGPACK}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_payload(message, encoding: int) -> bytes:
+    if encoding == ENCODING_JSON:
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+    if encoding == ENCODING_MSGPACK:
+        if msgpack is None:
+            raise ProtocolError(
+                "msgpack encoding requested but msgpack is not installed"
+            )
+        return msgpack.packb(message, use_bin_type=True)
+    raise ProtocolError(f"Unknown encoding: {encoding}")
+
+
+def decode_payload(payload: bytes, encoding: int):
+    try:
+        if encoding == ENCODING_JSON:
+            return json.loads(payload.decode("utf-8"))
+        if encoding == ENCODING_MSGPACK:
+            if msgpack is None:
+                raise ProtocolError(
+                    "Received a msgpack message but msgpack is not installed"
+                )
+            return msgpack.unpackb(payload, raw=False)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Invalid payload: {e}") from e
+    raise ProtocolError(f"Unknown encoding: {encoding}")
+
+
+def encode_message(message, encoding="json") -> bytes:
+    """Return the frame (header + payload) of a message. encoding: "json" or "msgpack"."""
+    encoding = ENCODINGS.get(encoding, encoding)
+    payload = encode_payload(message, encoding)
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Message too large: {len(payload)} bytes")
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, encoding, len(payload)) + payload
+
+
+def send_message(conn, message, encoding="json"):
+    conn.sendall(encode_message(message, encoding))
+
+
+class FrameDecoder:
+    """Incremental decoder: feed it the received bytes, get back the complete messages.
+
+    An invalid payload only drops its frame (its length is known), the error is
+    kept in `errors` and the next frames are still decoded. An invalid header
+    means the stream can't be followed anymore: the decoder stops, `error` is
+    set and the connection should be closed.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.messages_decoded = 0
+        self.bytes_decoded = 0
+        self.frames_dropped = 0
+        self.errors = []  # Invalid frames of the last feed
+        self.error = None  # Fatal error, the decoder is closed
+
+    def feed(self, data: bytes) -> list:
+        """Messages completed by the data, including the ones before an error."""
+        if self.error is not None:
+            raise ProtocolError(f"Decoder closed after an error: {self.error}")
+        self.buffer += data
+        self.errors = []
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            magic, version, encoding, length = HEADER.unpack_from(self.buffer, offset)
+            if magic != MAGIC:
+                self.close(ProtocolError(f"Invalid frame header: {bytes(magic)!r}"))
+                break
+            if version not in SUPPORTED_VERSIONS:
+                self.close(ProtocolError(f"Unsupported protocol version: {version}"))
+                break
+            if length > MAX_PAYLOAD_SIZE:
+                self.close(ProtocolError(f"Message too large: {length} bytes"))
+                break
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break  # Partial frame, wait for more data
+            payload = bytes(self.buffer[offset + HEADER.size : end])
+            try:
+                messages.append(decode_payload(payload, encoding))
+            except ProtocolError as e:
+                # Drop the invalid frame, the next ones can still be decoded
+                self.errors.append(e)
+                self.frames_dropped += 1
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+            self.bytes_decoded += offset
+            self.messages_decoded += len(messages)
+        if self.error is not None:
+            self.buffer.clear()
+        return messages
+
+    def close(self, error: ProtocolError):
+        self.error = error
+        self.errors.append(error)
+
+    @property
+    def pending(self) -> int:
+        """Number of bytes of an incomplete frame waiting for more data."""
+        return len(self.buffer)
+
+
+def recv_messages(conn, buffer_size: int = 65536):
+    """Yield the messages received on a socket until the connection is closed."""
+    decoder = FrameDecoder()
+    while True:
+        data = conn.recv(buffer_size)
+        if not data:
+            if decoder.pending:
+                raise ProtocolError(
+                    f"Connection closed in the middle of a frame ({decoder.pending} bytes)"
+                )
+            return
+        messages = decoder.feed(data)
+        for error in decoder.errors:
+            print(f"Dropped an invalid message: {error}")
+        yield from messages
+        if decoder.error is not None:
+            raise decoder.error
@@ -1,47 +1,55 @@
-import cv2
+from tools.camera_capture import (
+    FileSource,
+    RosSource,
+    VideoDeviceSource,
+    get_camera_capture,
+)
 
 
 def get_camera_image(device="/dev/video2", width=1920, height=1080):
-    # Open the video device
-    cap = cv2.VideoCapture(device)
-
-    if not cap.isOpened():
-        print(f"Error: Could not open video device {device}")
-        return None
-
-    # Set the desired resolution
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-
-    # Capture a single frame
-    ret, frame = cap.read()
-
-    # Release the video device
-    cap.release()
-
-    if not ret:
-        print("Error: Could not read frame from video device")
+    """Latest frame of the device, kept open by a background capture thread."""
+    try:
+        capture = get_camera_capture(
+            (device, width, height), lambda: VideoDeviceSource(device, width, height)
+        )
+    except RuntimeError as e:
+        print(f"Error: {e}")
         return None
-
-    return frame
+    return capture.read()
 
 
 def get_camera_image_ros(topic="/camera/image_raw"):
-    import rospy
-    from sensor_msgs.msg import Image
-    from cv_bridge import CvBridge
-
-    rospy.init_node("svlr_image_subsriber_node", anonymous=True)
-
+    """Latest frame of the topic, the node and the subscriber are created once."""
     try:
-        image_msg = rospy.wait_for_message(topic, Image)
-    except Exception as e:
-        rospy.logerr(f"Error getting the image on topic : {topic}, {e}")
+        capture = get_camera_capture(topic, lambda: RosSource(topic))
+    except RuntimeError as e:
+        print(f"Error getting the image on topic : {topic}, {e}")
         return None
-
-    cv_image = CvBridge().imgmsg_to_cv2(image_msg, "bgr8")
-
-    cv2.imshow("Captured Image", cv_image)
-    cv2.waitKey(0)
-
-    return cv_image
+    return capture.read()
+
+
+def get_file_image(path, fps=30.0):
+    """Latest frame of a video file or folder of images replayed like a camera."""
+    capture = get_camera_capture(path, lambda: FileSource(path, fps))
+    return capture.read()
+
+
+def open_camera_capture(args, buffer_size=4):
+    """Capture of the camera of the command line: --camera_file, --camera_topic or --camera_device."""
+    if args.camera_file:
+        return get_camera_capture(
+            args.camera_file,
+            lambda: FileSource(args.camera_file, args.camera_fps),
+            buffer_size,
+        )
+    if args.camera_topic:
+        return get_camera_capture(
+            args.camera_topic, lambda: RosSource(args.camera_topic), buffer_size
+        )
+    return get_camera_capture(
+        (args.camera_device, args.camera_width, args.camera_height),
+        lambda: VideoDeviceSource(
+            args.camera_device, args.camera_width, args.camera_height
+        ),
+        buffer_size,
+    )
@@ -1,16 +1,12 @@
 import os
 import json
 
+from tools.robot_profile import get_robot_profile
+
 
 def read_robot_json(robot_name: str) -> dict:
-    path = os.path.join(
-        os.path.dirname(os.path.dirname(__file__)),
-        "actions",
-        f"{robot_name}_action.json",
-    )
-    with open(path, "r") as f:
-        robot_info = json.load(f)
-    return robot_info
+    """Mutable copy of the robot profile, see tools.robot_profile for the shared read-only one."""
+    return get_robot_profile(robot_name).to_dict()
 
 
 def read_llm_prompt_json(llm_name: str) -> str:
@@ -0,0 +1,150 @@
+"""Robot profile (actions/<robot>_action.json) and camera calibration (calibration.yaml),
+loaded once and shared by the tools and the actions.
+
+The objects are immutable, so they can be shared between threads. The files are
+reloaded when their modification time changes, so they can still be edited while
+the server runs. The modification time is checked at most every
+`CHECK_INTERVAL` seconds, the action expansion doesn't do any file I/O otherwise.
+"""
+
+from types import MappingProxyType
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import yaml
+
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALIBRATION_PATH = os.path.join(ROOT_PATH, "calibration.yaml")
+CHECK_INTERVAL = 1.0  # seconds
+
+
+def robot_json_path(robot_name: str) -> str:
+    return os.path.join(ROOT_PATH, "actions", f"{robot_name}_action.json")
+
+
+def freeze(value):
+    """Read-only copy of a parsed JSON/YAML document: dicts become mappings, lists tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def unfreeze(value):
+    """Mutable copy of a frozen document, same as the parsed file."""
+    if isinstance(value, MappingProxyType):
+        return {key: unfreeze(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [unfreeze(item) for item in value]
+    return value
+
+
+class RobotProfile:
+    def __init__(self, info: dict):
+        self.info = freeze(info)
+        self.robot_name = self.info["robot_name"]
+        self.init_pose = self.info["init_pose"]["pos_end_effector"]
+        self.gripper_open = self.info["gripper"]["open"]
+        self.gripper_close = self.info["gripper"]["close"]
+        self.eye_to_hand = self.info["eye_to_hand"]
+        self.actions = self.info["actions"]
+        self.action_names = tuple(action["name"] for action in self.actions)
+        # {action name: module of the actions folder}
+        self.programs = MappingProxyType(
+            {action["name"]: action["program"] for action in self.actions}
+        )
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("RobotProfile is immutable")
+        super().__setattr__(name, value)
+
+    def to_dict(self) -> dict:
+        return unfreeze(self.info)
+
+
+class Calibration:
+    def __init__(self, data: dict):
+        camera_matrix = np.array(data["camera_matrix"]["data"], dtype=float).reshape(
+            3, 3
+        )
+        camera_matrix.setflags(write=False)
+        self.data = freeze(data)
+        self.camera_matrix = camera_matrix
+        self.fx = float(camera_matrix[0][0])
+        self.fy = float(camera_matrix[1][1])
+        self.cx = float(camera_matrix[0][2])
+        self.cy = float(camera_matrix[1][2])
+        self.dist_coeffs = tuple(
+            data.get("distortion_coefficients", {}).get("data", ())
+        )
+        self.image_size = (data.get("image_width"), data.get("image_height"))
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("Calibration is immutable")
+        super().__setattr__(name, value)
+
+
+class FileCache:
+    """Objects built from files, rebuilt when the file modification time changes."""
+
+    def __init__(self, check_interval: float = CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.entries = {}  # {path: (mtime, last check time, object)}
+        self.lock = threading.Lock()
+
+    def get(self, path: str, build):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and now - entry[1] < self.check_interval:
+            return entry[2]
+
+        mtime = os.stat(path).st_mtime_ns
+        if entry is not None and entry[0] == mtime:
+            obj = entry[2]
+        else:
+            if entry is not None:
+                print(f"{path} changed, reloading it")
+            obj = build(path)
+        with self.lock:
+            self.entries[path] = (mtime, now, obj)
+        return obj
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_file_cache = FileCache()
+
+
+def _load_robot_profile(path: str) -> RobotProfile:
+    with open(path, "r") as f:
+        return RobotProfile(json.load(f))
+
+
+def _load_calibration(path: str) -> Calibration:
+    with open(path, "r") as f:
+        return Calibration(yaml.safe_load(f))
+
+
+def get_robot_profile(robot_name: str) -> RobotProfile:
+    return _file_cache.get(robot_json_path(robot_name), _load_robot_profile)
+
+
+def get_calibration() -> Calibration:
+    try:
+        return _file_cache.get(CALIBRATION_PATH, _load_calibration)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"File {CALIBRATION_PATH} not found, please calibrate the camera, and add the calibration.yaml file at the root of the project."
+        ) from None
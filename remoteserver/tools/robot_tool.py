@@ -1,38 +1,25 @@
-from tools.read_json import read_robot_json
+from tools.robot_profile import get_robot_profile, get_calibration
+from tools.camera_transform import PixelToRobotTransform
 
-import yaml
+import functools
 import numpy as np
-import os
 
 
 def pixel_to_camera_coordinates(robot_name: str, pixel_pose: list) -> list:
-    robot_info = read_robot_json(robot_name)
+    robot_profile = get_robot_profile(robot_name)
     # Depth of the object in meters
-    depth = robot_info["eye_to_hand"]["depth"]
+    depth = robot_profile.eye_to_hand["depth"]
 
     pose = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]  # [x, y, z, rx, ry, rz, rw]
-    data = {"camera_matrix": {"data": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]}}
-    yaml_path = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calibration.yaml"
-    )
-    # Check if the file exists
-    if not os.path.exists(yaml_path):
-        raise FileNotFoundError(
-            f"File {yaml_path} not found, please calibrate the camera, and add the calibration.yaml file at the root of the project."
-        )
-
-    with open(yaml_path, "r") as f:
-        data = yaml.safe_load(f)
-
-    camera_matrix = np.array(data["camera_matrix"]["data"], dtype=float).reshape(3, 3)
+    calibration = get_calibration()
 
     # Example pixel coordinates of the object in the image
     u = pixel_pose[0]  # example x pixel coordinates
     v = pixel_pose[1]  # example y pixel coordinates
 
     # Convert pixel coordinates to normalized image coordinates
-    x_norm = (u - camera_matrix[0][2]) / camera_matrix[0][0]
-    y_norm = (v - camera_matrix[1][2]) / camera_matrix[1][1]
+    x_norm = (u - calibration.cx) / calibration.fx
+    y_norm = (v - calibration.cy) / calibration.fy
 
     # Direction vector in camera coordinates
     direction_vector = np.array([x_norm, y_norm, 1], dtype=float)
@@ -45,18 +32,15 @@ def pixel_to_camera_coordinates(robot_name: str, pixel_pose: list) -> list:
 
 
 def camera_to_robot(robot_name: str, camera_pose: list) -> list:
-    robot_info = read_robot_json(robot_name)
-    robot_init_pose = robot_info["init_pose"]["pos_end_effector"]
+    robot_profile = get_robot_profile(robot_name)
+    robot_init_pose = robot_profile.init_pose
+    eye_to_hand = robot_profile.eye_to_hand
     robot_pose = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]  # [x, y, z, rx, ry, rz, rw]
     # Convert the camera pose to robot pose
-    robot_pose[0] = (
-        camera_pose[0] + robot_init_pose[0] + robot_info["eye_to_hand"]["dx"]
-    )  # x
-    robot_pose[1] = (
-        -camera_pose[1] + robot_init_pose[1] + robot_info["eye_to_hand"]["dy"]
-    )  # y
+    robot_pose[0] = camera_pose[0] + robot_init_pose[0] + eye_to_hand["dx"]  # x
+    robot_pose[1] = -camera_pose[1] + robot_init_pose[1] + eye_to_hand["dy"]  # y
     # For the moment we fix the Z manually (no depth with camera), so we keep the same Z
-    robot_pose[2] = camera_pose[2] + robot_info["eye_to_hand"]["dz"]  # z
+    robot_pose[2] = camera_pose[2] + eye_to_hand["dz"]  # z
 
     # Copy the orientation from the robot initial pose
     robot_pose[3:] = robot_init_pose[3:]
@@ -64,7 +48,40 @@ def camera_to_robot(robot_name: str, camera_pose: list) -> list:
     return robot_pose
 
 
+@functools.lru_cache(maxsize=8)
+def robot_transform(robot_profile, calibration) -> PixelToRobotTransform:
+    """
+    Transform of pixel_to_camera_coordinates + camera_to_robot, built once per
+    robot profile and calibration (new objects when the files change).
+    """
+    eye_to_hand = robot_profile.eye_to_hand
+    robot_init_pose = robot_profile.init_pose
+    transform = PixelToRobotTransform(
+        calibration.camera_matrix,
+        rotation=np.diag([1.0, -1.0, 1.0]),
+        translation=[
+            robot_init_pose[0] + eye_to_hand["dx"],
+            robot_init_pose[1] + eye_to_hand["dy"],
+            eye_to_hand["dz"],
+        ],
+        depth=eye_to_hand["depth"],
+        dist_coeffs=calibration.dist_coeffs or None,
+        image_size=calibration.image_size,
+    )
+    if transform.has_distortion and None not in calibration.image_size:
+        transform.precompute_undistortion()
+    return transform
+
+
+def pixels_to_robot(robot_name: str, pixel_poses) -> list:
+    """Batch version of pixel_to_robot: (N, 2) pixels to a list of N robot poses."""
+    robot_profile = get_robot_profile(robot_name)
+    transform = robot_transform(robot_profile, get_calibration())
+    positions = transform(np.asarray(pixel_poses, dtype=float).reshape(-1, 2))
+    # Copy the orientation from the robot initial pose
+    orientation = list(robot_profile.init_pose[3:])
+    return [position + orientation for position in positions.tolist()]
+
+
 def pixel_to_robot(robot_name: str, pixel_pose: list) -> list:
-    camera_pose = pixel_to_camera_coordinates(robot_name, pixel_pose)
-    robot_pose = camera_to_robot(robot_name, camera_pose)
-    return robot_pose
+    return pixels_to_robot(robot_name, [pixel_pose[:2]])[0]
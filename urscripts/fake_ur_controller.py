@@ -0,0 +1,141 @@
+'''
+HMI2 Lab
+Fake UR controller, to test the URScript connection on a plain Linux box without a robot.
+
+Key functionality:
+- Listens on the primary port like the controller, accepts several clients.
+- Streams robot state messages to the clients, like the real port does. Only the robot mode
+  data is filled: a received program is reported running for `program_time` seconds.
+- Records every received script: a whole "def ... end" program or a single line.
+- Can drop its connections, to test the reconnection of the clients.
+
+Usage: python fake_ur_controller.py --port 30001
+'''
+
+import argparse
+import socket
+import threading
+import time
+
+class FakeURController:
+    def __init__(self, host="127.0.0.1", port=0, state_interval=0.1, program_time=0.0):
+        """
+        port: 0 picks a free port, read it from self.port.
+        state_interval: seconds between two state messages, 0 to send none.
+        program_time: seconds a received program runs, as reported in the robot state.
+        """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(8)
+        self.host, self.port = self.server.getsockname()
+        self.state_interval = state_interval
+        self.program_time = program_time
+        self.program_end = 0.0
+        self.scripts = [] #Received scripts, in order
+        self.connections = 0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = True
+        threading.Thread(target=self.accept, name="fake_ur_accept", daemon=True).start()
+
+    def accept(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                break
+            with self.lock:
+                self.connections += 1
+                self.clients.append(client)
+            threading.Thread(target=self.receive, args=(client,), daemon=True).start()
+            if self.state_interval:
+                threading.Thread(target=self.send_state, args=(client,), daemon=True).start()
+
+    def state_message(self):
+        #Robot mode data sub package: timestamp, then connected, enabled, power on, e-stop, protective stop, program running
+        running = time.time() < self.program_end
+        mode_data = int(time.time() * 1000).to_bytes(8, "big") + bytes([1, 1, 1, 0, 0, int(running)])
+        package = (5 + len(mode_data)).to_bytes(4, "big") + bytes([0]) + mode_data
+        #Length and type header of a robot state message
+        return (5 + len(package)).to_bytes(4, "big") + bytes([16]) + package
+
+    def send_state(self, client):
+        try:
+            while self.running:
+                client.sendall(self.state_message())
+                time.sleep(self.state_interval)
+        except OSError:
+            pass
+
+    def receive(self, client):
+        buffer = ""
+        program = None
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                buffer += data.decode("utf-8")
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    #Lines of a program are kept until its "end"
+                    if program is not None:
+                        program.append(line)
+                        if line.strip() == "end":
+                            self.program_end = time.time() + self.program_time
+                            self.record("\n".join(program) + "\n")
+                            program = None
+                    elif line.startswith("def "):
+                        program = [line]
+                    elif line.strip():
+                        self.record(line + "\n")
+        except OSError:
+            pass
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def record(self, script):
+        with self.condition:
+            self.scripts.append(script)
+            self.condition.notify_all()
+        print(f"Fake UR controller received:\n{script}", end="")
+
+    def wait_for_scripts(self, count, timeout=5.0):
+        """Waits until `count` scripts were received, returns them."""
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.scripts) >= count, timeout)
+            return list(self.scripts)
+
+    def drop_connections(self):
+        """Closes every client connection, like a controller restart."""
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+
+    def close(self):
+        self.running = False
+        self.drop_connections()
+        self.server.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake UR controller recording the received URScript")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=30001)
+    parser.add_argument("--program_time", type=float, default=2.0, help="Seconds a received program is reported running")
+    args = parser.parse_args()
+    controller = FakeURController(args.host, args.port, program_time=args.program_time)
+    print(f"Fake UR controller listening on {controller.host}:{controller.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        controller.close()
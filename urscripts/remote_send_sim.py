@@ -8,23 +8,33 @@ to the robot controller.
 
 Key functionality:
 - Maintains a socket client connection to the perception server.
-- Parses incoming JSON actions, data, and filters duplicates.
+- Parses incoming framed JSON actions (see remoteserver/tools/framing.py), data, and filters duplicates.
 - Translates end effector positions into robot base frame coordinates
 - Translates gripper values into human-readable "open"/"close" states.
-- Saves received actions to a JSONL log file for replay or debugging.
+- Saves received actions to a rotating JSONL log file, written by a background thread,
+  for replay (see replay_actions.py) or debugging.
 - Uses camera intrinsics and extrinsics to transform 2D image pixel coordinates 
   (u, v, depth) into 3D positions in the robot’s base frame.
 - Prints raw and transformed centroid data for validation and debugging.
-- Interfaces with the robot controller.
+- Interfaces with the robot controller. With --upload_programs, the poses of every message are
+  uploaded as URScript programs, honouring the move and blend radius of compiled waypoints.
 '''
 
+import argparse
 import socket
-import json
+import sys
 from datetime import datetime
 import numpy as np
 import cv2
 import os
-from ur_rcv_sim import send_named_command  
+
+#Framed message protocol shared with the remote server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "remoteserver"))
+from tools.framing import FrameDecoder, send_message
+#Batched pixel to robot base transform shared with the remote server
+from tools.camera_transform import PixelToRobotTransform
+#Background writer of the received actions log
+from tools.action_log import ActionLogWriter
 
 #Camera Matrix via Camera Calibration.
 K = np.array([
@@ -49,111 +59,169 @@ R_camera_to_base = np.array([
 #T_camera_to_base = np.array([0.158, 0.957, 0.600])  # meters, SIM
 T_camera_to_base = np.array([0.160, 1.030, 0.416])  # meters, REAL
 
-#Undistort pixels according to distortion matrix.
-def undistort_pixel(u, v):
-    points = np.array([[[u, v]]], dtype=np.float32)
-    undistorted = cv2.undistortPoints(points, K, dist_coeffs, P=K)
-    return undistorted[0][0]  # Returns (u', v')
-
-#Transforms a pixel to camera frame
-def pixel_to_camera_frame(u, v, depth=1.0):
-    pixel = np.array([u, v, 1.0])
-    cam_coords = K_inv @ pixel
-    return (cam_coords * depth).tolist()
-#Transforms camera to robot frame
-def camera_to_robot_frame(cam_coords):
-    return (R_camera_to_base @ np.array(cam_coords) + T_camera_to_base).tolist()
+#measured depth from robot to object. Currently flat
+z_m = .42
+
+#Undistorts, transforms to the camera frame then to the robot base frame, all the centroids at once.
+#The undistortion of every pixel is precomputed, a centroid is then a table lookup.
+pixel_transform = PixelToRobotTransform(
+    K, R_camera_to_base, T_camera_to_base, depth=z_m, dist_coeffs=dist_coeffs, image_size=image_size
+).precompute_undistortion()
+
+#Transforms pixels (N, 2) to the robot base frame (N, 3)
+def pixels_to_robot_frame(pixels):
+    return pixel_transform(pixels).tolist()
+
+#Processes the actions received from the remote server: translation, duplicate filtering, log, robot and centroids.
+#Used by the client and by the replay tool, so a recorded log goes through the same path.
+class ActionHandler:
+    def __init__(self, action_log=None, send_command=None, send_waypoints=None):
+        #action_log: ActionLogWriter of the received actions, None to not log them
+        self.action_log = action_log
+        #Robot driver, connected on first use (ur_rcv_sim connects to the gripper when imported)
+        if send_command is None:
+            from ur_rcv_sim import send_named_command as send_command
+        self.send_command = send_command
+        #send_waypoints: uploads the pose waypoints of a message as programs (ur_rcv_sim.send_waypoints_as_program),
+        #with their move and blend radius. None to only send the named commands.
+        self.send_waypoints = send_waypoints
+        self.waypoints = [] #Pose waypoints of the message being handled
+        self.gripper = None #Last gripper value sent with the waypoints, None when unknown
+        self.last_action_no_timestamp = None
+        self.actions = [] #Actions sent to the robot
+
+    #Handles the actions of a message, then uploads its pose waypoints. Returns the number of actions sent.
+    def handle_message(self, action_data):
+        #Transforms into a readable dictionary
+        if isinstance(action_data, dict):
+            action_data = [action_data]
+        handled = sum(self.handle(action_dict) for action_dict in action_data)
+        self.flush_waypoints()
+        return handled
+
+    #Uploads the pose waypoints handled so far, the robot runs them before the next command
+    def flush_waypoints(self):
+        if self.waypoints:
+            waypoints, self.waypoints = self.waypoints, []
+            #A message continues the previous one: its first waypoint may be blended, and an
+            #unchanged gripper value is not sent again
+            self.gripper = self.send_waypoints(waypoints, gripper=self.gripper)
+
+    #Returns True if the action was sent to the robot, False if it was a duplicate
+    def handle(self, action_dict):
+        #Prints action from the remote server before parsing.
+        print(f"\nRaw action received: {action_dict}")
+        #Gets the end effector position key
+        pose_cmd = action_dict.get("pos_end_effector")
+        #Uploaded as it was received: pose, gripper value, move and blend radius
+        upload = self.send_waypoints is not None and isinstance(pose_cmd, list)
+        waypoint = dict(action_dict)
+        #Translates data into a move action
+        action_dict["pos_end_effector"] = "move" if isinstance(pose_cmd, list) else str(pose_cmd)
+        #Gets the gripper key
+        gripper_value = action_dict.get("gripper", None)
+        #Translates gripper data to open and close, already translated values (replayed logs) are kept
+        if gripper_value not in ("open", "close"):
+            action_dict["gripper"] = "close" if gripper_value == 220 else "open" if gripper_value == 30 else "unknown"
+
+        #Debugging purposes, attaches a time stamp to the action
+        #Uploaded waypoints are compared on their pose, every "move" looks the same
+        current_action_no_timestamp = {
+            "pos_end_effector": pose_cmd if upload else action_dict["pos_end_effector"],
+            "gripper": action_dict["gripper"]
+        }
+
+        #Checks if action is repeated. If not, continues
+        if current_action_no_timestamp == self.last_action_no_timestamp:
+            #Skips current step in the dictionary if it is repeated
+            print("Duplicate action skipped.")
+            return False
+
+        action_dict["timestamp"] = datetime.now().isoformat()
+        self.actions.append(action_dict)
+
+        # Save action, the log thread writes it to the disk
+        if self.action_log is not None:
+            self.action_log.write(action_dict)
+
+        # Send to robot, the pose waypoints with the others of the message (see handle_message)
+        print(f"Simplified command: {action_dict}")
+        if upload:
+            self.waypoints.append(waypoint)
+        else:
+            self.flush_waypoints()
+            self.send_command(action_dict["pos_end_effector"])
+
+        # Centroid conversion, only when the centroids are sent ({name: (u, v, z)})
+        centroids = action_dict.get("objects_detected", {})
+        if isinstance(centroids, dict) and centroids:
+            pixels = np.array([(u, v) for u, v, z in centroids.values()], dtype=float)
+            #Transforms all the centroids to base coordinates in one batch
+            base_coords_list = pixels_to_robot_frame(pixels)
+            for (name, (u, v, z)), base_coords in zip(centroids.items(), base_coords_list):
+                #Prints the centroid position relative to the robot base frame.
+                print(f"{name} (pixel): ({u:.1f}, {v:.1f}, {z:.1f}) --> Robot base: {base_coords}")
+
+        self.last_action_no_timestamp = current_action_no_timestamp
+        return True
 
 #Main function to connect to the remote server, receive data via json, and translate data into a readable format.
-def run_client():
+#upload_programs: moves the robot through the received poses, as URScript programs
+def run_client(upload_programs=False):
     #Create a socket to connect to the remote server
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_ip = "192.168.168.42" #Remote server IP
     server_port = 8000
-    last_action_no_timestamp = None
-    actions = [] #Empty action dictionary
+    #Rotated at 10MB, the receive loop never waits for the disk
+    action_log = ActionLogWriter("received_actions.jsonl")
+    send_waypoints = None
+    if upload_programs:
+        from ur_rcv_sim import send_waypoints_as_program as send_waypoints
+    handler = ActionHandler(action_log, send_waypoints=send_waypoints)
 
     #Waits until connection is formed to the remote server
     try:
         client.connect((server_ip, server_port))
         print(f"Connected to server at {server_ip}:{server_port}")
+        #The job server (--job_server) then sends the actions of every job here, the simulation server ignores it
+        send_message(client, {"type": "register_robot"})
+
+        #Reassembles the length-prefixed messages, whatever the size of the reads
+        decoder = FrameDecoder()
 
         while True:
-            #Size of the data received in the JSON file. Increase the value to increase the size of data transfer (bit sizes).
-            data = client.recv(4096)
+            #Size of the data read from the socket. Messages larger than this are reassembled by the decoder.
+            data = client.recv(65536)
             #No data received, closes connection.
             if not data:
                 print("No data received. Closing connection.")
                 break
 
-            #Data received, parses data
-            try:
-                action_data = json.loads(data.decode("utf-8"))
-                #Transforms into a readable dictionary
-                if isinstance(action_data, dict):
-                    action_data = [action_data]
-
-                for action_dict in action_data:
-                    #Prints action from the remote server before parsing.
-                    print(f"\nRaw action received: {action_dict}")
-                    #Gets the end effector position key
-                    pose_cmd = action_dict.get("pos_end_effector")
-                    #Translates data into a move action
-                    action_dict["pos_end_effector"] = "move" if isinstance(pose_cmd, list) else str(pose_cmd)
-                    #Gets the gripper key
-                    gripper_value = action_dict.get("gripper", None)
-                    #Translates gripper data to open and close
-                    action_dict["gripper"] = "close" if gripper_value == 220 else "open" if gripper_value == 30 else "unknown"
-
-                    #Debugging purposes, attaches a time stamp to the action
-                    current_action_no_timestamp = {
-                        "pos_end_effector": action_dict["pos_end_effector"],
-                        "gripper": action_dict["gripper"]
-                    }
-                    
-                    #Checks if action is repeated. If not, continues
-                    if current_action_no_timestamp != last_action_no_timestamp:
-                        action_dict["timestamp"] = datetime.now().isoformat()
-                        actions.append(action_dict)
-
-                        # Save action
-                        with open("received_actions.jsonl", "a") as f:
-                            f.write(json.dumps(action_dict) + "\n")
-
-                        # Send to robot
-                        print(f"Simplified command: {action_dict}")
-                        send_named_command(action_dict["pos_end_effector"]) 
-
-                        # Centroid conversion
-                        centroids = action_dict.get("objects_detected", {})
-                        for name, (u, v, z) in centroids.items():
-                            #measured depth from robot to object. Currently flat
-                            z_m = .42
-                            #cam_coords = pixel_to_camera_frame(u, v, z_m)
-                            #Grabs the undistorted pixels
-                            u_undist, v_undist = undistort_pixel(u, v)
-                            #Transforms pixels to the camera coordinates
-                            cam_coords = pixel_to_camera_frame(u_undist, v_undist, z_m)
-                            #Transforms to base coordinates
-                            base_coords = camera_to_robot_frame(cam_coords)
-                            #Prints the centroid position relative to the robot base frame.
-                            print(f"{name} (pixel): ({u:.1f}, {v:.1f}, {z:.1f}) --> Robot base: {base_coords}")
-
-                        last_action_no_timestamp = current_action_no_timestamp
-                    #Skips current step in the dictionary if it is repeated
-                    else:
-                        print("Duplicate action skipped.")
-            #If not valid JSON, discards.
-            except json.JSONDecodeError:
-                print("Received data is not valid JSON:", data)
+            #Data received, decodes every complete message. An invalid message is discarded.
+            messages = decoder.feed(data)
+            for error in decoder.errors:
+                print("Received data is not a valid message:", error)
+
+            for action_data in messages:
+                handler.handle_message(action_data)
+
+            #Invalid header, the stream can't be followed anymore
+            if decoder.error is not None:
+                print("Lost the message framing. Closing connection.")
+                break
 
     except Exception as e:
         print(f"Error: {e}")
     finally:
         client.close()
         print("Connection to server closed.")
+        action_log.close()
+        print(action_log.report())
 
-    print("\nAll received actions:", actions)
+    print("\nAll received actions:", handler.actions)
 
 if __name__ == "__main__":
-    run_client()
+    parser = argparse.ArgumentParser(description="Client of the remote server, forwards the actions to the robot")
+    parser.add_argument("--upload_programs", action="store_true", help="Move the robot through the received poses (compiled waypoints are blended)")
+    args = parser.parse_args()
+    run_client(args.upload_programs)
@@ -0,0 +1,103 @@
+'''
+HMI2 Lab
+Replays a recorded action log (received_actions.jsonl, see remote_send_sim.py) through
+the action handling path of the client, without the remote server.
+Used to benchmark the client and the robot driver offline.
+
+Key functionality:
+- Reads the log and its rotated files, oldest first.
+- Feeds every action to ActionHandler.handle, at the recorded pace (--speed 1),
+  faster (--speed 10) or as fast as possible (--speed 0).
+- Reports the handling latency of the actions and how late they were on the recorded schedule.
+
+Usage: python replay_actions.py --log received_actions.jsonl --speed 0 --no_robot --quiet
+'''
+
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from remote_send_sim import ActionHandler
+from tools.action_log import ActionLogWriter, read_action_log
+
+#Time of an action in the recording, in seconds
+def recorded_time(action_dict):
+    timestamp = action_dict.get("timestamp")
+    return datetime.fromisoformat(timestamp).timestamp() if timestamp else None
+
+#Feeds the actions to the handler at `speed` times the recorded pace (0: no waiting)
+def replay(actions, handler, speed=1.0):
+    latencies = []
+    lateness = []
+    handled = 0
+    first_time = None
+    start = time.perf_counter()
+    for action_dict in actions:
+        action_time = recorded_time(action_dict)
+        if speed > 0 and action_time is not None:
+            if first_time is None:
+                first_time = action_time
+            #Waits until the recorded time of the action
+            scheduled = start + (action_time - first_time) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lateness.append(max(0.0, time.perf_counter() - scheduled))
+        #The handler sets its own timestamp, the recorded one is removed like on reception
+        action_dict = {key: value for key, value in action_dict.items() if key != "timestamp"}
+        handle_start = time.perf_counter()
+        handled += handler.handle(action_dict)
+        latencies.append(time.perf_counter() - handle_start)
+    return latencies, lateness, handled, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded action log through the client")
+    parser.add_argument("--log", type=str, default="received_actions.jsonl", help="Recorded action log")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 1 for the recorded pace, 0 for as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times the log is replayed")
+    parser.add_argument("--no_robot", action="store_true", help="Don't send the commands to the robot driver, benchmark the client only")
+    parser.add_argument("--output_log", type=str, default=None, help="Also log the replayed actions to this file, like the client")
+    parser.add_argument("--quiet", action="store_true", help="Hide the prints of the handler")
+    args = parser.parse_args()
+
+    actions = list(read_action_log(args.log))
+    if not actions:
+        print(f"No action in {args.log}")
+        return
+    print(f"Replaying {len(actions)} actions from {args.log} x{args.repeat} at speed {args.speed or 'max'}")
+
+    action_log = ActionLogWriter(args.output_log) if args.output_log else None
+    send_command = (lambda command: None) if args.no_robot else None
+    handler = ActionHandler(action_log, send_command)
+
+    latencies, lateness, handled, elapsed = [], [], 0, 0.0
+    output = open(os.devnull, "w") if args.quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        for _ in range(args.repeat):
+            #Each replay starts from a fresh duplicate filter
+            handler.last_action_no_timestamp = None
+            run_latencies, run_lateness, run_handled, run_elapsed = replay(actions, handler, args.speed)
+            latencies += run_latencies
+            lateness += run_lateness
+            handled += run_handled
+            elapsed += run_elapsed
+    if args.quiet:
+        output.close()
+    if action_log is not None:
+        action_log.close()
+
+    latencies_ms = sorted(1000 * latency for latency in latencies)
+    p95 = latencies_ms[min(len(latencies_ms) - 1, int(0.95 * len(latencies_ms)))]
+    print(f"{len(latencies)} actions in {elapsed:.3f}s ({len(latencies) / elapsed:.0f} actions/s), {handled} sent to the robot, {len(latencies) - handled} duplicates")
+    print(f"Handling latency: median {statistics.median(latencies_ms):.3f}ms, p95 {p95:.3f}ms, max {latencies_ms[-1]:.3f}ms")
+    if lateness:
+        print(f"Lateness on the recorded schedule: median {1000 * statistics.median(lateness):.3f}ms, max {1000 * max(lateness):.3f}ms")
+    if action_log is not None:
+        print(action_log.report())
+
+if __name__ == "__main__":
+    main()
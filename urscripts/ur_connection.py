@@ -0,0 +1,233 @@
+'''
+HMI2 Lab
+Persistent connection to the URScript interface of the UR controller (primary port 30001).
+
+Key functionality:
+- Keeps one TCP socket to the controller, reconnects automatically when it is closed or broken.
+- Drains the robot state messages the controller streams on the port, so the connection is not dropped.
+- Builds a whole action sequence as a single URScript program (def ... end), the controller
+  then runs every waypoint of a pick_and_place without a new command per waypoint.
+- Emits the compiled waypoints of remoteserver/src/motion_compiler.py: "movep"/"movel" with
+  their blend radius, split into one program per gripper action (the gripper has its own socket).
+- Follows the "program running" flag of the robot state, to wait for the end of a program.
+
+Only uses the standard library. Can be tested without a robot with fake_ur_controller.py.
+'''
+
+import socket
+import threading
+import time
+
+#Formats a URScript movel line from a pose [x, y, z, rx, ry, rz]
+def movel_line(pose, a=0.1, v=0.1, t=5):
+    pose_str = ", ".join(str(val) for val in pose)
+    return f"movel(p[{pose_str}], a={a}, v={v}, t={t})"
+
+MOVES = ("movel", "movep")
+
+#Formats a URScript move of a path. move: "movel" or "movep", r: blend radius in meters, 0 stops at the pose.
+def move_line(pose, move="movel", a=0.1, v=0.1, r=0):
+    if move not in MOVES:
+        raise ValueError(f"Unknown move {move}, expected one of {MOVES}")
+    pose_str = ", ".join(str(val) for val in pose)
+    return f"{move}(p[{pose_str}], a={a}, v={v}, r={r})"
+
+#Splits waypoints {"pos_end_effector", "gripper", "move", "blend_radius"} into programs.
+#Returns [(lines, gripper)]: the moves of a program, then the gripper value to set once the robot
+#stopped at its last pose (None to leave the gripper). A program ends where the robot stops
+#(blend radius 0) and the gripper changes: a gripper value equal to the current one is not sent again.
+#Waypoints without "move" (not compiled) are stop-and-go movel, waypoints without a pose
+#(named commands) are skipped.
+#gripper: gripper value before the first waypoint (end of the previous message), None when unknown.
+def program_segments(waypoints, a=0.1, v=0.1, gripper=None):
+    segments = []
+    moves = []
+    for waypoint in waypoints:
+        pose = waypoint.get("pos_end_effector")
+        if not isinstance(pose, (list, tuple)):
+            continue
+        move = waypoint.get("move", "movel")
+        radius = waypoint.get("blend_radius") or 0
+        moves.append((pose, move, radius))
+        waypoint_gripper = waypoint.get("gripper")
+        if not radius and waypoint_gripper is not None and waypoint_gripper != gripper:
+            segments.append((moves, waypoint_gripper))
+            moves = []
+            gripper = waypoint_gripper
+    if moves:
+        segments.append((moves, None))
+    programs = []
+    for moves, segment_gripper in segments:
+        #The robot stops at the end of a program, its last move is never blended
+        pose, move, _ = moves[-1]
+        moves[-1] = (pose, move, 0)
+        programs.append(([move_line(pose, move, a, v, r) for pose, move, r in moves], segment_gripper))
+    return programs
+
+#Wraps URScript lines into a program. A program sent to the controller replaces the running one.
+def urscript_program(lines, name="svlr_plan"):
+    body = "".join(f"  {line}\n" for line in lines)
+    return f"def {name}():\n{body}end\n"
+
+#Robot state message (type 16) of the primary port: [length int32][type uint8] then sub packages
+#[length int32][type uint8][data]. Robot mode data (type 0): timestamp uint64, then the booleans
+#real robot connected, real robot enabled, power on, emergency stopped, protective stopped, program running.
+ROBOT_STATE = 16
+ROBOT_MODE_DATA = 0
+PROGRAM_RUNNING_OFFSET = 5 + 8 + 5
+
+#Program running flag of a robot state message, None if the message doesn't have it
+def program_running(message):
+    if len(message) < 5 or message[4] != ROBOT_STATE:
+        return None
+    offset = 5
+    while offset + 5 <= len(message):
+        length = int.from_bytes(message[offset:offset + 4], "big")
+        if length < 5:
+            return None
+        if message[offset + 4] == ROBOT_MODE_DATA and length > PROGRAM_RUNNING_OFFSET:
+            return bool(message[offset + PROGRAM_RUNNING_OFFSET])
+        offset += length
+    return None
+
+class URScriptConnection:
+    def __init__(self, host, port=30001, timeout=5.0, retries=3, retry_delay=0.5):
+        """
+        timeout: connect and send timeout, in seconds.
+        retries: attempts to send a script, reconnecting in between.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.socket = None
+        self.lock = threading.Lock()
+        #Program state, from the robot state messages
+        self.state = threading.Condition()
+        self.program_running = False
+        self.programs_finished = 0
+        self.programs_finished_at_send = 0
+
+        #Metrics
+        self.connections = 0
+        self.scripts_sent = 0
+
+    def connected(self):
+        return self.socket is not None
+
+    def connect(self):
+        """Opens the socket, if not connected. Called with the lock held."""
+        if self.socket is not None:
+            return
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.socket = sock
+        self.connections += 1
+        #Reads (and discards) the robot state messages, and notices when the controller closes the connection
+        threading.Thread(target=self.drain, args=(sock,), name="urscript_drain", daemon=True).start()
+        print(f"Connected to the UR controller at {self.host}:{self.port}")
+
+    def drain(self, sock):
+        buffer = b""
+        while True:
+            try:
+                data = sock.recv(65536)
+                if not data:
+                    break
+            #The socket timeout is for the sends, no state message for a while is fine
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            buffer += data
+            #Splits the messages, [length int32] first
+            while len(buffer) >= 4:
+                length = int.from_bytes(buffer[:4], "big")
+                if length < 5:
+                    buffer = b""
+                    break
+                if len(buffer) < length:
+                    break
+                self.update_state(buffer[:length])
+                buffer = buffer[length:]
+        #The connection is gone, the next send reconnects
+        with self.lock:
+            if self.socket is sock:
+                self.socket = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def update_state(self, message):
+        running = program_running(message)
+        if running is None:
+            return
+        with self.state:
+            if self.program_running and not running:
+                self.programs_finished += 1
+            self.program_running = running
+            self.state.notify_all()
+
+    def wait_for_program(self, timeout=60.0, start_timeout=1.0):
+        """
+        Waits until the last program sent is done. Returns False when it was not seen running
+        within `start_timeout` (no robot state) or is still running after `timeout` seconds.
+        """
+        with self.state:
+            started = self.state.wait_for(
+                lambda: self.program_running or self.programs_finished > self.programs_finished_at_send,
+                start_timeout,
+            )
+            if not started:
+                return False
+            return self.state.wait_for(lambda: not self.program_running, timeout)
+
+    def disconnect(self):
+        """Called with the lock held."""
+        if self.socket is not None:
+            try:
+                #Wakes the drain thread up
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+            self.socket = None
+
+    def send(self, script):
+        """
+        Sends a URScript line or program, reconnecting if needed.
+        Raises ConnectionError after `retries` failed attempts.
+        """
+        if not script.endswith("\n"):
+            script += "\n"
+        data = script.encode("utf-8")
+        error = None
+        for attempt in range(self.retries):
+            with self.lock:
+                try:
+                    self.connect()
+                    self.socket.sendall(data)
+                    self.scripts_sent += 1
+                    return
+                except OSError as e:
+                    error = e
+                    self.disconnect()
+            print(f"URScript send failed ({error}), reconnecting (attempt {attempt + 1}/{self.retries})")
+            time.sleep(self.retry_delay)
+        raise ConnectionError(f"Could not send the URScript to {self.host}:{self.port}: {error}")
+
+    def send_program(self, lines, name="svlr_plan"):
+        """Sends the lines as one program, the controller runs them in sequence."""
+        with self.state:
+            self.programs_finished_at_send = self.programs_finished
+        self.send(urscript_program(lines, name))
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+    def report(self):
+        return f"URScript connection {self.host}:{self.port}: {self.scripts_sent} scripts sent, {self.connections} connections"
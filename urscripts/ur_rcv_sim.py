@@ -5,18 +5,21 @@ This script connects to a UR robot and sends URScript commands to it.
 It also controls a Robotiq gripper via its TCP/IP interface.
 
 Key functionality:
-- Establishes a TCP socket connection to the UR robot controller.
-- Sends URScript commands to move the robot to specified poses.
+- Keeps one TCP connection to the UR robot controller, reconnected when needed (see ur_connection.py).
+- Sends URScript commands to move the robot to specified poses, or a whole sequence of poses as one program.
+- Sends compiled waypoints (movep/movel with a blend radius) as programs, the gripper acting between them.
 - Interfaces with a Robotiq gripper to open and close it based on commands.
 '''
-import socket
 import robotiq_gripper
 import time
+from ur_connection import URScriptConnection, movel_line, program_segments
 
 # Robot connection details
 robotIP = "192.168.168.5"
 PRIMARY_PORT = 30001
-new_line = "\n"
+
+#Persistent connection, opened on the first command
+robot_connection = URScriptConnection(robotIP, PRIMARY_PORT)
 
 gripper_ip = "192.168.168.5"
 # This port needs to be allowed on the robot controller itself
@@ -33,11 +36,7 @@ def send_urscript_command(command: str):
     Sends a URScript command to the robot.
     """
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((robotIP, PRIMARY_PORT))
-        command += new_line
-        s.sendall(command.encode('utf-8'))
-        #s.close()
+        robot_connection.send(command)
         print("URScript command sent successfully.")
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -57,11 +56,42 @@ def send_pose_as_command(pose):
     """
     Formats a URScript command using the given pose and sends it to the robot.
     """
-    new_pose_str = ", ".join(str(val) for val in pose)
-    command = f"movel(p[{new_pose_str}], a=0.1, v=0.1, t=5)"
+    command = movel_line(pose)
     print(f"Sending robot command: {command}")
     send_urscript_command(command)
 
+def send_poses_as_program(poses):
+    """
+    Sends a sequence of poses (e.g. every waypoint of a pick_and_place) as one URScript program,
+    the controller moves through them without a command per waypoint.
+    """
+    send_waypoints_as_program([{"pos_end_effector": pose} for pose in poses])
+
+def send_waypoints_as_program(waypoints, gripper=None, timeout=60.0):
+    """
+    Sends waypoints {"pos_end_effector", "gripper"} as URScript programs. Compiled waypoints
+    (remoteserver/src/motion_compiler.py) are sent with their move and blend radius, the robot
+    goes through the blended ones without stopping.
+    The gripper is on its own socket: the waypoints are split at every stop where the gripper
+    changes, each part is one program, and the gripper acts once the robot finished it.
+    gripper: gripper value before the waypoints, None when unknown.
+    Returns the gripper value once the robot finished the last program.
+    """
+    try:
+        for lines, gripper_value in program_segments(waypoints, gripper=gripper):
+            print(f"Sending robot program of {len(lines)} moves")
+            robot_connection.send_program(lines)
+            print("URScript program sent successfully.")
+            #A new program replaces the running one, and the gripper must not act while the robot moves
+            if not robot_connection.wait_for_program(timeout):
+                print("Could not follow the robot program, the next moves are not sent.")
+                break
+            if gripper_value is not None:
+                control_gripper(gripper_value)
+                gripper = gripper_value
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    return gripper
 
 def control_gripper(gripper_value):
     """